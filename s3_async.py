@@ -0,0 +1,377 @@
+import asyncio
+from collections import deque
+import contextlib
+import datetime
+import numpy as np
+import re
+
+from aiobotocore.config import AioConfig
+from botocore.exceptions import ClientError
+# aiobotocore must be installed to use this module
+
+from s3_client import config_arguments
+from s3_delete import DELETE_BATCH_SIZE
+from s3_generate import gen_python_dict_from_tagging_list, gen_tagging_list_from_python_dict
+from s3_get import forget_bucket_tags, helper_date_intervals, helper_filter_page, helper_name_date_mask, helper_tag_query
+from s3_metrics import instrument_client, output, traced
+from s3_set import helper_lifecycle_from_arguments, helper_logging_policy, merge_lifecycle_rules
+from s3_throttle import get_limiter
+
+# asyncio versions of the s3_get, s3_set and s3_delete functions.
+# `session` is an aiobotocore session (aiobotocore.session.get_session()), not a boto3 session.
+# Every function takes an optional `s3_client` so many calls can share one client and its connection pool,
+# make one with `async with s3_client(session) as client:`.
+# Fan-outs run on the event loop, bounded by an asyncio.Semaphore of `max_concurrency`. Their requests, and
+# the tag setters', wait for a slot of the shared s3_throttle limiter like the threaded versions'.
+
+@contextlib.asynccontextmanager
+async def s3_client(session, max_concurrency: int = 64, **client_arguments):
+    '''
+    Async context manager making an S3 client whose connection pool fits `max_concurrency` requests.
+
+    The retry, keep-alive and timeout settings are the ones of s3_client.configure_clients(),
+    its calls are recorded by s3_metrics like the pooled clients'.
+
+    Parameters:
+    `session` aiobotocore.session.AioSession
+    `max_concurrency` int
+        the number of connections kept in the client's pool.
+    `client_arguments`
+        passed to session.create_client(), e.g. region_name or endpoint_url.
+    '''
+    config = AioConfig(**(config_arguments() | {"max_pool_connections": max_concurrency}))
+    async with session.create_client("s3", config = config, **client_arguments) as client:
+        yield instrument_client(client)
+
+@contextlib.asynccontextmanager
+async def helper_client(session, client = None):
+    '''helper for the async functions, yields `client` or a new client closed on exit'''
+    if client is not None:
+        yield client
+    else:
+        async with s3_client(session) as new_client:
+            yield new_client
+
+async def gather_bounded(coroutines, max_concurrency: int = 64) -> list:
+    '''
+    Runs `coroutines` concurrently with at most `max_concurrency` running at once and returns their results in order.
+
+    Parameters:
+    `coroutines` iterable of coroutines
+    `max_concurrency` int
+        the size of the semaphore bounding the fan-out.
+    '''
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async def bounded(coroutine):
+        async with semaphore:
+            return await coroutine
+    return await asyncio.gather(*(bounded(coroutine) for coroutine in coroutines))
+
+async def map_bounded(func, items, max_in_flight: int = 64):
+    '''
+    Lazily yields `await func(item)` for every item of the async iterable `items`, in the same order as `items`.
+
+    Async version of s3_parallel.bounded_map(): at most `max_in_flight` calls run at once and `items`
+    is only consumed as fast as results are yielded. A slow call holds back the results after it,
+    not the calls, which keep running across the pages of a listing.
+
+    Parameters:
+    `func` coroutine function
+        called with one item at a time.
+    `items` async iterable
+    `max_in_flight` int
+        the maximum number of calls running or waiting to be yielded.
+    '''
+    pending = deque()
+    try:
+        async for item in items:
+            if len(pending) >= max_in_flight:
+                yield await pending.popleft()
+            pending.append(asyncio.ensure_future(func(item)))
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending: task.cancel()
+
+## listing
+@traced
+async def iter_objects(session, bucket_name: str, object_prefix: str = "", s3_client = None):
+    '''
+    Lazily yields the object dicts in `bucket_name` following list_objects_v2 continuation tokens.
+
+    Async version of s3_get.iter_objects().
+    '''
+    async with helper_client(session, s3_client) as client:
+        paginator = client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket = bucket_name, Prefix = object_prefix or ""):
+            for obj in page.get("Contents", []):
+                yield obj
+
+## tag filter
+@traced
+async def get_buckets_with_tags(session, tags: list[dict]|dict|str, s3_format = True,
+                                max_concurrency: int = 64, s3_client = None) -> list[tuple]:
+    '''
+    Returns list of tuples containing buckets and their tags based on filtering by `tags`
+
+    Async version of s3_get.get_buckets_with_tags(), the bucket tags are fetched concurrently.
+    `max_concurrency` bounds the number of get_bucket_tagging requests in flight.
+    '''
+    query = helper_tag_query(tags, s3_format)
+    async with helper_client(session, s3_client) as client:
+        async def bucket_tags(bucket):
+            try:
+                return bucket, (await get_limiter().async_call(bucket["Name"], "", client.get_bucket_tagging,
+                                                               Bucket = bucket["Name"]))["TagSet"]
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "NoSuchTagSet": output("Error: ", err.response)
+                return bucket, None
+        bucket_list = (await client.list_buckets())["Buckets"]
+        tagged = await gather_bounded((bucket_tags(bucket) for bucket in bucket_list), max_concurrency)
+    return [(bucket, bucket_tags) for bucket, bucket_tags in tagged
+            if bucket_tags is not None and query.matches(gen_python_dict_from_tagging_list(bucket_tags))]
+
+@traced
+async def iter_objects_with_tags_from_bucket(session, bucket_name: str, tags: list[dict]|dict|str,
+                                             object_prefix: str = None, s3_format = True,
+                                             max_concurrency: int = 64, s3_client = None):
+    '''
+    Lazily yields tuples containing `bucket_name`'s objects and their tags based on `tags`, in listing order.
+
+    Async version of s3_get.iter_objects_with_tags_from_bucket(), the tags are fetched concurrently
+    while the listing goes on, at most `max_concurrency` requests at once across pages.
+    '''
+    query = helper_tag_query(tags, s3_format)
+    async with helper_client(session, s3_client) as client:
+        async def object_tags(obj):
+            response = await get_limiter().async_call(bucket_name, obj["Key"], client.get_object_tagging,
+                                                      Bucket = bucket_name, Key = obj["Key"])
+            return obj, gen_python_dict_from_tagging_list(response["TagSet"])
+        objects = iter_objects(session, bucket_name, object_prefix or "", s3_client = client)
+        async for obj, tag_dict in map_bounded(object_tags, objects, max_concurrency):
+            if query.matches(tag_dict):
+                yield obj, tag_dict
+
+@traced
+async def get_objects_with_tags_from_bucket(session, bucket_name: str, tags: list[dict]|dict|str,
+                                            object_prefix: str = None, s3_format = True,
+                                            max_concurrency: int = 64, s3_client = None) -> list[tuple]:
+    '''
+    Returns list of tuples containing `bucket_name`'s objects and their tags based on `tags`
+
+    Async version of s3_get.get_objects_with_tags_from_bucket(), see iter_objects_with_tags_from_bucket().
+    '''
+    return [tagged async for tagged in iter_objects_with_tags_from_bucket(
+        session, bucket_name, tags, object_prefix, s3_format, max_concurrency, s3_client)]
+
+## name date filter
+@traced
+async def get_buckets_with_name_date(session, prefix: str,
+                                     use_date: list[str|datetime.datetime|datetime.date]
+                                     | str|datetime.datetime|datetime.date
+                                     | None = None, regex: str = None, s3_client = None) -> list[dict]:
+    '''
+    Returns list of bucket dicts whose name starts with `prefix` and made on or in (list) `use_date`.
+
+    Async version of s3_get.get_buckets_with_name_date().
+    '''
+    assert use_date is None or isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
+    intervals = helper_date_intervals(use_date)
+    async with helper_client(session, s3_client) as client:
+        bucket_list = (await client.list_buckets())["Buckets"]
+    if not bucket_list:
+        return []
+    mask = helper_name_date_mask(np.array([bucket["Name"] for bucket in bucket_list]),
+                                 np.array([bucket["CreationDate"].timestamp() for bucket in bucket_list]),
+                                 prefix, intervals, regex = re.compile(regex) if regex else None)
+    return [bucket for bucket, keep in zip(bucket_list, mask) if keep]
+
+@traced
+async def get_objects_with_name_date(session, bucket_name: str, object_prefix: str,
+                                     use_date: list[str|datetime.datetime|datetime.date]
+                                     | str|datetime.datetime|datetime.date
+                                     | None = None, min_size: int = None, max_size: int = None,
+                                     storage_class: str|list[str] = None, regex: str = None,
+                                     s3_client = None) -> list[dict]:
+    '''
+    Returns list of objects who start with `object_prefix` and were modified on or in (list) `use_date`.
+
+    Async version of s3_get.get_objects_with_name_date().
+    '''
+    assert use_date is None or isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
+    intervals = helper_date_intervals(use_date)
+    pattern = re.compile(regex) if regex else None
+    objects = []
+    async with helper_client(session, s3_client) as client:
+        paginator = client.get_paginator("list_objects_v2")
+        async for page in paginator.paginate(Bucket = bucket_name, Prefix = object_prefix or ""):
+            objects.extend(helper_filter_page(page.get("Contents", []), intervals, min_size, max_size,
+                                              storage_class, pattern))
+    return objects
+
+## tag setters
+@traced
+async def add_tags_to_bucket(session, bucket_name: str, tags: list[dict]|dict, s3_format = True,
+                             overwrite = False, tag_index = None, s3_client = None):
+    '''
+    Adds tags to an s3 bucket and returns the tagging response, None if S3 refused the tags.
+
+    Async version of s3_set.add_tags_to_bucket().
+    '''
+    assert isinstance(tags, (list,dict))
+    if not s3_format:
+        tags = gen_tagging_list_from_python_dict(tags)
+    async with helper_client(session, s3_client) as client:
+        if not overwrite:
+            try:
+                tags.extend((await get_limiter().async_call(bucket_name, "", client.get_bucket_tagging,
+                                                            Bucket = bucket_name))["TagSet"])
+            except ClientError as err:
+                if err.response["Error"]["Code"] != "NoSuchTagSet": raise
+        try:
+            response = await get_limiter().async_call(bucket_name, "", client.put_bucket_tagging,
+                                                      Bucket = bucket_name, Tagging = {"TagSet": tags})
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "InvalidTag":
+                output("There may be a duplicate tag")
+                return None
+            raise
+    forget_bucket_tags(bucket_name) #cached by s3_get's bucket scans
+    if tag_index is not None:
+        tag_index.put_bucket_tags(bucket_name, tags)
+    return response
+
+@traced
+async def add_tags_to_object(session, bucket_name: str, object_name: str, tags: list[dict]|dict,
+                             s3_format = True, overwrite = False, tag_index = None, s3_client = None):
+    '''
+    Adds tags to an s3 object and returns the tagging response, None if S3 refused the tags.
+
+    Async version of s3_set.add_tags_to_object().
+    '''
+    if not s3_format:
+        tags = gen_tagging_list_from_python_dict(tags)
+    async with helper_client(session, s3_client) as client:
+        if not overwrite:
+            tags.extend((await get_limiter().async_call(bucket_name, object_name, client.get_object_tagging,
+                                                        Bucket = bucket_name, Key = object_name))["TagSet"])
+        try:
+            response = await get_limiter().async_call(bucket_name, object_name, client.put_object_tagging,
+                                                      Bucket = bucket_name, Key = object_name,
+                                                      Tagging = {"TagSet": tags})
+        except ClientError as err:
+            if err.response["Error"]["Code"] == "InvalidTag":
+                output("There may be a duplicate tag")
+                return None
+            raise
+    if tag_index is not None:
+        tag_index.put_object_tags(bucket_name, object_name, tags)
+    return response
+
+## lifecycle and logging
+@traced
+async def add_bucket_lifecycle(session, lifecycle_name: str, bucket_name: str, expected_owner: str = None,
+                               s3_client = None, **lifecycle_arguments):
+    '''
+    Sets a data lifecycle management configuration on a bucket in S3 and returns the configuration response.
+
+    Async version of s3_set.add_bucket_lifecycle(), `lifecycle_arguments` are its keyword arguments
+    (transition, transition_days, expiration, ..., abort_incomplete_days).
+    The rule replaces the existing rule with the same ID, see s3_set.merge_lifecycle_rules().
+    '''
+    assert isinstance(expected_owner, (str,type(None)))
+    config_json = helper_lifecycle_from_arguments(lifecycle_name, bucket_name, **lifecycle_arguments)
+    owner = {"ExpectedBucketOwner": expected_owner} if expected_owner else {}
+    async with helper_client(session, s3_client) as client:
+        try:
+            existing = await client.get_bucket_lifecycle_configuration(Bucket = bucket_name, **owner)
+            config_json["Rules"] = merge_lifecycle_rules(existing["Rules"], config_json["Rules"])
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "NoSuchLifecycleConfiguration": raise
+        return await client.put_bucket_lifecycle_configuration(
+            Bucket = bucket_name, LifecycleConfiguration = config_json, **owner)
+
+@traced
+async def grant_logging_permissions_bucket_policy(session, logging_bucket_name: str,
+                                                  source_accounts: str|list[str], s3_client = None):
+    '''
+    Gives a bucket a bucket policy that will allow it to be used for server access logging.
+
+    Async version of s3_set.grant_logging_permissions_bucket_policy().
+    '''
+    policy = helper_logging_policy(logging_bucket_name, source_accounts)
+    async with helper_client(session, s3_client) as client:
+        return await client.put_bucket_policy(Bucket = logging_bucket_name, Policy = policy)
+
+@traced
+async def set_bucket_server_access_logging_on(session, source_bucket_name: str, logging_bucket_name: str,
+                                              logging_path_prefix: str|None = None, s3_client = None):
+    '''
+    Activates logging of `source_bucket_name` in `logging_bucket_name` at path = `logging_path_prefix/`
+
+    Async version of s3_set.set_bucket_server_access_logging_on().
+    '''
+    assert isinstance(source_bucket_name, str)
+    assert isinstance(logging_bucket_name, str)
+    if logging_path_prefix is None:
+        logging_path_prefix = source_bucket_name + "/"
+    elif logging_path_prefix[-1] != "/":
+        logging_path_prefix += "/"
+    async with helper_client(session, s3_client) as client:
+        return await client.put_bucket_logging(
+            Bucket = source_bucket_name,
+            BucketLoggingStatus = {"LoggingEnabled": {"TargetBucket": logging_bucket_name,
+                                                      "TargetPrefix": logging_path_prefix}})
+
+@traced
+async def set_bucket_server_access_logging_off(session, source_bucket_name: str, s3_client = None):
+    '''
+    Turns off logging for `source_bucket_name`
+
+    Async version of s3_set.set_bucket_server_access_logging_off().
+    '''
+    async with helper_client(session, s3_client) as client:
+        return await client.put_bucket_logging(Bucket = source_bucket_name, BucketLoggingStatus = {})
+
+## delete
+@traced
+async def delete_objects__with_prefix(session, bucket_name: str, prefix: str, max_concurrency: int = 8,
+                                      dry_run: bool = False, s3_client = None) -> dict:
+    '''
+    Deletes every version and delete marker under `prefix` in batches of 1,000 keys sent concurrently.
+
+    Async version of s3_delete.delete_objects__with_prefix(), returns {"Deleted": int, "Errors": list[dict], "DryRun": bool}
+    '''
+    assert isinstance(bucket_name, str)
+    assert isinstance(prefix, str)
+    result = {"Deleted": 0, "Errors": [], "DryRun": dry_run}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with helper_client(session, s3_client) as client:
+        async def delete_batch(batch):
+            try:
+                if not dry_run:
+                    response = await get_limiter().async_call(bucket_name, batch[0]["Key"], client.delete_objects,
+                                                              Bucket = bucket_name,
+                                                              Delete = {"Objects": batch, "Quiet": True})
+                    result["Errors"].extend(response.get("Errors", []))
+                    result["Deleted"] -= len(response.get("Errors", []))
+                result["Deleted"] += len(batch)
+            finally:
+                semaphore.release()
+
+        #batches are deleted while the next pages are listed, at most `max_concurrency` at once
+        tasks = []
+        batch = []
+        paginator = client.get_paginator("list_object_versions")
+        async for page in paginator.paginate(Bucket = bucket_name, Prefix = prefix):
+            for version in page.get("Versions", []) + page.get("DeleteMarkers", []):
+                batch.append({"Key": version["Key"], "VersionId": version["VersionId"]})
+                if len(batch) == DELETE_BATCH_SIZE:
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(delete_batch(batch)))
+                    batch = []
+        if batch:
+            await semaphore.acquire()
+            tasks.append(asyncio.create_task(delete_batch(batch)))
+        await asyncio.gather(*tasks)
+    return result
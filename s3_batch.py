@@ -0,0 +1,396 @@
+from botocore.exceptions import BotoCoreError, ClientError
+import csv
+import io
+import itertools
+import json
+import time
+from urllib import parse
+import uuid
+
+from s3_client import get_client
+from s3_generate import gen_tagging_list_from_python_dict, upload_object, VALID_STORAGE
+from s3_metrics import output, traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_throttle import get_limiter
+
+# S3 Batch Operations runs one operation over every key of a CSV manifest stored in S3,
+# which suits runs of millions of keys better than a client-side loop.
+# The manifest rows are "bucket,url-encoded key", the completion report is a manifest.json
+# listing CSV result files with one "bucket,key,version,status,error code,HTTP status,message" row per task.
+# LocalBatchBackend reads and writes the same files but runs the tasks with a local thread pool,
+# it is the fallback where Batch Operations is unavailable and the stand-in for testing.
+# Manifests and reports are streamed: the manifest is uploaded in parts while the keys are listed,
+# and the local backend reads it line by line and writes a result file every `REPORT_CHUNK_ROWS` rows.
+
+REPORT_SCHEMA = "Bucket, Key, VersionId, TaskStatus, ErrorCode, HTTPStatusCode, ResultMessage"
+TERMINAL_STATUSES = ("Complete", "Failed", "Cancelled")
+REPORT_CHUNK_ROWS = 100_000 #rows per result file of a local completion report
+
+class CsvReader:
+    '''
+    Binary file-like object reading the CSV text of `rows` as they are produced, so it can be uploaded
+    in parts with s3_generate.upload_object() without being built in memory.
+
+    Parameters:
+    `rows` iterable of lists
+        the CSV rows, consumed `chunk_rows` at a time.
+    `chunk_rows` int
+        the number of rows formatted at once.
+    '''
+    def __init__(self, rows, chunk_rows: int = 10_000):
+        self.rows = iter(rows)
+        self.chunk_rows = chunk_rows
+        self.buffer = bytearray()
+        self.count = 0 #rows read so far
+
+    def read(self, size: int = -1) -> bytes:
+        '''Returns the next `size` bytes, fewer only at the end of the rows, all of the rest if `size` is negative'''
+        while size < 0 or len(self.buffer) < size:
+            chunk = list(itertools.islice(self.rows, self.chunk_rows))
+            if not chunk:
+                break
+            text = io.StringIO()
+            csv.writer(text, lineterminator = "\n").writerows(chunk)
+            self.buffer += text.getvalue().encode()
+            self.count += len(chunk)
+        size = len(self.buffer) if size < 0 else size
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+@traced
+def write_manifest(session, objects, manifest_bucket:str, manifest_key:str, bucket_name:str = None) -> dict:
+    '''
+    Writes the CSV manifest of `objects` to S3 and returns its location for create_job().
+
+    Returns {"ObjectArn": manifest arn, "ETag": manifest ETag, "Count": number of keys}
+
+    The manifest is uploaded in parts with s3_generate.upload_object() while `objects` is consumed,
+    so it is never held in memory as a whole.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `objects` iterable of str, object dicts or (bucket, key) tuples
+        the keys to process, e.g. the output of s3_get.iter_objects_with_name_date().
+        Keys given as str or object dicts are in `bucket_name`.
+    `manifest_bucket` str
+        the bucket the manifest is written to
+    `manifest_key` str
+        the key of the manifest
+    `bucket_name` str
+        the bucket of the keys given as str or object dicts.
+    '''
+    def rows():
+        for obj in objects:
+            if isinstance(obj, tuple): bucket, key = obj
+            else: bucket, key = bucket_name, obj["Key"] if isinstance(obj, dict) else obj
+            assert bucket is not None, "`bucket_name` is needed for keys given without their bucket"
+            yield bucket, parse.quote(key, safe = "/") #keys are url-encoded in manifests
+
+    reader = CsvReader(rows())
+    _, response, *_ = upload_object(session, manifest_bucket, manifest_key, reader, verbose = False)
+    return {"ObjectArn": f"arn:aws:s3:::{manifest_bucket}/{manifest_key}", "ETag": response["ETag"],
+            "Count": reader.count}
+
+def helper_operation(operation:str, tags:dict = None, target_bucket:str = None,
+                     target_prefix:str = None, storage_class:str = None) -> dict:
+    '''
+    helper for run_batch_job(), the create_job Operation of `operation` ("tag", "copy" or "storage_class")
+    `target_bucket` is needed by both copies, for "storage_class" it is the bucket of the objects.
+    '''
+    assert operation in ("tag", "copy", "storage_class"), f"Invalid operation = {operation}"
+    if operation == "tag":
+        assert tags is not None, "`tags` is needed for the tag operation"
+        return {"S3PutObjectTagging": {"TagSet": gen_tagging_list_from_python_dict(tags)}}
+    assert target_bucket is not None, f"`target_bucket` is needed for the {operation} operation"
+    copy = {"MetadataDirective": "COPY", "TargetResource": f"arn:aws:s3:::{target_bucket}"}
+    if operation == "copy":
+        if target_prefix: copy["TargetKeyPrefix"] = target_prefix
+    else:
+        assert storage_class is not None, "`storage_class` is needed for the storage_class operation"
+    if storage_class is not None:
+        assert storage_class in VALID_STORAGE, f"Invalid storage_class = {storage_class}"
+        copy["StorageClass"] = storage_class
+    return {"S3PutObjectCopy": copy}
+
+def helper_arn_path(arn:str) -> tuple[str, str]:
+    '''helper for batch functions, the (bucket, key) of an "arn:aws:s3:::bucket/key" arn'''
+    bucket, _, key = arn.split(":::", 1)[1].partition("/")
+    return bucket, key
+
+class LocalBatchBackend:
+    '''
+    Runs S3 Batch Operations jobs with a local thread pool, behind the same calls as the s3control client.
+
+    create_job() reads the manifest, runs every task and writes the completion report before returning,
+    so describe_job() always finds the job finished. Only the "S3PutObjectTagging" and "S3PutObjectCopy"
+    operations are supported. The manifest is read line by line and the report rows are written
+    `REPORT_CHUNK_ROWS` at a time, so jobs of any size run in bounded memory.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `max_workers` int
+        the number of tasks running at once.
+    `verbose` bool
+        if True, the progress and throughput are printed while running a job.
+    '''
+    def __init__(self, session, max_workers:int = 16, verbose:bool = True):
+        self.session = session
+        self.max_workers = max_workers
+        self.verbose = verbose
+        self.jobs = {}
+
+    def helper_task(self, operation:dict, bucket:str, key:str) -> tuple:
+        '''helper for create_job(), runs `operation` on one key and returns its report row'''
+        s3_client = get_client(self.session)
+        limiter = get_limiter() #like Batch Operations, throttled tasks are retried instead of failed
+        try:
+            if "S3PutObjectTagging" in operation:
+                limiter.call(bucket, key, s3_client.put_object_tagging, Bucket = bucket, Key = key,
+                             Tagging = {"TagSet": operation["S3PutObjectTagging"]["TagSet"]})
+            else:
+                copy = operation["S3PutObjectCopy"]
+                target_bucket = copy["TargetResource"].split(":::", 1)[1] if "TargetResource" in copy else bucket
+                arguments = {"StorageClass": copy["StorageClass"]} if "StorageClass" in copy else {}
+                limiter.call(target_bucket, copy.get("TargetKeyPrefix", "") + key, s3_client.copy_object,
+                             Bucket = target_bucket, Key = copy.get("TargetKeyPrefix", "") + key,
+                             CopySource = {"Bucket": bucket, "Key": key},
+                             MetadataDirective = copy["MetadataDirective"], **arguments)
+            return bucket, key, "", "succeeded", "", "200", "Successful"
+        except ClientError as err:
+            error = err.response["Error"]
+            return (bucket, key, "", "failed", error.get("Code", ""),
+                    str(err.response["ResponseMetadata"].get("HTTPStatusCode", "")), error.get("Message", ""))
+
+    def create_job(self, AccountId:str, Operation:dict, Report:dict, Manifest:dict, Priority:int,
+                   RoleArn:str, ClientRequestToken:str = None, Description:str = "",
+                   ConfirmationRequired:bool = False, **kwargs) -> dict:
+        assert "S3PutObjectTagging" in Operation or "S3PutObjectCopy" in Operation, \
+            f"LocalBatchBackend does not support {list(Operation)}"
+        job_id = str(uuid.uuid4())
+        s3_client = get_client(self.session)
+        manifest_bucket, manifest_key = helper_arn_path(Manifest["Location"]["ObjectArn"])
+        body = s3_client.get_object(Bucket = manifest_bucket, Key = manifest_key)["Body"]
+        lines = (line.decode() for line in body.iter_lines() if line)
+        tasks = ((bucket, parse.unquote(key)) for bucket, key, *_ in csv.reader(lines))
+        progress = ProgressCounter(f"Batch job {job_id}", unit = "tasks", verbose = self.verbose)
+
+        def run(task):
+            try: return self.helper_task(Operation, *task)
+            finally: progress.add()
+
+        write_report = Report.get("Enabled")
+        statuses = ("failed",) if Report.get("ReportScope") == "FailedTasksOnly" else ("succeeded", "failed")
+        pending = {"succeeded": [], "failed": []} #report rows not written yet
+        results = []
+        total = failed = 0
+        for row in bounded_map(run, tasks, self.max_workers):
+            total += 1
+            failed += row[3] == "failed"
+            if not write_report or row[3] not in statuses:
+                continue
+            pending[row[3]].append(row)
+            if len(pending[row[3]]) >= REPORT_CHUNK_ROWS:
+                results.append(self.helper_write_results(job_id, Report, row[3], pending[row[3]]))
+                pending[row[3]] = []
+        progress.close()
+        if write_report:
+            for status, rows in pending.items():
+                if rows: results.append(self.helper_write_results(job_id, Report, status, rows))
+            self.helper_write_report(job_id, Report, results)
+        self.jobs[job_id] = {
+            "JobId": job_id, "Description": Description, "Operation": Operation, "Priority": Priority,
+            "Status": "Complete", "Report": Report, "Manifest": Manifest, "RoleArn": RoleArn,
+            "ProgressSummary": {"TotalNumberOfTasks": total, "NumberOfTasksSucceeded": total - failed,
+                                "NumberOfTasksFailed": failed},
+        }
+        return {"JobId": job_id}
+
+    def helper_report_prefix(self, job_id:str, report:dict) -> tuple[str, str]:
+        '''helper for the report methods, the (bucket, prefix) of a job's completion report'''
+        report_bucket = report["Bucket"].split(":::", 1)[1]
+        prefix = f"{report['Prefix'].rstrip('/')}/job-{job_id}" if report.get("Prefix") else f"job-{job_id}"
+        return report_bucket, prefix
+
+    def helper_write_results(self, job_id:str, report:dict, status:str, rows:list[tuple]) -> dict:
+        '''helper for create_job(), writes one result file of `status` rows and returns its report manifest entry'''
+        report_bucket, prefix = self.helper_report_prefix(job_id, report)
+        text = io.StringIO()
+        csv.writer(text, lineterminator = "\n").writerows(
+            (bucket, parse.quote(key, safe = "/"), *rest) for bucket, key, *rest in rows)
+        key = f"{prefix}/results/{uuid.uuid4().hex}.csv"
+        get_client(self.session).put_object(Bucket = report_bucket, Key = key, Body = text.getvalue().encode())
+        return {"TaskExecutionStatus": status, "Bucket": report_bucket, "Key": key}
+
+    def helper_write_report(self, job_id:str, report:dict, results:list[dict]):
+        '''helper for create_job(), writes the manifest.json of the completion report like Batch Operations does'''
+        report_bucket, prefix = self.helper_report_prefix(job_id, report)
+        manifest = {"Format": "Report_CSV_20180820", "ReportCreationDate": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                    "Results": results, "ReportSchema": REPORT_SCHEMA}
+        get_client(self.session).put_object(Bucket = report_bucket, Key = f"{prefix}/manifest.json",
+                                            Body = json.dumps(manifest).encode())
+
+    def describe_job(self, AccountId:str, JobId:str) -> dict:
+        return {"Job": self.jobs[JobId]}
+
+@traced
+def wait_for_job(backend, account_id:str, job_id:str, poll_interval:float = 30, timeout:float = None,
+                 verbose:bool = True) -> dict:
+    '''
+    Polls a Batch Operations job until it finishes and returns its describe_job "Job" dict.
+
+    Parameters:
+    `backend` s3control client or LocalBatchBackend
+    `account_id` str
+    `job_id` str
+    `poll_interval` float
+        seconds between two describe_job calls.
+    `timeout` float
+        seconds after which a TimeoutError is raised, defaults to None, no timeout.
+    `verbose` bool
+        if True, the job's status and progress are printed at every poll.
+    '''
+    start = time.monotonic()
+    while True:
+        job = backend.describe_job(AccountId = account_id, JobId = job_id)["Job"]
+        summary = job.get("ProgressSummary", {})
+        if verbose:
+            output(f"Job {job_id}: {job['Status']}, {summary.get('NumberOfTasksSucceeded', 0)} succeeded, "
+                  f"{summary.get('NumberOfTasksFailed', 0)} failed of {summary.get('TotalNumberOfTasks', '?')}")
+        if job["Status"] in TERMINAL_STATUSES:
+            return job
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"Job {job_id} still {job['Status']} after {timeout}s")
+        time.sleep(poll_interval)
+
+@traced
+def read_completion_report(session, job:dict) -> list[dict]:
+    '''
+    Returns the failed tasks of a finished job from its completion report.
+
+    The failure dicts are {"Bucket", "Key", "VersionId", "ErrorCode", "HTTPStatusCode", "ResultMessage"}.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `job` dict
+        the describe_job "Job" dict, e.g. returned by wait_for_job()
+    '''
+    report = job["Report"]
+    assert report.get("Enabled"), f"Job {job['JobId']} has no completion report"
+    s3_client = get_client(session)
+    report_bucket = report["Bucket"].split(":::", 1)[1]
+    prefix = f"{report['Prefix'].rstrip('/')}/job-{job['JobId']}" if report.get("Prefix") else f"job-{job['JobId']}"
+    manifest = json.loads(s3_client.get_object(Bucket = report_bucket, Key = f"{prefix}/manifest.json")["Body"].read())
+    columns = [column.strip() for column in manifest["ReportSchema"].split(",")]
+    failures = []
+    for result in manifest["Results"]:
+        if result["TaskExecutionStatus"] != "failed":
+            continue
+        body = s3_client.get_object(Bucket = result["Bucket"], Key = result["Key"])["Body"]
+        for row in csv.reader(line.decode() for line in body.iter_lines() if line):
+            failure = dict(zip(columns, row))
+            failure["Key"] = parse.unquote(failure["Key"])
+            failure.pop("TaskStatus", None)
+            failures.append(failure)
+    return failures
+
+@traced
+def run_batch_job(session, bucket_name:str, objects, operation:str, report_bucket:str, role_arn:str = None,
+                  tags:dict = None, target_bucket:str = None, target_prefix:str = None, storage_class:str = None,
+                  report_prefix:str = "batch-jobs", account_id:str = None, backend = "auto",
+                  priority:int = 10, poll_interval:float = 30, timeout:float = None,
+                  max_workers:int = 16, verbose:bool = True) -> dict:
+    '''
+    Runs `operation` on `objects` as an S3 Batch Operations job: writes the manifest, submits the job,
+    waits for it and reads the failures back from the completion report.
+
+    Returns {"JobId": str, "Status": str, "Total": int, "Succeeded": int, "Failures": list[dict], "Backend": str}
+    The failure dicts are the ones read_completion_report() returns.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the bucket of the objects
+    `objects` iterable of str or object dicts
+        the keys to process, e.g. the output of s3_get.iter_objects_with_name_date()
+        or s3_get.iter_objects_with_tags_from_bucket() (only the object dicts of its pairs are kept).
+    `operation` str
+        "tag": the tag set of every object is replaced with `tags`.
+        "copy": every object is copied to `target_bucket` under `target_prefix`, with `storage_class` if given.
+        "storage_class": every object is copied onto itself with `storage_class`, `target_bucket` is ignored.
+    `report_bucket` str
+        the bucket the manifest and the completion report are written to
+    `role_arn` str
+        the IAM role Batch Operations assumes, needed unless `backend` is "local".
+    `tags` dict
+        the tags of the "tag" operation, a regular python dictionary.
+    `target_bucket` str
+        the destination bucket of the "copy" operation
+    `target_prefix` str
+        the prefix added to the copied keys, defaults to None, same keys.
+    `storage_class` str
+        the storage class of the copies, see gen_object() for the valid values.
+    `report_prefix` str
+        the prefix of the manifest and the completion report in `report_bucket`.
+    `account_id` str
+        the account running the job, defaults to None, the session's account.
+    `backend` str|LocalBatchBackend
+        "batch": submit to S3 Batch Operations.
+        "local": run the job with a local thread pool through LocalBatchBackend.
+        "auto": submit to Batch Operations and fall back to "local" if the job cannot be created
+        or `role_arn` is None.
+        A LocalBatchBackend (or any object with create_job/describe_job) is used as is.
+    `priority` int
+        the job priority, higher runs first.
+    `poll_interval` float
+        seconds between two job status checks.
+    `timeout` float
+        seconds to wait for the job, defaults to None, no timeout.
+    `max_workers` int
+        the number of tasks running at once with the local backend.
+    `verbose` bool
+        if True, the job's progress is printed.
+    '''
+    assert isinstance(backend, str) and backend in ("auto", "batch", "local") or hasattr(backend, "create_job"), \
+        f"Invalid backend = {backend}"
+    if operation == "copy": target_bucket = target_bucket or bucket_name
+    elif operation == "storage_class": target_bucket = bucket_name #copied onto themselves
+    job_operation = helper_operation(operation, tags, target_bucket, target_prefix, storage_class)
+    if account_id is None:
+        account_id = get_client(session, "sts").get_caller_identity()["Account"]
+    objects = (obj[0] if isinstance(obj, tuple) else obj for obj in objects) #(object, tags) pairs
+    token = str(uuid.uuid4())
+    manifest = write_manifest(session, objects, report_bucket,
+                              f"{report_prefix.rstrip('/')}/manifests/{token}.csv", bucket_name)
+    job_arguments = {
+        "AccountId": account_id, "ConfirmationRequired": False, "Operation": job_operation,
+        "Report": {"Bucket": f"arn:aws:s3:::{report_bucket}", "Format": "Report_CSV_20180820", "Enabled": True,
+                   "Prefix": report_prefix.rstrip("/"), "ReportScope": "AllTasks"},
+        "Manifest": {"Spec": {"Format": "S3BatchOperations_CSV_20180820", "Fields": ["Bucket", "Key"]},
+                     "Location": {"ObjectArn": manifest["ObjectArn"], "ETag": manifest["ETag"].strip('"')}},
+        "Priority": priority, "RoleArn": role_arn or "", "ClientRequestToken": token,
+        "Description": f"{operation} {manifest['Count']} objects of {bucket_name}",
+    }
+
+    if not isinstance(backend, str):
+        used, backend_name = backend, type(backend).__name__
+    elif backend == "local" or backend == "auto" and role_arn is None:
+        used, backend_name = LocalBatchBackend(session, max_workers, verbose), "local"
+    else:
+        assert role_arn is not None, "`role_arn` is needed to submit a Batch Operations job"
+        used, backend_name = get_client(session, "s3control"), "batch"
+    try:
+        job_id = used.create_job(**job_arguments)["JobId"]
+    except (ClientError, BotoCoreError) as err:
+        if backend != "auto":
+            raise
+        if verbose:
+            output(f"Batch Operations unavailable ({err}), running the job locally.")
+        used, backend_name = LocalBatchBackend(session, max_workers, verbose), "local"
+        job_id = used.create_job(**job_arguments)["JobId"]
+
+    job = wait_for_job(used, account_id, job_id, poll_interval, timeout, verbose)
+    summary = job.get("ProgressSummary", {})
+    return {"JobId": job_id, "Status": job["Status"], "Total": summary.get("TotalNumberOfTasks", 0),
+            "Succeeded": summary.get("NumberOfTasksSucceeded", 0),
+            "Failures": read_completion_report(session, job), "Backend": backend_name}
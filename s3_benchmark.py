@@ -0,0 +1,381 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from urllib import parse
+
+import boto3
+
+from s3_client import get_client
+import s3_delete as s3delete
+import s3_generate as s3gen
+import s3_get as s3get
+from s3_metrics import registry
+from s3_parallel import bounded_map
+import s3_set as s3set
+
+# Benchmarks run against moto's in-process S3 stand-in, so no AWS account or network is used.
+# moto answers in microseconds, `latency` adds a sleep before every request to model the
+# network round trip that dominates against real S3.
+#
+# run_suite() fills one bucket per size with tagged keys carrying a small parquet body, then times
+# the public functions against it. Every result has the throughput, the p50/p99 latency of the
+# benchmark's main S3 operation (from s3_metrics) and its peak memory growth, moto's allocations included:
+# sampled resident memory by default, or tracemalloc, exact but ~4x slower. Results are saved as a JSON
+# baseline and later runs are compared to it, e.g.
+#   python s3_benchmark.py --sizes 1000 100000 --save-baseline benchmark_baseline.json
+#   python s3_benchmark.py --sizes 1000 100000 --baseline benchmark_baseline.json
+# The second run exits with status 1 if a benchmark regressed. Filling 1,000,000 keys takes a while
+# and several GB of memory in moto, and moto's listings slow down with the bucket size (every page
+# sorts the whole bucket), so at 100k keys and more "name_date" and "delete_prefix" mostly time moto.
+
+BENCHMARKS = ("tag_fetch", "name_date", "gen_object", "bucket_tag_scan", "lifecycle", "delete_prefix")
+SIZES = (1000, 100000, 1000000)
+TAGS = {"content": "battery-data", "project": "benchmark"}
+
+def helper_mock_session(latency: float = 0.0, region: str = "us-east-1"):
+    '''Returns a boto3 session whose requests sleep `latency` seconds before being sent'''
+    session = boto3.session.Session(aws_access_key_id = "testing",
+                                    aws_secret_access_key = "testing",
+                                    region_name = region)
+    if latency:
+        session.events.register("before-send.s3.*", lambda **kwargs: time.sleep(latency))
+    return session
+
+@contextlib.contextmanager
+def helper_serialized_version_listing():
+    '''
+    Context manager making moto list versions and delete objects one request at a time.
+
+    moto's list_object_versions copies every key of the bucket while the deletes of other threads
+    remove keys from it, which fails the listing (real S3 does not), so the two are serialized.
+    '''
+    from moto.s3.models import S3Backend
+    lock = threading.Lock()
+    originals = dict((name, getattr(S3Backend, name)) for name in ("list_object_versions", "delete_objects"))
+    def serialized(original):
+        def call(*args, **kwargs):
+            with lock:
+                return original(*args, **kwargs)
+        return call
+    for name, original in originals.items():
+        setattr(S3Backend, name, serialized(original))
+    try:
+        yield
+    finally:
+        for name, original in originals.items():
+            setattr(S3Backend, name, original)
+
+def helper_parquet_body(rows: int = 16) -> bytes:
+    '''Returns a small parquet file of battery cycles, the body of the synthetic objects'''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    buffer = io.BytesIO()
+    pq.write_table(pa.table({"cycle": list(range(rows)), "voltage": [3.7] * rows}), buffer)
+    return buffer.getvalue()
+
+def helper_fill_bucket(session, bucket_name: str, n_objects: int, prefix: str = "data/",
+                       tags: dict = None, body: bytes = b"", max_workers: int = 32):
+    '''Creates `bucket_name` holding `n_objects` tagged objects with `body` under `prefix`'''
+    if tags is None:
+        tags = {"content": "battery-data"}
+    get_client(session).create_bucket(Bucket = bucket_name)
+    tag_string = parse.urlencode(tags)
+
+    def put(i):
+        get_client(session).put_object(Bucket = bucket_name, Key = f"{prefix}{i:08d}.parquet",
+                                       Body = body, Tagging = tag_string)
+
+    for _ in bounded_map(put, range(n_objects), max_workers):
+        pass
+
+def helper_rss() -> int|None:
+    '''helper for PeakMemory, the resident memory of the process in bytes, None where /proc is missing'''
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+class PeakMemory:
+    '''
+    Context manager measuring the peak memory growth in bytes while it is open, in `peak` once closed.
+
+    Parameters:
+    `mode` str
+        "rss": the resident memory is sampled every `interval` seconds, cheap but Linux only
+        and blind to memory reused from earlier allocations. `peak` stays None elsewhere.
+        "tracemalloc": every python allocation is traced, exact but several times slower.
+    `interval` float
+        the sampling interval of "rss" in seconds.
+    '''
+    def __init__(self, mode: str = "rss", interval: float = 0.005):
+        assert mode in ("rss", "tracemalloc"), f"Invalid mode = {mode}"
+        self.mode = mode
+        self.interval = interval
+        self.peak = None
+        self._sampler = None
+
+    def sample(self):
+        while not self._stop.wait(self.interval):
+            self._highest = max(self._highest, helper_rss())
+
+    def __enter__(self):
+        if self.mode == "tracemalloc":
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing: tracemalloc.start()
+            tracemalloc.reset_peak()
+            self._start = tracemalloc.get_traced_memory()[0]
+        elif helper_rss() is not None:
+            self._start = self._highest = helper_rss()
+            self._stop = threading.Event()
+            self._sampler = threading.Thread(target = self.sample, daemon = True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.mode == "tracemalloc":
+            self.peak = tracemalloc.get_traced_memory()[1] - self._start
+            if self._tracing: tracemalloc.stop()
+        elif self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self.peak = max(self._highest, helper_rss()) - self._start
+
+def helper_measure(name: str, n_keys: int, operation: str, func, unit: str = "objects", memory: str = "rss") -> dict:
+    '''helper for run_suite(), runs `func` (returning the number of items it handled) and returns its result dict'''
+    registry.reset()
+    start = time.perf_counter()
+    #the functions' own messages would swamp the table
+    with PeakMemory(memory) as peak_memory, contextlib.redirect_stdout(io.StringIO()):
+        items = func()
+    seconds = time.perf_counter() - start
+    peak = peak_memory.peak
+    metrics = registry.snapshot()["operations"].get(operation, {})
+    result = {"benchmark": name, "keys": n_keys, "items": items, "unit": unit, "seconds": seconds,
+              "throughput": items / seconds if seconds else 0.0, "operation": operation,
+              "calls": metrics.get("calls", 0), "p50_ms": metrics.get("p50", 0.0) * 1000,
+              "p99_ms": metrics.get("p99", 0.0) * 1000,
+              "peak_mib": peak / 1024**2 if peak is not None else None}
+    print(f"{name:<16}{n_keys:>9}{items:>9}{result['throughput']:>12.1f} {unit + '/s':<11}"
+          f"{result['p50_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+          f"{'-' if peak is None else format(result['peak_mib'], '.1f'):>10}")
+    return result
+
+def run_suite(sizes: tuple[int] = (1000,), benchmarks: tuple[str] = BENCHMARKS, latency: float = 0.005,
+              max_workers: int = 16, n_buckets: int = 50, n_rules: int = 50, n_generated: int = 1000,
+              memory: str = "rss") -> dict:
+    '''
+    Runs the benchmarks against one synthetic bucket per size and returns {"settings": dict, "results": list[dict]}
+
+    The result dicts are {"benchmark", "keys", "items", "unit", "seconds", "throughput", "operation",
+    "calls", "p50_ms", "p99_ms", "peak_mib"}, p50_ms and p99_ms are the latencies of `operation` calls.
+    Requires moto and pyarrow to be installed.
+
+    Parameters:
+    `sizes` tuple[int]
+        the numbers of keys of the synthetic buckets, e.g. SIZES for 1k, 100k and 1M keys.
+    `benchmarks` tuple[str]
+        the benchmarks to run, a subset of BENCHMARKS. "delete_prefix" empties the bucket so it runs last.
+    `latency` float
+        the simulated round-trip time in seconds added to every S3 request.
+    `max_workers` int
+        the `max_workers` given to the functions that take one.
+    `n_buckets` int
+        the number of tagged buckets scanned by "bucket_tag_scan".
+    `n_rules` int
+        the number of lifecycle rules added one by one by "lifecycle".
+    `n_generated` int
+        the largest number of objects written by "gen_object", at most the size of the bucket.
+    `memory` str
+        how the peak memory is measured, "rss" or "tracemalloc", see PeakMemory.
+    '''
+    from moto import mock_aws
+
+    unknown = set(benchmarks) - set(BENCHMARKS)
+    assert not unknown, f"Invalid benchmarks = {unknown}"
+    settings = {"sizes": list(sizes), "benchmarks": list(benchmarks), "latency": latency, "max_workers": max_workers,
+                "n_buckets": n_buckets, "n_rules": n_rules, "n_generated": n_generated, "memory": memory}
+    body = helper_parquet_body()
+    today = datetime.date.today()
+    results = []
+    print(f"{'benchmark':<16}{'keys':>9}{'items':>9}{'throughput':>12} {'':<11}{'p50 ms':>9}{'p99 ms':>9}{'peak MiB':>10}")
+    for n_keys in sizes:
+        with mock_aws():
+            bucket_name = f"benchmark-{n_keys}"
+            setup_session = helper_mock_session()
+            helper_fill_bucket(setup_session, bucket_name, n_keys, tags = TAGS, body = body)
+            if "bucket_tag_scan" in benchmarks:
+                for i in range(n_buckets):
+                    get_client(setup_session).create_bucket(Bucket = f"{bucket_name}-scan-{i}")
+                    get_client(setup_session).put_bucket_tagging(Bucket = f"{bucket_name}-scan-{i}", Tagging = {
+                        "TagSet": s3gen.gen_tagging_list_from_python_dict(TAGS)})
+            session = helper_mock_session(latency)
+
+            def tag_fetch():
+                found = s3get.get_objects_with_tags_from_bucket(session, bucket_name, {"content": "battery-data"},
+                                                                s3_format = False, max_workers = max_workers)
+                assert len(found) == n_keys
+                return len(found)
+
+            def name_date():
+                found = s3get.get_objects_with_name_date(session, bucket_name, "data/",
+                                                         [today - datetime.timedelta(days = 1), today + datetime.timedelta(days = 1)])
+                assert len(found) == n_keys
+                return len(found)
+
+            def gen_object():
+                count = min(n_keys, n_generated)
+                list(bounded_map(lambda i: s3gen.gen_object(session, bucket_name, f"generated/{i:08d}.parquet", TAGS,
+                                                            source = io.BytesIO(body)),
+                                 range(count), max_workers))
+                return count
+
+            def bucket_tag_scan():
+                found = s3get.get_buckets_with_tags(session, TAGS, s3_format = False)
+                assert len(found) == n_buckets
+                return n_buckets + 1
+
+            def lifecycle():
+                for i in range(n_rules):
+                    s3set.add_bucket_lifecycle(session, f"benchmark-rule-{i}", bucket_name, prefix_filter = f"rule-{i}/")
+                return n_rules
+
+            def delete_prefix():
+                #the streaming path is timed, the listing goes on while the batches are deleted
+                with helper_serialized_version_listing():
+                    result = s3delete.delete_objects__with_prefix(session, bucket_name, "data/",
+                                                                  max_workers = max_workers // 2 or 1, verbose = False)
+                assert result["Deleted"] == n_keys and not result["Errors"]
+                return result["Deleted"]
+
+            runs = {"tag_fetch": (tag_fetch, "s3.GetObjectTagging", "objects"),
+                    "name_date": (name_date, "s3.ListObjectsV2", "objects"),
+                    "gen_object": (gen_object, "s3.PutObject", "objects"),
+                    "bucket_tag_scan": (bucket_tag_scan, "s3.GetBucketTagging", "buckets"),
+                    "lifecycle": (lifecycle, "s3.PutBucketLifecycleConfiguration", "rules"),
+                    "delete_prefix": (delete_prefix, "s3.DeleteObjects", "objects")}
+            for name in BENCHMARKS: #in this order, deleting last
+                if name in benchmarks:
+                    func, operation, unit = runs[name]
+                    results.append(helper_measure(name, n_keys, operation, func, unit, memory))
+    return {"settings": settings, "results": results}
+
+def save_baseline(suite: dict, path: str):
+    '''
+    Writes the run_suite() output to `path` as JSON, the baseline later runs are compared to.
+
+    Parameters:
+    `suite` dict
+        the output of run_suite()
+    `path` str
+        the JSON file to write
+    '''
+    with open(path, "w") as file:
+        json.dump(suite, file, indent = 1)
+
+def compare_to_baseline(suite: dict, path: str, tolerance: float = 0.2) -> list[dict]:
+    '''
+    Returns the regressions of `suite` against the baseline at `path`.
+
+    A benchmark regresses when its throughput drops, or its p99 latency or peak memory grows,
+    by more than `tolerance` relative to the baseline run with the same benchmark and number of keys.
+    The regression dicts are {"benchmark", "keys", "metric", "baseline", "value", "change"}.
+
+    Parameters:
+    `suite` dict
+        the output of run_suite()
+    `path` str
+        the JSON baseline written by save_baseline()
+    `tolerance` float
+        the relative change allowed, e.g. 0.2 for 20%. Peak memory changes under 1 MiB are ignored.
+    '''
+    with open(path) as file:
+        baseline = json.load(file)
+    for setting in ("latency", "max_workers", "memory"):
+        if baseline["settings"].get(setting) != suite["settings"].get(setting):
+            print(f"Warning: the baseline was run with another {setting}, its numbers are not comparable.")
+    previous = dict(((result["benchmark"], result["keys"]), result) for result in baseline["results"])
+    regressions = []
+    for result in suite["results"]:
+        before = previous.get((result["benchmark"], result["keys"]))
+        if before is None: continue
+        for metric, higher_is_better in (("throughput", True), ("p99_ms", False), ("peak_mib", False)):
+            if not before[metric] or result[metric] is None: continue
+            if metric == "peak_mib" and abs(result[metric] - before[metric]) < 1: continue #sampling noise
+            change = result[metric] / before[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append({"benchmark": result["benchmark"], "keys": result["keys"], "metric": metric,
+                                    "baseline": before[metric], "value": result[metric], "change": change})
+    return regressions
+
+def benchmark_tag_fetch(n_objects: int = 1000, workers: tuple[int] = (1, 2, 4, 8, 16, 32),
+                        latency: float = 0.02) -> list[dict]:
+    '''
+    Measures get_objects_with_tags_from_bucket() throughput for each worker count in `workers`.
+
+    Returns a list of dicts {"max_workers", "seconds", "objects_per_second"}, one per worker count.
+    Requires moto to be installed.
+
+    Parameters:
+    `n_objects` int
+        the number of tagged objects in the synthetic bucket.
+    `workers` tuple[int]
+        the `max_workers` values to benchmark.
+    `latency` float
+        the simulated round-trip time in seconds added to every S3 request.
+    '''
+    from moto import mock_aws
+
+    results = []
+    with mock_aws():
+        helper_fill_bucket(helper_mock_session(), "benchmark-tags", n_objects)
+        session = helper_mock_session(latency)
+        for max_workers in workers:
+            start = time.perf_counter()
+            found = s3get.get_objects_with_tags_from_bucket(session, "benchmark-tags",
+                                                            {"content": "battery-data"},
+                                                            s3_format = False,
+                                                            max_workers = max_workers)
+            seconds = time.perf_counter() - start
+            assert len(found) == n_objects
+            results.append({"max_workers": max_workers,
+                            "seconds": seconds,
+                            "objects_per_second": n_objects / seconds})
+            print(f"max_workers={max_workers:<4}{seconds:>8.2f}s{n_objects / seconds:>10.1f} objects/s")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmarks the S3 functions against moto's S3 stand-in.")
+    parser.add_argument("--sizes", type = int, nargs = "+", default = [1000],
+                        help = f"numbers of keys of the synthetic buckets, e.g. {' '.join(map(str, SIZES))}")
+    parser.add_argument("--benchmarks", nargs = "+", default = list(BENCHMARKS), choices = BENCHMARKS)
+    parser.add_argument("--latency", type = float, default = 0.005, help = "simulated round trip in seconds")
+    parser.add_argument("--max-workers", type = int, default = 16)
+    parser.add_argument("--memory", default = "rss", choices = ("rss", "tracemalloc"), help = "peak memory measurement")
+    parser.add_argument("--save-baseline", metavar = "PATH", help = "write the results as the new baseline")
+    parser.add_argument("--baseline", metavar = "PATH", help = "compare the results to this baseline")
+    parser.add_argument("--tolerance", type = float, default = 0.2, help = "relative change counted as a regression")
+    parser.add_argument("--worker-sweep", action = "store_true", help = "only run benchmark_tag_fetch()")
+    arguments = parser.parse_args()
+    if arguments.worker_sweep:
+        benchmark_tag_fetch()
+        sys.exit(0)
+    suite = run_suite(tuple(arguments.sizes), tuple(arguments.benchmarks), arguments.latency, arguments.max_workers,
+                      memory = arguments.memory)
+    if arguments.baseline and os.path.exists(arguments.baseline):
+        regressions = compare_to_baseline(suite, arguments.baseline, arguments.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression['benchmark']} ({regression['keys']} keys) {regression['metric']}: "
+                  f"{regression['baseline']:.2f} -> {regression['value']:.2f} ({regression['change']:+.0%})")
+        if not regressions: print("No regression against the baseline.")
+    if arguments.save_baseline:
+        save_baseline(suite, arguments.save_baseline)
+    if arguments.baseline and os.path.exists(arguments.baseline) and regressions:
+        sys.exit(1)
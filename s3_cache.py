@@ -0,0 +1,242 @@
+from collections import OrderedDict
+from concurrent.futures import Future
+import contextlib
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+
+from s3_client import get_client
+from s3_get import download_object, MiB
+from s3_index import default_cache_dir
+from s3_metrics import traced
+
+# Training loops read the same objects every epoch. ObjectCache keeps them on local disk, one file per
+# bucket/key/ETag at <cache dir>/objects/<sha256 of bucket/key>/<ETag>, so a replaced object is a new
+# entry and the stale one is dropped. Files are written to a temporary name and renamed when complete,
+# several processes can share a cache directory. Entries are evicted least recently used first once
+# the cache holds more than `max_bytes`; the order survives restarts through the files' mtime.
+# Reads of an entry being downloaded wait for that download instead of starting their own.
+# An evicted file can still be read through the memory maps already returned, Linux frees it when they are closed.
+# Between fetching a path and opening it the entry is pinned, pinned entries are skipped by eviction.
+
+class ObjectCache:
+    '''
+    Thread-safe read-through on-disk cache of S3 objects with LRU eviction, the objects are read as memory maps.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `cache_dir` str
+        the cache directory, defaults to None, which is "objects" in s3_index.default_cache_dir().
+    `max_bytes` int
+        the size budget of the cache, the least recently used entries are deleted to stay under it.
+        The entry just read is never evicted, even if it is larger than the budget on its own.
+    `part_size` int
+    `max_workers` int
+        the range size and the number of concurrent range GETs of a download, see s3_get.download_object().
+    '''
+    def __init__(self, session, cache_dir: str = None, max_bytes: int = 10 * 1024**3,
+                 part_size: int = 8 * MiB, max_workers: int = 8):
+        assert max_bytes > 0, f"Invalid max_bytes = {max_bytes}"
+        self.session = session
+        self.cache_dir = cache_dir or os.path.join(default_cache_dir(), "objects")
+        self.max_bytes = max_bytes
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self._lock = threading.Lock()
+        self._downloads = {} #path: Future of the download in progress
+        self._pins = {} #path: number of callers about to open the entry
+        self.entries = OrderedDict() #path: size, least recently used first
+        self.size = 0
+        self.stats = {"Hits": 0, "Misses": 0, "Collapsed": 0, "Evicted": 0, "DownloadedBytes": 0}
+        os.makedirs(self.cache_dir, exist_ok = True)
+        found = []
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir(): continue
+            for file in os.scandir(folder.path):
+                if ".tmp-" in file.name: #left by an interrupted download
+                    os.remove(file.path)
+                    continue
+                status = file.stat()
+                found.append((status.st_mtime, file.path, status.st_size))
+        for _, path, size in sorted(found):
+            self.entries[path] = size
+            self.size += size
+
+    def helper_folder(self, bucket_name: str, object_name: str) -> str:
+        '''helper for the cache methods, the directory holding the entries of an object'''
+        return os.path.join(self.cache_dir, hashlib.sha256(f"{bucket_name}/{object_name}".encode()).hexdigest())
+
+    def helper_cached_paths(self, folder: str) -> list[str]:
+        '''helper for the cache methods, the complete entries of an object's `folder`, most recently used last'''
+        if not os.path.isdir(folder): return []
+        paths = [os.path.join(folder, name) for name in os.listdir(folder) if ".tmp-" not in name]
+        return sorted(paths, key = lambda path: os.stat(path).st_mtime)
+
+    def helper_evict(self, keep: str):
+        '''helper for fetch(), deletes the least recently used entries but `keep` until the cache fits its budget (lock held)'''
+        for path in list(self.entries):
+            if self.size <= self.max_bytes: return
+            if path == keep or path in self._downloads or path in self._pins: continue
+            self.helper_remove(path)
+            self.stats["Evicted"] += 1
+
+    def helper_pin(self, path: str):
+        '''helper for helper_fetch(), keeps the entry at `path` from being evicted until helper_unpin() (lock held)'''
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def helper_unpin(self, path: str):
+        '''helper for the cache methods, releases a pin of helper_pin() and evicts what it kept over the budget'''
+        with self._lock:
+            self._pins[path] -= 1
+            if not self._pins[path]:
+                del self._pins[path]
+            self.helper_evict(path) #the entry just read is kept
+
+    def helper_remove(self, path: str):
+        '''helper for the cache methods, deletes the entry at `path` (lock held)'''
+        self.size -= self.entries.pop(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError: #removed by another process sharing the directory
+            pass
+
+    def helper_download(self, bucket_name: str, object_name: str, etag: str, path: str):
+        '''helper for fetch(), downloads the object at `path` through a temporary file'''
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        temporary = f"{path}.tmp-{uuid.uuid4().hex}"
+        try:
+            download_object(self.session, bucket_name, object_name, temporary, self.part_size,
+                            self.max_workers, verbose = False, etag = etag)
+            os.replace(temporary, path)
+        finally:
+            if os.path.exists(temporary): os.remove(temporary)
+
+    def helper_fetch(self, bucket_name: str, object_name: str, etag: str, validate: bool) -> str:
+        '''helper for fetch() and pinned(), returns the path of the cached copy pinned with helper_pin()'''
+        folder = self.helper_folder(bucket_name, object_name)
+        if etag is None and not validate:
+            with self._lock:
+                cached = self.helper_cached_paths(folder)
+            if cached:
+                etag = os.path.basename(cached[-1])
+        if etag is None:
+            etag = get_client(self.session).head_object(Bucket = bucket_name, Key = object_name)["ETag"]
+        etag = etag.strip('"')
+        path = os.path.join(folder, etag)
+        with self._lock:
+            if os.path.exists(path):
+                if path not in self.entries: #downloaded by another process sharing the directory
+                    self.entries[path] = os.path.getsize(path)
+                    self.size += self.entries[path]
+                self.entries.move_to_end(path)
+                self.stats["Hits"] += 1
+                os.utime(path) #keeps the LRU order for the next process
+                self.helper_pin(path)
+                return path
+            download = self._downloads.get(path)
+            leader = download is None
+            if leader:
+                download = self._downloads[path] = Future()
+                self.stats["Misses"] += 1
+            else:
+                self.stats["Collapsed"] += 1
+            #pinned before the lock is released, so the leader's entry is not evicted before the waiters open it
+            self.helper_pin(path)
+        if not leader:
+            try:
+                download.result() #raises the leader's error
+            except BaseException:
+                self.helper_unpin(path)
+                raise
+            return path
+
+        try:
+            self.helper_download(bucket_name, object_name, f'"{etag}"', path)
+        except BaseException as err:
+            with self._lock:
+                del self._downloads[path]
+            self.helper_unpin(path)
+            download.set_exception(err)
+            raise
+        with self._lock:
+            if path in self.entries: #was cached but its file had been removed
+                self.size -= self.entries.pop(path)
+            for stale in self.helper_cached_paths(folder):
+                if stale != path and stale in self.entries and stale not in self._pins:
+                    self.helper_remove(stale) #older content of the same object
+            size = os.path.getsize(path)
+            self.entries[path] = size
+            self.size += size
+            self.stats["DownloadedBytes"] += size
+            self.helper_evict(path)
+            del self._downloads[path]
+        download.set_result(path)
+        return path
+
+    @traced
+    def fetch(self, bucket_name: str, object_name: str, etag: str = None, validate: bool = True) -> str:
+        '''
+        Returns the path of the cached copy of an object, downloaded first if it is not cached.
+
+        Concurrent calls for the same object and ETag make a single download, the others wait for it.
+        Later fetches of other objects can evict the copy, use pinned() to keep it while opening it.
+
+        Parameters:
+        `bucket_name` str
+        `object_name` str
+        `etag` str
+            the ETag of the wanted content, e.g. from a listing, no request is made if it is cached.
+            defaults to None, the current ETag is asked with head_object, see `validate`.
+        `validate` bool
+            if False and `etag` is None, the most recently used cached copy of the object is returned
+            without asking S3, so epochs after the first run offline. Objects not cached are still downloaded.
+        '''
+        path = self.helper_fetch(bucket_name, object_name, etag, validate)
+        self.helper_unpin(path)
+        return path
+
+    @contextlib.contextmanager
+    def pinned(self, bucket_name: str, object_name: str, etag: str = None, validate: bool = True):
+        '''
+        Context manager yielding the path of the cached copy of an object, which is not evicted until the block exits.
+
+        Parameters:
+        see fetch()
+        '''
+        path = self.helper_fetch(bucket_name, object_name, etag, validate)
+        try:
+            yield path
+        finally:
+            self.helper_unpin(path)
+
+    def get(self, bucket_name: str, object_name: str, etag: str = None, validate: bool = True) -> mmap.mmap|bytes:
+        '''
+        Returns the content of an object as a read-only memory map of its cached copy, see fetch().
+
+        The map can be handed to pyarrow without copying, e.g. pq.read_table(pa.BufferReader(buffer)),
+        and can be closed once nothing uses it anymore. pyarrow can also map the cached file itself:
+        pq.read_table(cache.fetch(bucket_name, object_name), memory_map = True).
+        Empty objects are returned as b"", they cannot be mapped.
+
+        Parameters:
+        see fetch()
+        '''
+        with self.pinned(bucket_name, object_name, etag, validate) as path, open(path, "rb") as file:
+            if not os.fstat(file.fileno()).st_size:
+                return b""
+            return mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+
+    def forget(self, bucket_name: str, object_name: str):
+        '''Deletes every cached copy of an object'''
+        folder = self.helper_folder(bucket_name, object_name)
+        with self._lock:
+            for path in self.helper_cached_paths(folder):
+                if path in self.entries: self.helper_remove(path)
+
+    def clear(self):
+        '''Deletes every cached copy, downloads in progress and pinned copies are kept'''
+        with self._lock:
+            for path in [path for path in self.entries if path not in self._downloads and path not in self._pins]:
+                self.helper_remove(path)
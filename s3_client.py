@@ -0,0 +1,122 @@
+from botocore.config import Config
+import threading
+import weakref
+
+from s3_metrics import instrument_client
+
+# Shared pool of boto3 clients and resources used by every module instead of session.client("s3").
+# Building a client costs tens of milliseconds and each one holds its own connection pool, so each
+# (session, service, region) gets one client, made on first use and shared by every thread afterwards:
+# clients are thread-safe, and the short-lived worker threads of s3_parallel.bounded_map() reuse the
+# same pool of connections call after call. Sessions and resources are not thread-safe, hence the
+# per-thread cache of resources and the lock around session.client()/session.resource().
+# The caches hold their sessions weakly: the clients of a session are dropped when it is collected.
+
+_settings = {
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "max_attempts": 5,
+    "retry_mode": "standard",
+    "connect_timeout": 10,
+    "read_timeout": 60,
+}
+_generation = 0 #bumped by configure_clients() so clients made with old settings are rebuilt
+_session_lock = threading.Lock()
+_clients = weakref.WeakKeyDictionary() #session: {(service, region): (generation, client)}, shared by all threads
+_thread_cache = threading.local()
+
+def configure_clients(max_pool_connections: int = None, tcp_keepalive: bool = None,
+                      max_attempts: int = None, retry_mode: str = None,
+                      connect_timeout: float = None, read_timeout: float = None) -> dict:
+    '''
+    Changes the settings of the clients made by get_client() and get_resource() and returns them.
+
+    Only the given arguments change, clients already made are replaced on their next use.
+
+    Parameters:
+    `max_pool_connections` int
+        the number of HTTP connections each client keeps open, at least the number of threads sharing it.
+    `tcp_keepalive` bool
+        if True, TCP keep-alive probes keep idle pooled connections open.
+    `max_attempts` int
+        the number of attempts of a request, including the first one.
+    `retry_mode` str
+        "legacy", "standard" or "adaptive", see the botocore retry documentation.
+        "adaptive" adds client-side rate limiting when S3 throttles.
+    `connect_timeout` float
+        seconds to wait for a connection.
+    `read_timeout` float
+        seconds to wait for a response.
+    '''
+    global _generation
+    assert retry_mode in (None, "legacy", "standard", "adaptive"), f"Invalid retry_mode = {retry_mode}"
+    arguments = {"max_pool_connections": max_pool_connections, "tcp_keepalive": tcp_keepalive,
+                 "max_attempts": max_attempts, "retry_mode": retry_mode,
+                 "connect_timeout": connect_timeout, "read_timeout": read_timeout}
+    with _session_lock:
+        _settings.update((key, val) for key, val in arguments.items() if val is not None)
+        _generation += 1
+    return dict(_settings)
+
+def config_arguments() -> dict:
+    '''Returns the current settings as botocore Config keyword arguments, also used by s3_async'''
+    return {
+        "max_pool_connections": _settings["max_pool_connections"],
+        "tcp_keepalive": _settings["tcp_keepalive"],
+        "retries": {"max_attempts": _settings["max_attempts"], "mode": _settings["retry_mode"]},
+        "connect_timeout": _settings["connect_timeout"],
+        "read_timeout": _settings["read_timeout"],
+    }
+
+def client_config() -> Config:
+    '''Returns the botocore Config built from the current settings'''
+    return Config(**config_arguments())
+
+def helper_cached(session, kind: str, service_name: str, region_name: str|None):
+    '''helper for get_client() and get_resource(), returns the shared client or the calling thread's resource'''
+    if kind == "client":
+        sessions = _clients
+    else:
+        sessions = getattr(_thread_cache, "sessions", None)
+        if sessions is None:
+            sessions = _thread_cache.sessions = weakref.WeakKeyDictionary()
+    key = (service_name, region_name)
+    cached = sessions.get(session, {}).get(key)
+    if cached is None or cached[0] != _generation:
+        with _session_lock:
+            cache = sessions.setdefault(session, {})
+            cached = cache.get(key) #another thread may have made the client meanwhile
+            if cached is None or cached[0] != _generation:
+                make = session.client if kind == "client" else session.resource
+                arguments = {"region_name": region_name} if region_name else {}
+                made = make(service_name, config = client_config(), **arguments)
+                #every call is recorded by s3_metrics, resources through their client
+                instrument_client(made if kind == "client" else made.meta.client)
+                cached = cache[key] = (_generation, made)
+    return cached[1]
+
+def get_client(session, service_name: str = "s3", region_name: str = None):
+    '''
+    Returns the pooled `service_name` client of `session`, shared by all threads.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `service_name` str
+        the boto3 service name, defaults to "s3"
+    `region_name` str
+        the client's region, defaults to None, the session's region.
+    '''
+    return helper_cached(session, "client", service_name, region_name)
+
+def get_resource(session, service_name: str = "s3", region_name: str = None):
+    '''
+    Returns the pooled `service_name` resource of `session` for the calling thread.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `service_name` str
+        the boto3 service name, defaults to "s3"
+    `region_name` str
+        the resource's region, defaults to None, the session's region.
+    '''
+    return helper_cached(session, "resource", service_name, region_name)
@@ -0,0 +1,191 @@
+from botocore.exceptions import ClientError
+import datetime
+import hashlib
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+# pyarrow must be installed to compact parquet objects
+
+from s3_client import get_client
+from s3_delete import delete_keys
+from s3_generate import upload_object, MiB
+from s3_get import iter_objects
+from s3_metrics import traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_sync import helper_etag_is_md5, helper_local_etag
+from s3_throttle import get_limiter
+
+# Compaction merges the small objects of a time partition into files of about `target_size`.
+# A merged file is written to a local temporary file while its sources are downloaded (a few at a time),
+# uploaded, then checked against S3: same size, and same ETag as the local file unless the bucket encrypts
+# with SSE-KMS or SSE-C (their ETags are not MD5s). Only then are its sources deleted, on condition of the
+# ETag they were read with, so a failure at any step, or a source rewritten meanwhile, leaves the originals in place.
+
+PARTITION_FORMATS = {"hour": "%Y-%m-%d-%H", "day": "%Y-%m-%d", "month": "%Y-%m"}
+PART_SIZE = 8 * MiB #multipart part size of the merged files, also used to compute their expected ETag
+
+def helper_compaction_groups(objects: list[dict], partition: str, target_size: int) -> list[tuple[str, list[dict]]]:
+    '''helper for compact_prefix(), the (partition, objects) groups of at most `target_size` bytes each'''
+    partitions = {}
+    for obj in objects:
+        name = obj["LastModified"].strftime(PARTITION_FORMATS[partition]) if partition else "all"
+        partitions.setdefault(name, []).append(obj)
+    groups = []
+    for name, partition_objects in sorted(partitions.items()):
+        group, group_size = [], 0
+        for obj in sorted(partition_objects, key = lambda obj: obj["Key"]):
+            if group and group_size + obj["Size"] > target_size:
+                groups.append((name, group))
+                group, group_size = [], 0
+            group.append(obj)
+            group_size += obj["Size"]
+        groups.append((name, group))
+    return [(name, group) for name, group in groups if len(group) > 1] #a lone object is not worth rewriting
+
+def helper_merge_text(bodies, file) -> int:
+    '''helper for compact_prefix(), appends the text `bodies` to `file` and returns the number of lines'''
+    lines = 0
+    for body in bodies:
+        if body and not body.endswith(b"\n"): body += b"\n" #keeps the last record of an object on its own line
+        file.write(body)
+        lines += body.count(b"\n")
+    return lines
+
+def helper_merge_parquet(bodies, path: str, row_group_size: int) -> int:
+    '''helper for compact_prefix(), writes the parquet `bodies` as one file at `path` and returns the number of rows'''
+    writer = None
+    pending, pending_size, rows = [], 0, 0
+    try:
+        for body in bodies:
+            table = pq.read_table(pa.BufferReader(body))
+            if writer is None:
+                writer = pq.ParquetWriter(path, table.schema, compression = "zstd")
+            pending.append(table.cast(writer.schema)) #raises if an object has another schema
+            pending_size += table.nbytes
+            rows += table.num_rows
+            if pending_size >= row_group_size: #small inputs are regrouped into large row groups
+                writer.write_table(pa.concat_tables(pending))
+                pending, pending_size = [], 0
+        if pending:
+            writer.write_table(pa.concat_tables(pending))
+    finally:
+        if writer is not None: writer.close()
+    return rows
+
+@traced
+def compact_prefix(session, bucket_name: str, prefix: str, output_prefix: str = None,
+                   target_size: int = 128 * MiB, small_size: int = 16 * MiB, partition: str|None = "day",
+                   file_format: str = "auto", min_age_hours: float = 1, delete_originals: bool = True,
+                   max_workers: int = 16, row_group_size: int = 64 * MiB, dry_run: bool = False,
+                   verbose: bool = True) -> dict:
+    '''
+    Merges the small objects under `prefix` into larger files, one set of files per time partition.
+
+    Returns {"Merged": number of source objects, "Written": list of keys, "Deleted": int, "Errors": list[dict], "DryRun": bool}
+    The error dicts are {"Keys": source keys of the group, "Error": error message}, a failed group keeps its sources.
+
+    Objects smaller than `small_size` and older than `min_age_hours` are grouped by the partition of
+    their LastModified time, then by key order into files of at most `target_size` bytes, written at
+    `output_prefix`<partition>/<group id>.<extension>. Text objects (e.g. server access logs) are
+    concatenated line by line, parquet objects are rewritten as one parquet file with large row groups.
+    At most `2 * max_workers` source objects are held in memory, the merged file is written to a temporary file.
+    The sources of a merged file are deleted with delete_keys() only after its size and ETag in S3 match
+    the local file (size only in SSE-KMS and SSE-C buckets), and only if their ETag is still the one they
+    were read with: a source rewritten meanwhile is kept. Lifecycle rules then apply to far fewer objects.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the bucket name, e.g. the logging bucket
+    `prefix` str
+        the prefix of the objects to compact, e.g. "melon_bucket/"
+    `output_prefix` str
+        the prefix of the merged files, defaults to None, which is "compacted/" + `prefix`:
+        a sibling root outside `prefix`, so readers of `prefix` such as s3_logs.ingest_access_logs()
+        never see the merged files as new objects. An `output_prefix` inside `prefix` works too,
+        objects under it are never compacted again, but every other reader of `prefix` must skip it.
+    `target_size` int
+        the largest size in bytes of the sources of one merged file.
+    `small_size` int
+        objects of at least `small_size` bytes are left alone.
+    `partition` str|None
+        "hour", "day" or "month": objects of different partitions are never merged together.
+        None merges regardless of time.
+    `file_format` str
+        "text", "parquet", or "auto": parquet for keys ending in ".parquet", text otherwise.
+    `min_age_hours` float
+        objects modified more recently are left for a later run, their partition may still be growing.
+    `delete_originals` bool
+        if True, the sources of every verified merged file are deleted.
+    `max_workers` int
+        the number of source objects downloaded at once.
+    `row_group_size` int
+        the in-memory size in bytes of the row groups of merged parquet files.
+    `dry_run` bool
+        if True, nothing is written or deleted, "Written" lists the files that would be written.
+    `verbose` bool
+        if True, the progress and throughput are printed while compacting.
+    '''
+    assert partition is None or partition in PARTITION_FORMATS, f"Invalid partition = {partition}"
+    assert file_format in ("auto", "text", "parquet"), f"Invalid file_format = {file_format}"
+    if output_prefix is None: output_prefix = "compacted/" + prefix
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours = min_age_hours)
+    candidates = {"text": [], "parquet": []}
+    for obj in iter_objects(session, bucket_name, prefix):
+        if obj["Key"].startswith(output_prefix) or obj["Size"] >= small_size or obj["LastModified"] > cutoff:
+            continue
+        kind = file_format if file_format != "auto" else "parquet" if obj["Key"].endswith(".parquet") else "text"
+        candidates[kind].append(obj)
+
+    groups = [(kind, name, group) for kind, objects in candidates.items()
+              for name, group in helper_compaction_groups(objects, partition, target_size)]
+    result = {"Merged": 0, "Written": [], "Deleted": 0, "Errors": [], "DryRun": dry_run}
+    progress = ProgressCounter(f"Compacted {bucket_name}/{prefix}", sum(len(group) for *_, group in groups),
+                               unit = "objects", verbose = verbose)
+
+    def download(obj):
+        #IfMatch fails the download if the object was replaced since it was listed
+        body = get_limiter().call(bucket_name, obj["Key"], lambda: get_client(session).get_object(
+            Bucket = bucket_name, Key = obj["Key"], IfMatch = obj["ETag"])["Body"].read())
+        progress.add()
+        return body
+
+    for kind, name, group in groups:
+        group_id = hashlib.sha256("\n".join(obj["Key"] for obj in group).encode()).hexdigest()[:16]
+        key = f"{output_prefix}{name}/{group_id}.{'parquet' if kind == 'parquet' else 'log'}"
+        if dry_run:
+            result["Written"].append(key)
+            result["Merged"] += len(group)
+            continue
+        handle, path = tempfile.mkstemp(suffix = "." + kind)
+        try:
+            bodies = bounded_map(download, group, max_workers)
+            if kind == "parquet":
+                os.close(handle)
+                helper_merge_parquet(bodies, path, row_group_size)
+            else:
+                with os.fdopen(handle, "wb") as file:
+                    helper_merge_text(bodies, file)
+            size = os.path.getsize(path)
+            upload_object(session, bucket_name, key, path, part_size = PART_SIZE, verbose = False)
+            head = get_client(session).head_object(Bucket = bucket_name, Key = key)
+            if head["ContentLength"] != size or (helper_etag_is_md5(head)
+                                                 and head["ETag"] != helper_local_etag(path, size, PART_SIZE)):
+                raise ValueError(f"{key} does not match the merged file, sources kept")
+        except (ClientError, OSError, ValueError, pa.ArrowException) as err:
+            result["Errors"].append({"Keys": [obj["Key"] for obj in group], "Error": str(err)})
+            continue
+        finally:
+            if os.path.exists(path): os.remove(path)
+        result["Written"].append(key)
+        result["Merged"] += len(group)
+        if delete_originals:
+            deleted = delete_keys(session, bucket_name, ({"Key": obj["Key"], "ETag": obj["ETag"]} for obj in group),
+                                  verbose = False, if_match = True)
+            result["Deleted"] += deleted["Deleted"]
+            result["Errors"].extend({"Keys": [error["Key"]], "Error": error.get("Message", error.get("Code"))}
+                                    for error in deleted["Errors"])
+    progress.close()
+    return result
@@ -0,0 +1,226 @@
+from botocore.exceptions import ClientError
+import hashlib
+
+from s3_client import get_client
+from s3_delete import delete_keys
+from s3_generate import gen_python_dict_from_tagging_list, helper_put_arguments, MIN_PART_SIZE, MAX_PARTS, MiB
+from s3_get import iter_objects
+from s3_metrics import traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_sync import helper_etag_is_md5
+from s3_throttle import get_limiter
+
+# Copies run server-side: CopyObject for objects up to 5 GiB, a multipart upload whose parts are
+# UploadPartCopy byte ranges of the source for larger ones, so no data goes through this machine.
+# Every request names the source ETag (CopySourceIfMatch), a source replaced since it was listed fails
+# its copy instead of copying the new content. A copy is verified against its source (size, and ETag
+# whenever S3's ETag of the copy can be predicted) before a move deletes the source. A move deletes
+# the version it copied, or in an unversioned bucket deletes on condition of the copied ETag,
+# so a source overwritten after its copy is kept.
+
+MAX_COPY_SIZE = 5 * 1024**3 #CopyObject and UploadPartCopy copy at most 5 GiB per request
+
+def helper_copy_etag(source_etag: str, part_etags: list[str], head: dict) -> str|None:
+    '''helper for copy_object(), the ETag S3 gives the copy of the source described by `head`, None if it cannot be predicted'''
+    if not helper_etag_is_md5(head): #encrypted with SSE-KMS or SSE-C, the ETags are not MD5s
+        return None
+    if part_etags:
+        digests = b"".join(bytes.fromhex(etag.strip('"')) for etag in part_etags)
+        return f'"{hashlib.md5(digests).hexdigest()}-{len(part_etags)}"'
+    #CopyObject of a single part object keeps its MD5, a multipart source gets a new ETag
+    return source_etag if "-" not in source_etag else None
+
+def helper_multipart_copy(session, copy_source: dict, bucket_name: str, key: str, size: int, etag: str,
+                          part_size: int, max_workers: int, put_arguments: dict, head: dict) -> list[str]:
+    '''helper for copy_object(), copies `copy_source` in parallel UploadPartCopy ranges and returns the part ETags'''
+    s3_client = get_client(session)
+    part_size = max(part_size, -(-size // MAX_PARTS))
+    arguments = dict((name, head[name]) for name in ("ContentType", "ContentEncoding", "ContentDisposition",
+                                                     "ContentLanguage", "CacheControl", "Metadata") if head.get(name))
+    upload_id = s3_client.create_multipart_upload(Bucket = bucket_name, Key = key,
+                                                  **arguments, **put_arguments)["UploadId"]
+
+    def copy_part(numbered_start):
+        part_number, start = numbered_start
+        response = get_limiter().call(bucket_name, key, lambda: get_client(session).upload_part_copy(
+            Bucket = bucket_name, Key = key, UploadId = upload_id, PartNumber = part_number,
+            CopySource = copy_source, CopySourceIfMatch = etag,
+            CopySourceRange = f"bytes={start}-{min(start + part_size, size) - 1}"))
+        return {"ETag": response["CopyPartResult"]["ETag"], "PartNumber": part_number}
+
+    try:
+        completed = list(bounded_map(copy_part, enumerate(range(0, size, part_size), start = 1), max_workers))
+        s3_client.complete_multipart_upload(Bucket = bucket_name, Key = key, UploadId = upload_id,
+                                            MultipartUpload = {"Parts": completed})
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket = bucket_name, Key = key, UploadId = upload_id)
+        raise
+    return [part["ETag"] for part in completed]
+
+@traced
+def copy_object(session, source_bucket_name: str, source_key: str, bucket_name: str, key: str,
+                tags: dict = None, storage_class: str = None, multipart_threshold: int = MAX_COPY_SIZE,
+                part_size: int = 256 * MiB, max_workers: int = 8, verify: bool = True) -> dict:
+    '''
+    Copies an S3 object server-side, with parallel UploadPartCopy parts above `multipart_threshold` bytes.
+
+    Returns {"Key": `key`, "Size": int, "ETag": ETag of the copy, "Verified": bool,
+             "SourceETag": ETag of the copied source, "SourceVersionId": its version id, None if unversioned}
+
+    Tags, storage class, content type and user metadata of the source are kept unless replaced.
+    Raises ValueError if `verify` is True and the copy does not match its source.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `source_bucket_name` str
+    `source_key` str
+        the object to copy
+    `bucket_name` str
+    `key` str
+        the copy, can be in the same bucket
+    `tags` dict
+        the tags of the copy, a regular python dictionary like in s3_generate.gen_object().
+        defaults to None, the source's tags.
+    `storage_class` str
+        the storage class of the copy, see s3_generate.gen_object() for the valid values.
+        defaults to None, the source's storage class.
+    `multipart_threshold` int
+        objects larger than this are copied in parts, at most 5 GiB, the CopyObject limit.
+    `part_size` int
+        the size in bytes of the copied parts, at least 5 MiB and at most 5 GiB.
+    `max_workers` int
+        the number of parts copied at once.
+    `verify` bool
+        if True, the copy's size (and ETag when predictable, not for SSE-KMS or SSE-C) is checked against the source.
+    '''
+    assert MIN_PART_SIZE <= part_size <= MAX_COPY_SIZE, f"Invalid part_size = {part_size}"
+    assert multipart_threshold <= MAX_COPY_SIZE, f"multipart_threshold must be at most {MAX_COPY_SIZE} bytes"
+    s3_client = get_client(session)
+    head = s3_client.head_object(Bucket = source_bucket_name, Key = source_key)
+    size, etag = head["ContentLength"], head["ETag"]
+    #head_object leaves out the STANDARD storage class, and CopyObject would store the copy as STANDARD
+    storage_class = storage_class or head.get("StorageClass", "STANDARD")
+    copy_source = {"Bucket": source_bucket_name, "Key": source_key}
+
+    part_etags = []
+    if size > multipart_threshold:
+        if tags is None: #UploadPartCopy does not copy tags
+            tags = gen_python_dict_from_tagging_list(s3_client.get_object_tagging(
+                Bucket = source_bucket_name, Key = source_key)["TagSet"])
+        part_etags = helper_multipart_copy(session, copy_source, bucket_name, key, size, etag, part_size,
+                                           max_workers, helper_put_arguments(tags, storage_class), head)
+    else:
+        arguments = helper_put_arguments(tags, storage_class)
+        if tags is not None:
+            arguments["TaggingDirective"] = "REPLACE"
+            arguments.setdefault("Tagging", "") #an empty dict removes the tags
+        get_limiter().call(bucket_name, key, lambda: get_client(session).copy_object(
+            Bucket = bucket_name, Key = key, CopySource = copy_source, CopySourceIfMatch = etag, **arguments))
+
+    #"null" is the version id of objects written while versioning was off
+    version_id = head.get("VersionId") if head.get("VersionId") != "null" else None
+    result = {"Key": key, "Size": size, "ETag": None, "Verified": False, "SourceETag": etag, "SourceVersionId": version_id}
+    if verify:
+        copy_head = s3_client.head_object(Bucket = bucket_name, Key = key)
+        expected = helper_copy_etag(etag, part_etags, head)
+        if copy_head["ContentLength"] != size or expected is not None and copy_head["ETag"] != expected:
+            raise ValueError(f"{bucket_name}/{key} does not match its source {source_bucket_name}/{source_key}")
+        result["ETag"], result["Verified"] = copy_head["ETag"], True
+    return result
+
+@traced
+def copy_objects(session, source_bucket_name: str, prefix: str, bucket_name: str, destination_prefix: str,
+                 objects = None, tags: dict = None, storage_class: str = None, move: bool = False,
+                 multipart_threshold: int = MAX_COPY_SIZE, part_size: int = 256 * MiB, max_workers: int = 16,
+                 part_workers: int = 4, dry_run: bool = False, verbose: bool = True) -> dict:
+    '''
+    Copies or moves the objects under `prefix` to `destination_prefix`, server-side and concurrently.
+
+    Returns {"Copied": list of destination keys, "Bytes": int, "Deleted": number of sources deleted,
+             "Errors": list of dicts, "DryRun": bool}
+    The error dicts are {"Key": source key, "Error": error message}, a failed object does not stop the others.
+
+    A source key <prefix><rest> is copied to <destination_prefix><rest> with copy_object().
+    With `move`, the sources are deleted with delete_keys() in batches of 1,000 while the copies go on,
+    each source only once its copy has been verified, failed copies keep their source.
+    Only the copied content is deleted: in a versioned bucket the copied version is deleted for good,
+    otherwise the delete is conditional on the copied ETag. A source overwritten after its copy is kept
+    and reported in "Errors".
+
+    Parameters:
+    `session` boto3.session.Session()
+    `source_bucket_name` str
+    `prefix` str
+        the prefix of the objects to copy, e.g. "raw/test-bench/"
+    `bucket_name` str
+        the destination bucket, can be `source_bucket_name`.
+    `destination_prefix` str
+        the prefix replacing `prefix` in the copies' keys, e.g. "processed/test-bench/"
+    `objects` iterable of dict
+        listed object dicts under `prefix` to copy instead of all of them,
+        e.g. from s3_get.iter_objects_with_name_date(). defaults to None, every object under `prefix`.
+    `tags` dict
+    `storage_class` str
+        the tags and storage class of the copies, see copy_object(). defaults to None, the sources' ones.
+    `move` bool
+        if True, the verified sources are deleted.
+    `multipart_threshold` int
+    `part_size` int
+        see copy_object()
+    `max_workers` int
+        the number of objects copied at once.
+    `part_workers` int
+        the number of parts copied at once per object copied in parts.
+    `dry_run` bool
+        if True, nothing is copied or deleted and "Copied" lists the keys that would have been written.
+    `verbose` bool
+        if True, the progress and throughput are printed while copying.
+    '''
+    assert isinstance(prefix, str) and isinstance(destination_prefix, str)
+    same_bucket = source_bucket_name == bucket_name
+    assert not (same_bucket and prefix == destination_prefix and move), "Moving objects onto themselves deletes them"
+    if objects is None:
+        objects = iter_objects(session, source_bucket_name, prefix)
+    #in the same bucket, copies written under the source prefix are never copied again
+    nested = same_bucket and destination_prefix.startswith(prefix) and destination_prefix != prefix
+    objects = (obj for obj in objects if not (nested and obj["Key"].startswith(destination_prefix)))
+
+    result = {"Copied": [], "Bytes": 0, "Deleted": 0, "Errors": [], "DryRun": dry_run}
+    progress = ProgressCounter(f"{'Moved' if move else 'Copied'} {source_bucket_name}/{prefix} to "
+                               f"{bucket_name}/{destination_prefix}", unit = "objects", verbose = verbose)
+
+    def copy(obj):
+        assert obj["Key"].startswith(prefix), f"{obj['Key']} is not under {prefix}"
+        key = destination_prefix + obj["Key"][len(prefix):]
+        if dry_run:
+            return obj, key, {}
+        try:
+            copied = copy_object(session, source_bucket_name, obj["Key"], bucket_name, key, tags, storage_class,
+                                 multipart_threshold, part_size, part_workers)
+            return obj, key, copied
+        except (ClientError, ValueError) as err:
+            return obj, key, str(err)
+        finally:
+            progress.add()
+
+    def verified_sources():
+        for obj, key, copied in bounded_map(copy, objects, max_workers):
+            if isinstance(copied, str):
+                result["Errors"].append({"Key": obj["Key"], "Error": copied})
+                continue
+            result["Copied"].append(key)
+            result["Bytes"] += obj.get("Size", 0)
+            if copied.get("SourceVersionId"):
+                yield {"Key": obj["Key"], "VersionId": copied["SourceVersionId"]}
+            else:
+                yield {"Key": obj["Key"], "ETag": copied.get("SourceETag")}
+
+    if move and not dry_run:
+        deleted = delete_keys(session, source_bucket_name, verified_sources(), verbose = False, if_match = True)
+        result["Deleted"] = deleted["Deleted"]
+        result["Errors"].extend({"Key": error["Key"], "Error": error.get("Message", error.get("Code"))}
+                                for error in deleted["Errors"])
+    else:
+        for _ in verified_sources(): pass
+    progress.close()
+    return result
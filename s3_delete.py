@@ -1,10 +1,109 @@
 import boto3
+import datetime
+import time
+
+from s3_client import get_client
+from s3_metrics import output, THROTTLE_CODES, traced
+from s3_parallel import bounded_map, chunked, ProgressCounter
+from s3_throttle import get_limiter
+
+# delete_objects accepts at most 1,000 keys per request
+DELETE_BATCH_SIZE = 1000
+
+def helper_list_version_pages(s3_client, bucket_name: str, prefix: str = ""):
+    '''helper for delete functions, lazily yields (Versions, DeleteMarkers) of every list_object_versions page'''
+    request = {"Bucket": bucket_name, "Prefix": prefix}
+    while True:
+        page = s3_client.list_object_versions(**request)
+        yield page.get("Versions", []), page.get("DeleteMarkers", [])
+        if not page.get("IsTruncated"):
+            return
+        request["KeyMarker"] = page["NextKeyMarker"]
+        request["VersionIdMarker"] = page["NextVersionIdMarker"]
+
+def helper_delete_batch(session, bucket_name: str, batch: list[dict]) -> list[dict]:
+    '''helper for delete_keys(), deletes up to 1,000 keys in one request and returns the per-key errors'''
+    limiter = get_limiter()
+    errors = []
+    for attempt in range(limiter.max_attempts):
+        response = limiter.call(bucket_name, batch[0]["Key"], get_client(session).delete_objects,
+            Bucket = bucket_name,
+            Delete = {"Objects": batch, "Quiet": True} #quiet mode only returns the keys that failed
+        )
+        #a successful response can still list throttled keys, only those are sent again
+        throttled = [error for error in response.get("Errors", []) if error.get("Code") in THROTTLE_CODES]
+        errors.extend(error for error in response.get("Errors", []) if error.get("Code") not in THROTTLE_CODES)
+        if not throttled or attempt + 1 == limiter.max_attempts or not limiter.enabled:
+            return errors + throttled
+        limiter.record(bucket_name, batch[0]["Key"], True)
+        sent = dict(((entry["Key"], entry.get("VersionId")), entry) for entry in batch) #keeps their ETag conditions
+        batch = [sent[(error["Key"], error.get("VersionId"))] for error in throttled]
+        time.sleep(limiter.backoff(attempt))
+
+@traced
+def delete_keys(session, bucket_name: str, objects, max_workers: int = 8,
+                dry_run: bool = False, verbose: bool = True, if_match: bool = False) -> dict:
+    '''
+    Deletes `objects` from a bucket in batches of 1,000 keys sent concurrently.
+
+    Returns {"Deleted": number of keys deleted, "Bytes": sum of the "Size" of the deleted objects,
+             "Errors": list of S3 error dicts, "DryRun": `dry_run`}.
+    The error dicts are the ones S3 returns in the delete_objects "Errors" array:
+    {"Key", "VersionId", "Code", "Message"}.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the bucket name
+    `objects` iterable of dict
+        the objects to delete as {"Key": key} or {"Key": key, "VersionId": version_id} dicts,
+        other fields like "Size" are not sent ("ETag" only with `if_match`), listed object or version dicts
+        can be given as is.
+        Can be a generator, it is consumed one batch at a time.
+    `max_workers` int
+        the number of delete_objects requests sent at once.
+    `dry_run` bool
+        if True, nothing is deleted and "Deleted" is the number of keys that would have been deleted.
+    `verbose` bool
+        if True, the progress and throughput are printed while deleting.
+    `if_match` bool
+        if True, the "ETag" of the objects that have one is sent with them: S3 only deletes an object
+        whose ETag still matches, one replaced meanwhile is kept and reported in "Errors".
+    '''
+    assert isinstance(bucket_name, str)
+    fields = ("Key", "VersionId", "ETag") if if_match else ("Key", "VersionId")
+    progress = ProgressCounter(f"{'Would delete' if dry_run else 'Deleted'} from {bucket_name}",
+                               unit = "keys", verbose = verbose)
+    errors = []
+    deleted_bytes = 0
+
+    def delete_batch(batch):
+        request = [dict((name, obj[name]) for name in fields if obj.get(name)) for obj in batch]
+        batch_errors = [] if dry_run else helper_delete_batch(session, bucket_name, request)
+        progress.add(len(batch) - len(batch_errors))
+        failed = set((error.get("Key"), error.get("VersionId")) for error in batch_errors)
+        size = sum(obj.get("Size", 0) for obj in batch if (obj["Key"], obj.get("VersionId")) not in failed)
+        return batch_errors, size
+
+    for batch_errors, size in bounded_map(delete_batch, chunked(objects, DELETE_BATCH_SIZE), max_workers):
+        errors.extend(batch_errors)
+        deleted_bytes += size
+    progress.close()
+    if errors and verbose:
+        output(f"{len(errors)} keys could not be deleted, see the returned \"Errors\".")
+    return {"Deleted": progress.done, "Bytes": deleted_bytes, "Errors": errors, "DryRun": dry_run}
 
 # can use this to delete all objects if you pass "" as the prefix
-def delete_objects__with_prefix(session, bucket_name: str, prefix: str):
+@traced
+def delete_objects__with_prefix(session, bucket_name: str, prefix: str, max_workers: int = 8,
+                                dry_run: bool = False, verbose: bool = True):
     '''
     Delete objects from a bucket using `prefixes` as the filter for object names
 
+    Every version and delete marker under `prefix` is deleted, so versioned objects are removed for good.
+    Use cleanup_versions() to only delete old versions and delete markers.
+    Returns the delete_keys() summary: {"Deleted": int, "Bytes": int, "Errors": list[dict], "DryRun": bool}
+
     Can call `for object in bucket.object_versions.all(): print(object.key)`
     to get the object that remain after running this delete function
 
@@ -13,24 +112,130 @@ def delete_objects__with_prefix(session, bucket_name: str, prefix: str):
     `bucket_name` str
         the bucket name
     `prefix` str
-        The path prefix to use to delete objects that start with `prefix`
+        The path prefix to use to delete objects that start with `prefix`.
+        The prefix is filtered server-side by list_object_versions.
+    `max_workers` int
+        the number of delete requests of 1,000 keys sent at once.
+    `dry_run` bool
+        if True, the matching keys are counted but not deleted.
+    `verbose` bool
+        if True, the progress and throughput are printed while deleting.
     '''
     assert isinstance(bucket_name, str)
     assert isinstance(prefix, str)
-    
-    response = []
-    bucket = session.resource("s3").Bucket(bucket_name)
-
-    for obj in bucket.object_versions.all():
-        try:
-            if obj.object_key[:len(prefix)] == prefix:
-                response.append({
-                    "Key": obj.object_key,
-                    "VersionID": obj.version_id
-                })
-        except IndexError:
-            continue
-
-    bucket.delete_objects(Delete={"Objects": response})
-    print("Objects Deleted:", *response, sep="\n\t")
-    return response
+
+    def versions():
+        s3_client = get_client(session)
+        for version_list, marker_list in helper_list_version_pages(s3_client, bucket_name, prefix):
+            for version in version_list + marker_list:
+                yield {"Key": version["Key"], "VersionId": version["VersionId"], "Size": version.get("Size", 0)}
+
+    return delete_keys(session, bucket_name, versions(), max_workers, dry_run, verbose)
+
+def helper_version_entries(s3_client, bucket_name: str, prefix: str = ""):
+    '''helper for cleanup_versions(), lazily yields the versions and delete markers of every key in key order, newest first'''
+    for version_list, marker_list in helper_list_version_pages(s3_client, bucket_name, prefix):
+        #a page lists versions and delete markers apart, both in key order and newest first
+        entries = ([dict(version, IsDeleteMarker = False) for version in version_list]
+                   + [dict(marker, IsDeleteMarker = True, Size = 0) for marker in marker_list])
+        entries.sort(key = lambda entry: (entry["LastModified"], entry["IsLatest"]), reverse = True)
+        entries.sort(key = lambda entry: entry["Key"])
+        yield from entries
+
+@traced
+def cleanup_versions(session, bucket_name: str, prefix: str = "", keep_versions: int = 1,
+                     older_than_days: float = None, remove_delete_markers: bool = True,
+                     max_workers: int = 8, dry_run: bool = False, verbose: bool = True) -> dict:
+    '''
+    Deletes the old versions and delete markers under `prefix` of a versioned bucket, keeping the current objects.
+
+    Returns {"Deleted": number of versions and delete markers deleted, "BytesReclaimed": size of the deleted versions,
+             "DeleteMarkers": number of delete markers sent for deletion, "Kept": number of versions kept,
+             "Errors": list of S3 error dicts, "DryRun": bool}
+
+    The versions are listed page by page and deleted with delete_keys() while the listing goes on,
+    the newest versions of a key spanning several pages are counted across pages.
+    A version is deleted if it is not the current version, at least `keep_versions` newer versions
+    of its key exist and it is older than `older_than_days`.
+    With `remove_delete_markers`, noncurrent delete markers older than `older_than_days` are deleted,
+    and so are the current delete markers left without any version ("expired object delete markers").
+    A current delete marker whose versions are all being deleted is only deleted once they are gone,
+    so a failed delete never makes an old version current again.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the bucket name
+    `prefix` str
+        only the keys starting with `prefix` are cleaned up, filtered server-side by list_object_versions.
+    `keep_versions` int
+        the number of newest versions kept per key, the current version included.
+        The current version is always kept, 0 deletes every version of keys whose current version is a delete marker.
+    `older_than_days` float
+        only versions and delete markers last modified more than `older_than_days` days ago are deleted.
+        defaults to None, whatever their age.
+    `remove_delete_markers` bool
+        if True, the noncurrent and the orphaned delete markers are deleted.
+    `max_workers` int
+        the number of delete requests of 1,000 keys sent at once.
+    `dry_run` bool
+        if True, nothing is deleted, the result tells what would be deleted.
+    `verbose` bool
+        if True, the progress and throughput are printed while deleting.
+    '''
+    assert isinstance(bucket_name, str)
+    assert isinstance(keep_versions, int) and keep_versions >= 0, f"Invalid keep_versions = {keep_versions}"
+    cutoff = None
+    if older_than_days is not None:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days = older_than_days)
+    counts = {"DeleteMarkers": 0, "Kept": 0}
+    deferred_markers = [] #current delete markers of keys whose versions are all being deleted
+
+    def old(entry) -> bool:
+        return cutoff is None or entry["LastModified"] < cutoff
+
+    def finish_key(marker, seen: int, deleted: int):
+        #a current delete marker is only known to be orphaned once all the versions of its key are listed
+        if marker is None or not remove_delete_markers or deleted < seen or not old(marker):
+            return None
+        counts["DeleteMarkers"] += 1
+        if seen == 0:
+            return marker
+        deferred_markers.append(marker)
+
+    def candidates():
+        key, marker, seen, deleted = None, None, 0, 0
+        for entry in helper_version_entries(get_client(session), bucket_name, prefix):
+            if entry["Key"] != key:
+                orphan = finish_key(marker, seen, deleted)
+                if orphan: yield orphan
+                key, marker, seen, deleted = entry["Key"], None, 0, 0
+            if entry["IsDeleteMarker"]:
+                if entry["IsLatest"]:
+                    marker = entry
+                elif remove_delete_markers and old(entry):
+                    counts["DeleteMarkers"] += 1
+                    yield entry
+                continue
+            seen += 1
+            if entry["IsLatest"] or seen <= keep_versions or not old(entry):
+                counts["Kept"] += 1
+                continue
+            deleted += 1
+            yield entry
+        orphan = finish_key(marker, seen, deleted)
+        if orphan: yield orphan
+
+    result = delete_keys(session, bucket_name, candidates(), max_workers, dry_run, verbose)
+    if deferred_markers:
+        failed_keys = set(error.get("Key") for error in result["Errors"])
+        markers = [marker for marker in deferred_markers if marker["Key"] not in failed_keys]
+        counts["DeleteMarkers"] -= len(deferred_markers) - len(markers)
+        marker_result = delete_keys(session, bucket_name, markers, max_workers, dry_run, verbose)
+        result["Deleted"] += marker_result["Deleted"]
+        result["Errors"].extend(marker_result["Errors"])
+    if verbose:
+        output(f"{'Would reclaim' if dry_run else 'Reclaimed'} {result['Bytes']} bytes from {bucket_name}/{prefix}, "
+               f"{counts['Kept']} versions kept")
+    return {"Deleted": result["Deleted"], "BytesReclaimed": result["Bytes"], "DeleteMarkers": counts["DeleteMarkers"],
+            "Kept": counts["Kept"], "Errors": result["Errors"], "DryRun": dry_run}
@@ -1,6 +1,23 @@
+import io
+import mmap
+import os
 from uuid import uuid4
 from urllib import parse
 
+from s3_client import get_client, get_resource
+from s3_metrics import output, traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_throttle import get_limiter
+
+VALID_STORAGE = ['STANDARD', 'REDUCED_REDUNDANCY', 'STANDARD_IA', 'ONEZONE_IA',
+    'INTELLIGENT_TIERING', 'GLACIER', 'DEEP_ARCHIVE', 'OUTPOSTS', 'GLACIER_IR']
+# multipart upload limits: parts are at least 5 MiB (except the last), at most 5 GiB, and at most 10,000 per upload
+MIN_PART_SIZE = 5 * 1024**2
+MAX_PARTS = 10000
+MAX_PART_SIZE = 5 * 1024**3
+PART_GROWTH_INTERVAL = 1000 #parts of a stream between two doublings of the part size
+MiB = 1024**2
+
 def gen_tagging_list_from_python_dict(tags:dict):
     '''Converts a dict of key-value pairs to a list of s3 tagging dicts'''
     return [{'Key': key, 'Value': val} for key,val in tags.items()]
@@ -23,6 +40,7 @@ def gen_bucket_name(bucket_name: str) -> str:
             [bucket_name, hyphen[bucket_name[-1] == "-"], str(uuid4())]
         )[:min((len(bucket_name) + 36), 63)]
 
+@traced
 def gen_bucket(session, bucket_name: str, tags: list[dict] = None, region = None, suffix = True):
     '''
     Creates an S3 bucket and returns the suffixed bucket name as well as the S3 response
@@ -58,7 +76,7 @@ def gen_bucket(session, bucket_name: str, tags: list[dict] = None, region = None
             The `bucket_name` argument is used as the S3 bucket name
             (this may throw an error since buckets need to be globally unique).
     '''
-    s3_boto_connection = session.resource("s3")
+    s3_boto_connection = get_resource(session)
     if not region:
         region = session.region_name
     if suffix: bucket_name = gen_bucket_name(bucket_name)
@@ -68,20 +86,29 @@ def gen_bucket(session, bucket_name: str, tags: list[dict] = None, region = None
             "LocationConstraint": region
         }
     )
-    print(f"Bucket: {bucket_name}\tRegion: {region}")
+    output(f"Bucket: {bucket_name}\tRegion: {region}")
 
     if isinstance(tags, list):
         bucket_tagger = s3_boto_connection.BucketTagging(bucket_name)
         set_tag = bucket_tagger.put(Tagging={"TagSet":tags})
         # bucket_tagger.reload() #useless here since it isn't called again
-        print(f"Bucket tags: {tags}")
+        output(f"Bucket tags: {tags}")
         return bucket_name, bucket_response, set_tag
     return bucket_name, bucket_response
 
     
 
+def helper_put_arguments(tags: dict = None, storage_class = "STANDARD") -> dict:
+    '''helper for gen_object() and upload_object(), the ACL, StorageClass and Tagging arguments of a put'''
+    assert storage_class in VALID_STORAGE, f"incorrect storage_class input = {storage_class}"
+    arguments = {"ACL": "private", "StorageClass": storage_class}
+    if tags:
+        arguments["Tagging"] = parse.urlencode(tags)
+    return arguments
+
+@traced
 def gen_object(session, bucket_name:str, object_path:str,
-               tags: dict = None, storage_class = "STANDARD"):
+               tags: dict = None, storage_class = "STANDARD", source = None):
     '''
     Creates an S3 object in a bucket
     
@@ -92,8 +119,7 @@ def gen_object(session, bucket_name:str, object_path:str,
         Each tag in `tags` must be in s3 tag format: {'Key':key_argument, 'Value':value_argument}
 
     This function uses `session` to find its default region.
-    Note: the boto3 implementation for uploading a file to an object is very straightforward
-    so no additional abstraction via functions is needed.
+    Without `source` the object is empty, use upload_object() directly to tune how `source` is uploaded.
 
     Parameters:
     `session` boto3.session.Session()
@@ -108,22 +134,173 @@ def gen_object(session, bucket_name:str, object_path:str,
     `storage_class` str
         One of 'STANDARD'|'REDUCED_REDUNDANCY'|'STANDARD_IA'|'ONEZONE_IA'|
         'INTELLIGENT_TIERING'|'GLACIER'|'DEEP_ARCHIVE'|'OUTPOSTS'|'GLACIER_IR'
+    `source` str|file-like
+        The content of the object, a local file path or a binary file-like object.
+        defaults to None, the object is empty.
     '''
-    valid_storage = ['STANDARD', 'REDUCED_REDUNDANCY', 'STANDARD_IA', 'ONEZONE_IA', 
-        'INTELLIGENT_TIERING', 'GLACIER', 'DEEP_ARCHIVE', 'OUTPOSTS', 'GLACIER_IR']
-    assert storage_class in valid_storage, f"incorrect storage_class input = {storage_class}"
+    if source is not None:
+        return upload_object(session, bucket_name, object_path, source, tags, storage_class)
+    put_arguments = helper_put_arguments(tags, storage_class)
 
-    s3_obj = session.resource("s3").Object(bucket_name, object_path)
+    s3_obj = get_resource(session).Object(bucket_name, object_path)
+    response = s3_obj.put(**put_arguments)
     if tags:
-        url_tags = parse.urlencode(tags)
-        response = s3_obj.put(
-            ACL = "private",
-            StorageClass = storage_class,
-            Tagging = url_tags)
         return object_path, response, gen_tagging_list_from_python_dict(tags)
+    return object_path, response
+
+class MemoryviewReader(io.RawIOBase):
+    '''
+    Seekable, read-only file-like view of a buffer, lets botocore send a slice of a memory map without copying it.
+
+    Parameters:
+    `buffer` bytes-like
+        the data to read, e.g. a slice of an mmap.mmap
+    '''
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, destination):
+        count = min(len(destination), len(self._view) - self._position)
+        destination[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, start + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def __len__(self):
+        return len(self._view)
+
+    def close(self):
+        self._view.release() #a memory map cannot be closed while views of it are alive
+        super().close()
+
+def helper_iter_parts(source, size: int|None, part_size: int, first_part: bytes = b""):
+    '''
+    helper for upload_object(), lazily yields the part bodies of a memory map or a file-like object
+    The size of a stream is unknown, its part size doubles every `PART_GROWTH_INTERVAL` parts up to 5 GiB,
+    so 10,000 parts of at least 5 MiB hold more than the 5 TiB S3 object limit.
+    '''
+    if isinstance(source, mmap.mmap):
+        for start in range(0, size, part_size):
+            yield MemoryviewReader(memoryview(source)[start:start + part_size])
     else:
-        response = s3_obj.put(
-            ACL = "private",
-            StorageClass = storage_class)
-        
-    return object_path, response
\ No newline at end of file
+        data = first_part or source.read(part_size)
+        count = 0
+        while data:
+            yield data
+            count += 1
+            if count % PART_GROWTH_INTERVAL == 0: part_size = min(2 * part_size, MAX_PART_SIZE)
+            data = source.read(part_size)
+
+def helper_rewound(body):
+    '''helper for the upload functions, `body` moved back to its start so a retried request sends all of it'''
+    if hasattr(body, "seek"): body.seek(0)
+    return body
+
+def helper_multipart_upload(session, bucket_name:str, object_path:str, parts, total_mib: float|None,
+                            max_workers: int, put_arguments: dict, verbose: bool):
+    '''helper for upload_object(), uploads `parts` concurrently and completes or aborts the multipart upload'''
+    s3_client = get_client(session)
+    upload_id = s3_client.create_multipart_upload(
+        Bucket = bucket_name, Key = object_path, **put_arguments)["UploadId"]
+    progress = ProgressCounter(f"Uploaded {object_path}", total_mib, unit = "MiB", verbose = verbose)
+
+    def upload_part(numbered_part):
+        part_number, body = numbered_part
+        try:
+            response = get_limiter().call(bucket_name, object_path, lambda: get_client(session).upload_part(
+                Bucket = bucket_name, Key = object_path, UploadId = upload_id,
+                PartNumber = part_number, Body = helper_rewound(body)))
+            progress.add(len(body) / MiB)
+        finally:
+            if isinstance(body, MemoryviewReader): body.close()
+        return {"ETag": response["ETag"], "PartNumber": part_number}
+
+    try:
+        completed = list(bounded_map(upload_part, enumerate(parts, start = 1), max_workers))
+        response = s3_client.complete_multipart_upload(
+            Bucket = bucket_name, Key = object_path, UploadId = upload_id,
+            MultipartUpload = {"Parts": completed})
+    except BaseException:
+        s3_client.abort_multipart_upload(Bucket = bucket_name, Key = object_path, UploadId = upload_id)
+        raise
+    progress.close()
+    return response
+
+@traced
+def upload_object(session, bucket_name:str, object_path:str, source, tags: dict = None,
+                  storage_class = "STANDARD", part_size: int = 8 * MiB, max_workers: int = 8,
+                  verbose: bool = True):
+    '''
+    Uploads a local file or file-like object to an S3 object with a parallel multipart upload.
+
+    Returns the object path inside its bucket, the S3 response, and the tags that were set, like gen_object().
+    The response is the complete_multipart_upload response, or the put response if `source` fits in one part.
+
+    Files are read through a memory map so the parts are sent straight from the page cache.
+    File-like objects are read one part at a time, at most `2 * max_workers` parts are held in memory.
+    Their size is not known in advance, so their part size doubles every 1,000 parts to fit in 10,000 parts.
+    If a part fails the multipart upload is aborted so no orphaned parts are billed.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        The S3 bucket's name
+    `object_path` str
+        The path inside the bucket to be used as the object key.
+    `source` str|file-like
+        a local file path or a binary file-like object with a read() method.
+    `tags` dict
+        Must be a regular python dictionary such as {key_arg1:val_arg1, key_arg2:val_arg2}, see gen_object().
+    `storage_class` str
+        The storage class of the object, see gen_object() for the valid values.
+    `part_size` int
+        The size in bytes of every part but the last, at least 5 MiB and at most 5 GiB.
+        Raised automatically for files that would need more than 10,000 parts,
+        and doubled every 1,000 parts of a file-like object.
+    `max_workers` int
+        The number of parts uploaded at once.
+    `verbose` bool
+        if True, the progress and throughput are printed while uploading.
+    '''
+    assert isinstance(part_size, int) and MIN_PART_SIZE <= part_size <= MAX_PART_SIZE, \
+        f"part_size must be between {MIN_PART_SIZE} and {MAX_PART_SIZE} bytes"
+    put_arguments = helper_put_arguments(tags, storage_class)
+    tag_list = [gen_tagging_list_from_python_dict(tags)] if tags else []
+
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size <= part_size:
+                response = get_limiter().call(bucket_name, object_path, lambda: get_client(session).put_object(
+                    Bucket = bucket_name, Key = object_path, Body = helper_rewound(file), **put_arguments))
+                return object_path, response, *tag_list
+            part_size = max(part_size, -(-size // MAX_PARTS))
+            with mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ) as file_map:
+                response = helper_multipart_upload(session, bucket_name, object_path,
+                                                   helper_iter_parts(file_map, size, part_size),
+                                                   size / MiB, max_workers, put_arguments, verbose)
+        return object_path, response, *tag_list
+
+    first_part = source.read(part_size)
+    if len(first_part) < part_size:
+        response = get_limiter().call(bucket_name, object_path, get_client(session).put_object,
+            Bucket = bucket_name, Key = object_path, Body = first_part, **put_arguments)
+        return object_path, response, *tag_list
+    response = helper_multipart_upload(session, bucket_name, object_path,
+                                       helper_iter_parts(source, None, part_size, first_part),
+                                       None, max_workers, put_arguments, verbose)
+    return object_path, response, *tag_list
@@ -1,49 +1,227 @@
 import boto3
 from botocore.exceptions import ClientError
+from concurrent.futures import as_completed, ThreadPoolExecutor
 import datetime
+import mmap
+import numpy as np
+import os
+import re
+import threading
+import time
 
 from s3_generate import gen_python_dict_from_tagging_list#, gen_tagging_list_from_python_dict
+from s3_client import get_client
+from s3_metrics import output, traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_tagquery import compile_tag_query
+from s3_throttle import get_limiter
 # at some point these will likely be changed to use metadata stored by AWS either in S3 or RDS
 
+## listing
+def helper_list_object_pages(s3_client, bucket_name:str, object_prefix:str = "", start_after:str = None):
+    '''helper for iter_objects(), lazily yields the "Contents" list of every list_objects_v2 page'''
+    request = {"Bucket": bucket_name, "Prefix": object_prefix or ""}
+    if start_after:
+        request["StartAfter"] = start_after
+    while True:
+        page = s3_client.list_objects_v2(**request)
+        yield page.get("Contents", []) #"Contents" is missing when nothing matches
+        if not page.get("IsTruncated"):
+            return
+        request["ContinuationToken"] = page["NextContinuationToken"]
+
+@traced
+def iter_objects(session, bucket_name:str, object_prefix:str = "", start_after:str = None, s3_client = None):
+    '''
+    Lazily yields the object dicts in `bucket_name`, in key order, following list_objects_v2 continuation tokens.
+
+    Only one page (up to 1,000 objects) is held at a time, so this works on buckets of any size
+    and yields the first objects before the listing is done.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the name of the bucket to list
+    `object_prefix` str
+        only objects whose key starts with `object_prefix` are listed, filtered server-side.
+        defaults to "", all objects in the bucket are listed.
+    `start_after` str
+        only objects whose key comes after `start_after` are listed.
+    `s3_client` boto3.client("s3")
+        Gives the option to pass an s3 client, defaults to the pooled client of s3_client.get_client().
+    '''
+    if s3_client is None: s3_client = get_client(session)
+    for contents in helper_list_object_pages(s3_client, bucket_name, object_prefix, start_after):
+        yield from contents
+
 ## tag filter
-def helper_tag_filter(tag_list:dict, source_tags:dict):
-    '''helper for get_buckets_tag_filter() and get_object_tag_filter()'''
-    result = len(tag_list)
-    for tkey, tval in tag_list.items():
-        if not result: return True
-        if source_tags.get(tkey) == tval:
-            result -= 1
-    return not result
+def helper_tag_query(tags: list[dict]|dict|str, s3_format: bool):
+    '''helper for tag filters, compiles `tags` once into a s3_tagquery.TagQuery'''
+    if s3_format and isinstance(tags, list):
+        tags = gen_python_dict_from_tagging_list(tags)
+    return compile_tag_query(tags)
+
+# bucket regions never change and are cached for good, bucket tags for `ttl` seconds
+BUCKET_TAGS_TTL = 300
+_bucket_cache = {} #bucket name -> {"Region": str, "TagSet": list[dict]|None, "Expires": float}
+_bucket_cache_lock = threading.Lock()
+
+def forget_bucket_tags(bucket_name: str = None):
+    '''
+    Drops the cached tags of `bucket_name`, or of every bucket, so the next scan fetches them again.
+
+    Parameters:
+    `bucket_name` str
+        defaults to None, every bucket.
+    '''
+    with _bucket_cache_lock:
+        for name, entry in _bucket_cache.items():
+            if bucket_name is None or name == bucket_name: entry.pop("TagSet", None)
+
+def helper_bucket_region(s3_client, bucket: dict) -> str:
+    '''helper for bucket scans, the bucket's region from the listing, the cache or get_bucket_location'''
+    region = bucket.get("BucketRegion") or _bucket_cache.get(bucket["Name"], {}).get("Region")
+    if region is None:
+        location = s3_client.get_bucket_location(Bucket = bucket["Name"])["LocationConstraint"]
+        #buckets made without a location constraint are in us-east-1, "EU" is the legacy name of eu-west-1
+        region = {None: "us-east-1", "": "us-east-1", "EU": "eu-west-1"}.get(location, location)
+    with _bucket_cache_lock:
+        _bucket_cache.setdefault(bucket["Name"], {})["Region"] = region
+    return region
+
+def helper_bucket_tags(bucket: dict, ttl: float, client_of) -> tuple[dict, list[dict]|None, dict|None]:
+    '''
+    helper for bucket scans, (bucket, S3 formatted tags or None if untagged, error response or None)
+    `client_of(region)` returns the client of `region`, the session's default client for None
+    '''
+    entry = _bucket_cache.get(bucket["Name"], {})
+    if "TagSet" in entry and entry["Expires"] > time.monotonic():
+        return bucket, entry["TagSet"], None
+    try:
+        region = helper_bucket_region(client_of(None), bucket)
+        #a client of the bucket's own region answers without a redirect round trip
+        s3_client = client_of(region)
+        try:
+            bucket_tags = get_limiter().call(bucket["Name"], "", s3_client.get_bucket_tagging,
+                                             Bucket = bucket["Name"])["TagSet"]
+        except ClientError as err:
+            if err.response["Error"]["Code"] != "NoSuchTagSet": raise
+            bucket_tags = None
+    except ClientError as err:
+        return bucket, None, err.response
+    with _bucket_cache_lock:
+        _bucket_cache.setdefault(bucket["Name"], {}).update(TagSet = bucket_tags, Expires = time.monotonic() + ttl)
+    return bucket, bucket_tags, None
 
-def get_buckets_with_tags(session, tags: list[dict]|dict, s3_format = True) -> list[tuple[str]]:
+@traced
+def iter_buckets_with_tags(session, tags: list[dict]|dict|str, s3_format = True, max_workers: int = 16,
+                           ttl: float = BUCKET_TAGS_TTL):
+    '''
+    Lazily yields tuples containing buckets and their tags based on filtering by `tags`, as the lookups finish
+
+    Streaming version of get_buckets_with_tags(), see it for the parameters.
+    The buckets come in the order their tags arrive, not in listing order.
+    '''
+    query = helper_tag_query(tags, s3_format)
+    buckets = []
+    request = {}
+    while True: #list_buckets pages only when asked to, older accounts get every bucket at once
+        page = get_client(session).list_buckets(**request)
+        buckets.extend(page["Buckets"])
+        if not page.get("ContinuationToken"): break
+        request["ContinuationToken"] = page["ContinuationToken"]
+    #buckets of a region are looked up together
+    buckets.sort(key = lambda bucket: bucket.get("BucketRegion") or _bucket_cache.get(bucket["Name"], {}).get("Region") or "")
+    #the pooled clients are shared by the workers, one per region
+    def client_of(region):
+        return get_client(session, region_name = None if region == session.region_name else region)
+
+    executor = ThreadPoolExecutor(max_workers)
+    futures = [executor.submit(helper_bucket_tags, bucket, ttl, client_of) for bucket in buckets]
+    try:
+        for future in as_completed(futures):
+            bucket, bucket_tags, error = future.result()
+            if error is not None: output("Error: ", error)
+            elif bucket_tags is not None and query.matches(gen_python_dict_from_tagging_list(bucket_tags)):
+                yield bucket, bucket_tags
+    finally:
+        #only reached with pending futures if the consumer stopped early
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait = True)
+
+@traced
+def get_buckets_with_tags(session, tags: list[dict]|dict|str, s3_format = True, tag_index = None,
+                          max_workers: int = 16, ttl: float = BUCKET_TAGS_TTL) -> list[tuple[str]]:
     '''
     Returns list of tuples containing buckets and their tags based on filtering by `tags`
 
+    The buckets' tags are fetched concurrently, each with a client of the bucket's region, and cached:
+    regions for good, tags for `ttl` seconds. The list is sorted by bucket name like list_buckets().
+
     Parameters:
     `session` boto3.session.Session()
-    `tags` list[dict]|dict
-        See `s3_format` for more information
+    `tags` list[dict]|dict|str|s3_tagquery.TagQuery
+        the tags every bucket must have, see `s3_format` for more information,
+        or a tag query like "cell-type in {A, B} and not test-status = failed", see s3_tagquery.
     `s3_format` bool
         if True, `tags` is a list S3 tag formatted dicts {"Key":key_arg, "Value":value_arg}
         if False, `tags` is a dict of regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2}
+    `tag_index` s3_index.TagIndex
+        if given, the index is refreshed with the buckets that are new since its last refresh
+        and the query is answered from it instead of fetching every bucket's tags.
+    `max_workers` int
+        the number of bucket lookups sent at once.
+    `ttl` float
+        the seconds cached bucket tags are used for, 0 fetches every bucket's tags again.
+        s3_set.add_tags_to_bucket() drops the cached tags of the buckets it tags.
     '''
-    assert isinstance(tags,(list,dict))
-    if s3_format:
-        tags = gen_python_dict_from_tagging_list(tags)
-    s3_client = session.client("s3")
-    result = []
-    for bucket in s3_client.list_buckets()["Buckets"]:
-        try:
-            bucket_tags = s3_client.get_bucket_tagging(Bucket=bucket["Name"])["TagSet"]
-            if helper_tag_filter(tags, gen_python_dict_from_tagging_list(bucket_tags)):
-                result.append((bucket, bucket_tags))
-        except ClientError as err:
-            if err.response["Error"]["Code"] == "NoSuchTagSet": continue
-            else: print("Error: ", err.response)
-    return result
+    if tag_index is not None:
+        tag_index.refresh_buckets(session)
+        return tag_index.query_buckets(helper_tag_query(tags, s3_format))
+    return sorted(iter_buckets_with_tags(session, tags, s3_format, max_workers, ttl),
+                  key = lambda bucket_and_tags: bucket_and_tags[0]["Name"])
+
+def helper_fetch_object_tags(session, bucket_name:str, object:dict) -> tuple[dict, dict]:
+    '''helper for get_objects_with_tags_from_bucket(), fetches one object's tags on the pooled client'''
+    tag_dict = gen_python_dict_from_tagging_list(get_limiter().call(
+        bucket_name, object["Key"], get_client(session).get_object_tagging, Bucket = bucket_name, Key = object["Key"]
+    )["TagSet"])
+    return object, tag_dict
+
+@traced
+def iter_objects_with_tags_from_bucket(session, bucket_name:str, tags:list[dict]|dict|str,
+                                       object_prefix:str = None, s3_format = True,
+                                       max_workers:int = 1, max_in_flight:int = None, tag_index = None):
+    '''
+    Lazily yields tuples containing `bucket_name`'s objects and their tags based on `tags`
+
+    Streaming version of get_objects_with_tags_from_bucket(), see it for the parameters.
+    Objects are tag-checked as the listing pages arrive, so the first matches are yielded
+    before the whole bucket has been listed.
+    '''
+    query = helper_tag_query(tags, s3_format)
+    if object_prefix: #!= None
+        assert isinstance(object_prefix,str)
+    if tag_index is not None:
+        tag_index.refresh_objects(session, bucket_name, object_prefix, max_workers)
+        yield from tag_index.query_objects(bucket_name, query, object_prefix)
+        return
+    object_stream = iter_objects(session, bucket_name, object_prefix)
+    if max_workers > 1:
+        tagged_objects = bounded_map(lambda obj: helper_fetch_object_tags(session, bucket_name, obj),
+                                     object_stream, max_workers, max_in_flight)
+    else:
+        tagged_objects = (helper_fetch_object_tags(session, bucket_name, obj) for obj in object_stream)
+    for object, tag_dict in tagged_objects:
+        if query.matches(tag_dict):
+            yield object, tag_dict
 
-def get_objects_with_tags_from_bucket(session, bucket_name:str, tags:list[dict]|dict,
-                                      object_prefix:str = None, s3_format = True) -> list[tuple[str]]:
+@traced
+def get_objects_with_tags_from_bucket(session, bucket_name:str, tags:list[dict]|dict|str,
+                                      object_prefix:str = None, s3_format = True,
+                                      max_workers:int = 1, max_in_flight:int = None,
+                                      tag_index = None) -> list[tuple[str]]:
     '''
     Returns list of tuples containing `bucket_name`'s objects and their tags based on `tags` 
 
@@ -51,31 +229,30 @@ def get_objects_with_tags_from_bucket(session, bucket_name:str, tags:list[dict]|
     `session` boto3.session.Session()
     `bucket_name` str
         the name of the bucket to check
-    `tags` list[dict]|dict
-        See `s3_format` for more information
+    `tags` list[dict]|dict|str|s3_tagquery.TagQuery
+        the tags every object must have, see `s3_format` for more information,
+        or a tag query like "cell-type in {A, B} and not test-status = failed", see s3_tagquery.
     `object_prefix` str
-        Prefix of objects that should be returned, makes the request from AWS smaller I think, accelerates the function.
+        Prefix of objects that should be returned, filtered server-side so fewer objects are tag-checked.
         defaults to None, all objects in the bucket are checked for the tags
     `s3_format` bool
         if True, `tags` is a list S3 tag formatted dicts {"Key":key_arg, "Value":value_arg}
         if False, `tags` is a dict of regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2}
+    `max_workers` int
+        the number of threads fetching object tags concurrently, sharing the pooled client.
+        defaults to 1, the tags are fetched one object at a time.
+    `max_in_flight` int
+        the maximum number of tag requests queued at once when `max_workers` > 1.
+        defaults to None, which is `2 * max_workers`.
+    `tag_index` s3_index.TagIndex
+        if given, the index is refreshed for `object_prefix`, which only re-fetches the tags of objects
+        whose ETag or LastModified changed, and the query is answered from it.
+
+    The result is in listing order whatever the value of `max_workers`.
+    Use iter_objects_with_tags_from_bucket() to process the matches as they arrive.
     '''
-    s3_client = session.client("s3")
-    result = []
-    if s3_format:
-        tags = gen_python_dict_from_tagging_list(tags)
-    if object_prefix: #!= None
-        assert isinstance(object_prefix,str)
-        object_list =  s3_client.list_objects(Bucket = bucket_name, Prefix = object_prefix)["Contents"]
-    else:
-        object_list = s3_client.list_objects(Bucket = bucket_name)["Contents"]
-    for object in object_list:
-        tag_dict = gen_python_dict_from_tagging_list(
-            s3_client.get_object_tagging(Bucket = bucket_name, Key = object["Key"])["TagSet"]
-        )
-        if helper_tag_filter(tags,tag_dict):
-            result.append((object,tag_dict))
-    return result
+    return list(iter_objects_with_tags_from_bucket(session, bucket_name, tags, object_prefix,
+                                                   s3_format, max_workers, max_in_flight, tag_index))
 
 
 ## name date filter
@@ -104,30 +281,70 @@ def helper_date_conversion(use_date):
     #use_date is all datetime.datetime now
     return use_date
 
-def helper_date_comparison(bucket_creationdate: datetime.datetime, *args) -> bool:
-    '''helper for name_date filters, returns the date comparison result'''
-    timezone = bucket_creationdate.tzinfo
-    args = list(args) #args is a tuple but a mutable object is needed
-    for i in range(len(args)):
-        if not args[i].tzinfo:
-            args[i] = args[i].replace(tzinfo = timezone)
-    if len(args) == 2:
-        assert args[0] < args[1], "start date must be before end date in `use_date`."
-        return bucket_creationdate <= args[1] and bucket_creationdate >= args[0]
-    else:
-        if not args[0]: #default value is None in get_bucket_with_name_date
-            return True #so all dates are retrieved
-        else:
-            return bucket_creationdate.date() == args[0].date()
-            #will use the date portion for single comparison
+def helper_date_intervals(use_date) -> np.ndarray|None:
+    '''
+    helper for name_date filters, normalizes `use_date` once into an (n, 2) array of [start, end] POSIX timestamps
 
+    Returns None if `use_date` is None, no date filter. A single date covers its whole day,
+    a [start, end] list is one inclusive interval, a list of [start, end] pairs is several intervals.
+    Dates without time zone are UTC, the time zone of S3 dates.
+    '''
+    if use_date is None:
+        return None
+    if isinstance(use_date, list) and use_date and all(isinstance(d, (list, tuple)) for d in use_date):
+        return np.concatenate([helper_date_intervals(list(interval)) for interval in use_date])
+    converted = helper_date_conversion(list(use_date) if isinstance(use_date, list) else use_date)
+    assert not isinstance(converted, str), converted #helper_date_conversion() returns its error message
+    converted = [d if d.tzinfo else d.replace(tzinfo = datetime.timezone.utc) for d in converted]
+    if len(converted) == 2:
+        assert converted[0] < converted[1], "start date must be before end date in `use_date`."
+        return np.array([[converted[0].timestamp(), converted[1].timestamp()]])
+    day = datetime.datetime.combine(converted[0].date(), datetime.time(0), tzinfo = converted[0].tzinfo)
+    return np.array([[day.timestamp(), day.timestamp() + 86400 - 1e-6]])
+
+def helper_name_date_mask(names: np.ndarray, dates: np.ndarray, prefix: str = "", intervals: np.ndarray = None,
+                          sizes: np.ndarray = None, min_size: int = None, max_size: int = None,
+                          storage_classes: np.ndarray = None, storage_class: str|list[str] = None,
+                          regex: re.Pattern = None) -> np.ndarray:
+    '''helper for name_date filters, the boolean mask of the entries matching every given predicate'''
+    mask = np.ones(len(names), dtype = bool)
+    if prefix:
+        mask &= np.char.startswith(names, prefix)
+    if intervals is not None:
+        mask &= ((dates[:, None] >= intervals[:, 0]) & (dates[:, None] <= intervals[:, 1])).any(axis = 1)
+    if min_size is not None:
+        mask &= sizes >= min_size
+    if max_size is not None:
+        mask &= sizes <= max_size
+    if storage_class is not None:
+        mask &= np.isin(storage_classes, [storage_class] if isinstance(storage_class, str) else storage_class)
+    if regex is not None:
+        mask &= np.fromiter((regex.search(name) is not None for name in names), dtype = bool, count = len(names))
+    return mask
+
+def helper_filter_page(contents: list[dict], intervals: np.ndarray = None, min_size: int = None, max_size: int = None,
+                       storage_class: str|list[str] = None, regex: re.Pattern = None) -> list[dict]:
+    '''helper for object name_date filters, the objects of a listing page matching the predicates, in one pass'''
+    if not contents:
+        return []
+    mask = helper_name_date_mask(
+        np.array([obj["Key"] for obj in contents]),
+        np.array([obj["LastModified"].timestamp() for obj in contents]),
+        intervals = intervals,
+        sizes = np.array([obj["Size"] for obj in contents]), min_size = min_size, max_size = max_size,
+        storage_classes = np.array([obj.get("StorageClass", "STANDARD") for obj in contents]),
+        storage_class = storage_class, regex = regex)
+    return [obj for obj, keep in zip(contents, mask) if keep]
+
+@traced
 def get_buckets_with_name_date(session,
                                prefix: str,
                                use_date: list[str|datetime.datetime|datetime.date]
                                | str|datetime.datetime|datetime.date
-                               | None = None) -> list[str]:
+                               | None = None,
+                               regex: str = None) -> list[dict]:
     '''
-    Returns list of bucket names who start with `prefix` and made on or in (list) `use_date` using boto3.
+    Returns list of bucket dicts (list_buckets "Buckets" entries) whose name starts with `prefix` and made on or in (list) `use_date` using boto3.
 
     Parameters:
     `session` boto3.session.Session()
@@ -139,28 +356,67 @@ def get_buckets_with_name_date(session,
         Used to retrieve the buckets made on the date given.
         if str, must be in the format "year-month-day-hour-minute-second".
             only year, month, and day are required.
-        If you want to check an interval of dates, use a for loop with an f-string for `use_date`.
+        A list of two dates is an interval, a list of [start, end] lists is several intervals.
+    `regex` str
+        only buckets whose name contains a match of the regular expression `regex`.
 
     Doesn't throw an indexing error if the prefix is longer than the bucket name.
     '''
-    assert isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
-    # turning use_date into datetime.datetime
-    use_date = helper_date_conversion(use_date)
-    bucket_list = session.client("s3").list_buckets()["Buckets"]
-    #removed from list comprehension to separate boto3 interacting with a loop
-    return [bucket for bucket
-        in bucket_list
-        if (bucket["Name"][: min(len(bucket["Name"]), len(prefix))] == prefix)
-            & (helper_date_comparison(bucket["CreationDate"], *use_date))]
+    assert use_date is None or isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
+    # turning use_date into timestamp intervals once
+    intervals = helper_date_intervals(use_date)
+    bucket_list = get_client(session).list_buckets()["Buckets"]
+    if not bucket_list:
+        return []
+    names = np.array([bucket["Name"] for bucket in bucket_list])
+    dates = np.array([bucket["CreationDate"].timestamp() for bucket in bucket_list])
+    mask = helper_name_date_mask(names, dates, prefix, intervals, regex = re.compile(regex) if regex else None)
+    return [bucket for bucket, keep in zip(bucket_list, mask) if keep]
 
+@traced
+def iter_objects_with_name_date(session,
+                                bucket_name: str,
+                                object_prefix: str,
+                                use_date: list[str|datetime.datetime|datetime.date]
+                                | str|datetime.datetime|datetime.date
+                                | None = None,
+                                inventory = None,
+                                min_size: int = None,
+                                max_size: int = None,
+                                storage_class: str|list[str] = None,
+                                regex: str = None):
+    '''
+    Lazily yields the objects of `bucket_name` who start with `object_prefix` and were modified on or in (list) `use_date`.
+
+    Streaming version of get_objects_with_name_date(), see it for the parameters.
+    '''
+    assert use_date is None or isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
+    if inventory is not None:
+        assert inventory.bucket_name == bucket_name, f"The inventory is a report of {inventory.bucket_name}"
+        yield from inventory.iter_objects_with_name_date(session, object_prefix, use_date, min_size, max_size,
+                                                         storage_class, regex)
+        return
+    # turning use_date into timestamp intervals and compiling the regex once
+    intervals = helper_date_intervals(use_date)
+    pattern = re.compile(regex) if regex else None
+    #the prefix is filtered server-side, the other predicates one listing page at a time
+    for contents in helper_list_object_pages(get_client(session), bucket_name, object_prefix):
+        yield from helper_filter_page(contents, intervals, min_size, max_size, storage_class, pattern)
+
+@traced
 def get_objects_with_name_date(session,
                                bucket_name: str,
                                object_prefix: str,
                                use_date: list[str|datetime.datetime|datetime.date]
                                | str|datetime.datetime|datetime.date
-                               | None = None) -> list[str]:
+                               | None = None,
+                               inventory = None,
+                               min_size: int = None,
+                               max_size: int = None,
+                               storage_class: str|list[str] = None,
+                               regex: str = None) -> list[dict]:
     '''
-    Returns list of bucket names who start with `prefix` and made on or in (list) `use_date` using boto3.
+    Returns list of object dicts (list_objects_v2 "Contents" entries) whose key starts with `object_prefix` and modified on or in (list) `use_date` using boto3.
 
     Parameters:
     `session` boto3.session.Session()
@@ -171,19 +427,144 @@ def get_objects_with_name_date(session,
         use `prefix` = "" to not filter by name
     `use_date` list[str|datetime.datetime|datetime.date] or str|datetime.datetime|datetime.date
         defaults to None if only the name is needed as a search.
-        Used to retrieve the buckets made on the date given.
+        Used to retrieve the objects modified on the date given.
         if str, must be in the format "year-month-day-hour-minute-second".
             only year, month, and day are required.
-        If you want to check an interval of dates, use a for loop with an f-string for `use_date`.
+        A list of two dates is an interval, a list of [start, end] lists is several intervals,
+        e.g. [["2023-2-1", "2023-2-3"], ["2023-3-1", "2023-3-3"]].
+    `inventory` s3_inventory.Inventory
+        if given, the objects are filtered from this S3 Inventory report of `bucket_name` instead of listed,
+        the result is a snapshot as fresh as the report, see s3_inventory.Inventory.iter_objects_with_name_date().
+        Defaults to None, live listing.
+    `min_size` int
+        only objects of at least `min_size` bytes.
+    `max_size` int
+        only objects of at most `max_size` bytes.
+    `storage_class` str|list[str]
+        only objects in that storage class or one of those storage classes, e.g. "STANDARD_IA".
+    `regex` str
+        only objects whose key contains a match of the regular expression `regex`, e.g. "[.]parquet$".
 
+    The filters are applied to whole listing pages at once, the dates are converted a single time.
     Doesn't throw an indexing error if the prefix is longer than the bucket name.
+    Use iter_objects_with_name_date() to process the matches as they arrive.
+    '''
+    return list(iter_objects_with_name_date(session, bucket_name, object_prefix, use_date, inventory,
+                                            min_size, max_size, storage_class, regex))
+
+
+## object contents
+MiB = 1024**2
+
+def helper_get_range(session, bucket_name:str, object_name:str, start:int, end:int,
+                     etag:str, destination:memoryview = None):
+    '''
+    helper for the download functions, GETs bytes `start` to `end` (exclusive) of an object.
+
+    If `destination` is given the bytes are read straight into it and None is returned, the bytes are returned otherwise.
+    `etag` makes S3 refuse the range if the object changed since the download started.
+    '''
+    body = get_client(session).get_object(Bucket = bucket_name, Key = object_name,
+                                                   Range = f"bytes={start}-{end - 1}", IfMatch = etag)["Body"]
+    with body:
+        if destination is None:
+            return body.read()
+        position = 0
+        while position < len(destination):
+            count = body.readinto(destination[position:])
+            if not count:
+                raise IOError(f"{object_name} range {start}-{end} ended after {position} bytes")
+            position += count
+
+def helper_ranges(size:int, part_size:int):
+    '''helper for the download functions, the (start, end) byte ranges splitting an object of `size` bytes'''
+    return [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+@traced
+def download_object(session, bucket_name:str, object_name:str, destination = None,
+                    part_size:int = 8 * MiB, max_workers:int = 8, verbose:bool = True, etag:str = None):
+    '''
+    Downloads an object with concurrent byte-range GETs written straight into their final place.
+
+    Returns `destination`, or a bytearray holding the object if `destination` is None.
+
+    Every range is read from the socket into its slice of the destination, no part is buffered on the side.
+    All ranges are pinned to the object's ETag, so an object overwritten during the download raises
+    a ClientError (PreconditionFailed) instead of mixing two versions.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the name of the bucket containing the object
+    `object_name` str
+        the key of the object
+    `destination` str|bytearray|mmap.mmap|memoryview
+        a file path: the file is created (or truncated) at the object's size and filled through a memory map.
+        a writable buffer: the object is written at its start, it must be at least as large as the object.
+        defaults to None, a bytearray of the object's size is allocated.
+    `part_size` int
+        the size in bytes of each range GET.
+    `max_workers` int
+        the number of range GETs running at once.
+    `verbose` bool
+        if True, the progress and throughput are printed while downloading.
+    `etag` str
+        if given, the download fails with a ClientError (PreconditionFailed) unless the object has this ETag,
+        e.g. the ETag it was listed with. defaults to None, whatever the object is when the download starts.
+    '''
+    assert isinstance(part_size, int) and part_size > 0, f"Invalid part_size = {part_size}"
+    head = get_client(session).head_object(Bucket = bucket_name, Key = object_name, **({"IfMatch": etag} if etag else {}))
+    size, etag = head["ContentLength"], head["ETag"]
+    progress = ProgressCounter(f"Downloaded {object_name}", size / MiB, unit = "MiB", verbose = verbose)
+
+    def fill(buffer):
+        view = memoryview(buffer)
+        def get_range(byte_range):
+            start, end = byte_range
+            helper_get_range(session, bucket_name, object_name, start, end, etag, view[start:end])
+            progress.add((end - start) / MiB)
+        try:
+            for _ in bounded_map(get_range, helper_ranges(size, part_size), max_workers):
+                pass
+        finally:
+            view.release()
+        progress.close()
+
+    if isinstance(destination, (str, os.PathLike)):
+        with open(destination, "w+b") as file:
+            file.truncate(size)
+            if size:
+                with mmap.mmap(file.fileno(), size) as file_map:
+                    fill(file_map)
+        return destination
+    if destination is None:
+        destination = bytearray(size)
+    assert len(destination) >= size, f"destination holds {len(destination)} bytes, the object has {size}"
+    fill(destination)
+    return destination
+
+@traced
+def iter_object_chunks(session, bucket_name:str, object_name:str, chunk_size:int = 8 * MiB,
+                       max_workers:int = 4):
+    '''
+    Lazily yields the content of an object as consecutive bytes chunks of `chunk_size`.
+
+    The next chunks are fetched concurrently while the current one is processed, with at most
+    `2 * max_workers` chunks held in memory, so objects larger than memory can be streamed.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the name of the bucket containing the object
+    `object_name` str
+        the key of the object
+    `chunk_size` int
+        the size in bytes of the yielded chunks, the last one may be smaller.
+    `max_workers` int
+        the number of chunks fetched at once.
     '''
-    assert isinstance(use_date, (str, list, datetime.date, datetime.datetime)), f"Invalid type(use_date) = {type(use_date)}"
-    # turning use_date into datetime.datetime
-    use_date = helper_date_conversion(use_date)
-    object_list = session.client("s3").list_objects(Bucket = bucket_name,
-                                                    Prefix = object_prefix)["Contents"]
-    #removed from list comprehension to separate boto3 interacting with a loop
-    return [obj for obj
-        in object_list
-        if helper_date_comparison(obj["LastModified"], *use_date)]
\ No newline at end of file
+    assert isinstance(chunk_size, int) and chunk_size > 0, f"Invalid chunk_size = {chunk_size}"
+    head = get_client(session).head_object(Bucket = bucket_name, Key = object_name)
+    yield from bounded_map(
+        lambda byte_range: helper_get_range(session, bucket_name, object_name, *byte_range, head["ETag"]),
+        helper_ranges(head["ContentLength"], chunk_size), max_workers)
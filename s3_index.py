@@ -0,0 +1,301 @@
+from botocore.exceptions import ClientError
+import datetime
+from itertools import groupby
+import os
+import sqlite3
+import threading
+
+from s3_client import get_client
+from s3_generate import gen_python_dict_from_tagging_list, gen_tagging_list_from_python_dict
+from s3_get import helper_fetch_object_tags, helper_list_object_pages
+from s3_metrics import output, traced
+from s3_parallel import bounded_map
+from s3_tagquery import compile_tag_query
+from s3_throttle import get_limiter
+
+# Local SQLite copy of bucket/object listing metadata and tag sets.
+# Objects are keyed by bucket/key and remember the ETag and LastModified they were tagged at,
+# so a refresh only re-fetches the tags of objects whose listing metadata changed.
+# Tag changes do not change an object's ETag or LastModified: tags set outside of s3_set
+# (console, other tools) are only picked up by a refresh with `full=True`.
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER,
+    storage_class TEXT,
+    refresh_id INTEGER,
+    PRIMARY KEY (bucket, key)
+);
+CREATE TABLE IF NOT EXISTS object_tags (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    tag_key TEXT NOT NULL,
+    tag_value TEXT NOT NULL,
+    PRIMARY KEY (bucket, key, tag_key)
+);
+CREATE INDEX IF NOT EXISTS object_tags_inverted ON object_tags (bucket, tag_key, tag_value, key);
+CREATE TABLE IF NOT EXISTS buckets (
+    bucket TEXT PRIMARY KEY,
+    creation_date TEXT
+);
+CREATE TABLE IF NOT EXISTS bucket_tags (
+    bucket TEXT NOT NULL,
+    tag_key TEXT NOT NULL,
+    tag_value TEXT NOT NULL,
+    PRIMARY KEY (bucket, tag_key)
+);
+CREATE INDEX IF NOT EXISTS bucket_tags_inverted ON bucket_tags (tag_key, tag_value, bucket);
+'''
+
+def default_cache_dir() -> str:
+    '''Returns the local cache directory, `$AWS_PROJECT_CACHE_DIR` if set, `~/.cache/aws_project` otherwise'''
+    return os.environ.get("AWS_PROJECT_CACHE_DIR",
+                          os.path.join(os.path.expanduser("~"), ".cache", "aws_project"))
+
+def default_index_path() -> str:
+    '''Returns the default tag index location, inside default_cache_dir()'''
+    return os.path.join(default_cache_dir(), "tag_index.sqlite3")
+
+class TagIndex:
+    '''
+    Persistent local index of S3 bucket and object tags, answers tag queries without calling S3.
+
+    Pass it as `tag_index` to s3_get.get_buckets_with_tags(), s3_get.get_objects_with_tags_from_bucket(),
+    s3_set.add_tags_to_bucket() and s3_set.add_tags_to_object() to refresh, query and update it.
+
+    Parameters:
+    `path` str
+        the SQLite file of the index, created if it does not exist.
+        defaults to None, which is default_index_path().
+    '''
+    def __init__(self, path: str = None):
+        if path is None:
+            path = default_index_path()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok = True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread = False)
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        '''Closes the SQLite connection'''
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def helper_replace_object_tags(self, bucket_name: str, object_name: str, tag_dict: dict):
+        '''helper for TagIndex, replaces the indexed tag set of one object, the lock must be held'''
+        self._connection.execute("DELETE FROM object_tags WHERE bucket = ? AND key = ?",
+                                 (bucket_name, object_name))
+        self._connection.executemany(
+            "INSERT INTO object_tags VALUES (?, ?, ?, ?)",
+            [(bucket_name, object_name, tkey, tval) for tkey, tval in tag_dict.items()])
+
+    def helper_replace_bucket_tags(self, bucket_name: str, tag_dict: dict):
+        '''helper for TagIndex, replaces the indexed tag set of one bucket, the lock must be held'''
+        self._connection.execute("DELETE FROM bucket_tags WHERE bucket = ?", (bucket_name,))
+        self._connection.executemany(
+            "INSERT INTO bucket_tags VALUES (?, ?, ?)",
+            [(bucket_name, tkey, tval) for tkey, tval in tag_dict.items()])
+
+    ## refresh
+    @traced
+    def refresh_objects(self, session, bucket_name: str, object_prefix: str = "",
+                        max_workers: int = 8, full: bool = False) -> dict:
+        '''
+        Updates the index with the objects of `bucket_name` under `object_prefix`.
+
+        Only objects that are new or whose ETag/LastModified changed get their tags fetched,
+        objects that no longer exist are removed from the index.
+        Returns {"Listed": int, "Retagged": int, "Removed": int}
+
+        Parameters:
+        `session` boto3.session.Session()
+        `bucket_name` str
+            the bucket to index
+        `object_prefix` str
+            only objects under this prefix are refreshed, defaults to "", the whole bucket.
+        `max_workers` int
+            the number of concurrent get_object_tagging requests.
+        `full` bool
+            if True, the tags of every object are re-fetched, use it after tags were changed outside of s3_set.
+        '''
+        object_prefix = object_prefix or ""
+        refresh_id = int(datetime.datetime.now().timestamp() * 1e6)
+        listed = retagged = 0
+        for contents in helper_list_object_pages(get_client(session), bucket_name, object_prefix):
+            listed += len(contents)
+            keys = [obj["Key"] for obj in contents]
+            with self._lock:
+                indexed = dict(((key, (etag, last_modified)) for key, etag, last_modified in
+                    self._connection.execute(
+                        f"SELECT key, etag, last_modified FROM objects WHERE bucket = ? "
+                        f"AND key IN ({','.join('?' * len(keys))})", [bucket_name, *keys])))
+            changed = [obj for obj in contents
+                       if full or indexed.get(obj["Key"]) != (obj["ETag"], obj["LastModified"].isoformat())]
+            tagged_objects = list(bounded_map(
+                lambda obj: helper_fetch_object_tags(session, bucket_name, obj), changed, max_workers))
+            retagged += len(tagged_objects)
+            with self._lock, self._connection:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(bucket_name, obj["Key"], obj["ETag"], obj["LastModified"].isoformat(),
+                      obj.get("Size"), obj.get("StorageClass"), refresh_id) for obj in contents])
+                for obj, tag_dict in tagged_objects:
+                    self.helper_replace_object_tags(bucket_name, obj["Key"], tag_dict)
+        with self._lock, self._connection:
+            removed = [key for (key,) in self._connection.execute(
+                "SELECT key FROM objects WHERE bucket = ? AND substr(key, 1, ?) = ? "
+                "AND (refresh_id IS NULL OR refresh_id != ?)",
+                (bucket_name, len(object_prefix), object_prefix, refresh_id))]
+            self._connection.executemany("DELETE FROM objects WHERE bucket = ? AND key = ?",
+                                         [(bucket_name, key) for key in removed])
+            self._connection.executemany("DELETE FROM object_tags WHERE bucket = ? AND key = ?",
+                                         [(bucket_name, key) for key in removed])
+        return {"Listed": listed, "Retagged": retagged, "Removed": len(removed)}
+
+    @traced
+    def refresh_buckets(self, session, full: bool = False) -> dict:
+        '''
+        Updates the index with the account's buckets.
+
+        Only new buckets get their tags fetched, buckets that no longer exist are removed from the index.
+        Returns {"Listed": int, "Retagged": int, "Removed": int}
+
+        Parameters:
+        `session` boto3.session.Session()
+        `full` bool
+            if True, the tags of every bucket are re-fetched, use it after tags were changed outside of s3_set.
+        '''
+        s3_client = get_client(session)
+        bucket_list = s3_client.list_buckets()["Buckets"]
+        with self._lock:
+            indexed = dict(self._connection.execute("SELECT bucket, creation_date FROM buckets"))
+        retagged = 0
+        bucket_tags = {}
+        for bucket in bucket_list:
+            if not full and indexed.get(bucket["Name"]) == bucket["CreationDate"].isoformat():
+                continue
+            try:
+                bucket_tags[bucket["Name"]] = gen_python_dict_from_tagging_list(
+                    get_limiter().call(bucket["Name"], "", s3_client.get_bucket_tagging, Bucket = bucket["Name"])["TagSet"])
+            except ClientError as err:
+                if err.response["Error"]["Code"] == "NoSuchTagSet": bucket_tags[bucket["Name"]] = {}
+                else:
+                    output("Error: ", err.response) #left out of the index so the next refresh retries it
+                    continue
+            retagged += 1
+        names = set(bucket["Name"] for bucket in bucket_list)
+        removed = [name for name in indexed if name not in names]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO buckets VALUES (?, ?)",
+                [(bucket["Name"], bucket["CreationDate"].isoformat()) for bucket in bucket_list
+                 if bucket["Name"] in bucket_tags or bucket["Name"] in indexed])
+            for name, tag_dict in bucket_tags.items():
+                self.helper_replace_bucket_tags(name, tag_dict)
+            self._connection.executemany("DELETE FROM buckets WHERE bucket = ?", [(name,) for name in removed])
+            self._connection.executemany("DELETE FROM bucket_tags WHERE bucket = ?", [(name,) for name in removed])
+        return {"Listed": len(bucket_list), "Retagged": retagged, "Removed": len(removed)}
+
+    ## write-through from s3_set
+    def put_object_tags(self, bucket_name: str, object_name: str, tags: list[dict]):
+        '''
+        Replaces the indexed tag set of an object, called by s3_set after a successful put.
+
+        Objects not in the index yet are added without listing metadata, the next refresh fills it in.
+
+        Parameters:
+        `bucket_name` str
+        `object_name` str
+        `tags` list[dict]
+            the full S3 tag set of the object {"Key":key_arg, "Value":value_arg}
+        '''
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO objects (bucket, key) VALUES (?, ?)",
+                                     (bucket_name, object_name))
+            self.helper_replace_object_tags(bucket_name, object_name, gen_python_dict_from_tagging_list(tags))
+
+    def put_bucket_tags(self, bucket_name: str, tags: list[dict]):
+        '''
+        Replaces the indexed tag set of a bucket, called by s3_set after a successful put.
+
+        Parameters:
+        `bucket_name` str
+        `tags` list[dict]
+            the full S3 tag set of the bucket {"Key":key_arg, "Value":value_arg}
+        '''
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR IGNORE INTO buckets (bucket) VALUES (?)", (bucket_name,))
+            self.helper_replace_bucket_tags(bucket_name, gen_python_dict_from_tagging_list(tags))
+
+    ## queries
+    @traced
+    def query_objects(self, bucket_name: str, tags: dict|str, object_prefix: str = None) -> list[tuple[dict, dict]]:
+        '''
+        Returns the indexed objects of `bucket_name` whose tags match `tags`, in key order.
+
+        Same format as s3_get.get_objects_with_tags_from_bucket(): a list of (object dict, tag dict),
+        the object dicts hold "Key", "ETag", "LastModified", "Size" and "StorageClass".
+
+        Parameters:
+        `bucket_name` str
+        `tags` dict|str|s3_tagquery.TagQuery
+            regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2} that must all be present,
+            or a tag query, evaluated in SQL over the inverted tag index.
+        `object_prefix` str
+            only objects under this prefix are returned.
+        '''
+        object_prefix = object_prefix or ""
+        sql = ("SELECT o.key, o.etag, o.last_modified, o.size, o.storage_class, t.tag_key, t.tag_value "
+               "FROM objects o LEFT JOIN object_tags t ON t.bucket = o.bucket AND t.key = o.key "
+               "WHERE o.bucket = ? AND o.key >= ? AND substr(o.key, 1, ?) = ?")
+        params = [bucket_name, object_prefix, len(object_prefix), object_prefix]
+        tag_sql, tag_params = compile_tag_query(tags).to_sql("o.key", "key", "object_tags", "bucket = ? AND ", [bucket_name])
+        sql += f" AND ({tag_sql}) ORDER BY o.key"
+        params.extend(tag_params)
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        result = []
+        for (key, etag, last_modified, size, storage_class), group in groupby(rows, lambda row: row[:5]):
+            tag_dict = dict((row[5], row[6]) for row in group if row[5] is not None)
+            obj = {"Key": key, "ETag": etag, "Size": size, "StorageClass": storage_class,
+                   "LastModified": datetime.datetime.fromisoformat(last_modified) if last_modified else None}
+            result.append((obj, tag_dict))
+        return result
+
+    @traced
+    def query_buckets(self, tags: dict|str) -> list[tuple[dict, list[dict]]]:
+        '''
+        Returns the indexed buckets whose tags match `tags`, in name order.
+
+        Same format as s3_get.get_buckets_with_tags(): a list of (bucket dict, S3 formatted tag list),
+        the bucket dicts hold "Name" and "CreationDate".
+        Buckets without tags are never returned, like S3 answers NoSuchTagSet for them.
+
+        Parameters:
+        `tags` dict|str|s3_tagquery.TagQuery
+            regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2} that must all be present,
+            or a tag query, evaluated in SQL over the inverted tag index.
+        '''
+        tag_sql, params = compile_tag_query(tags).to_sql("b.bucket", "bucket", "bucket_tags")
+        sql = ("SELECT b.bucket, b.creation_date, t.tag_key, t.tag_value "
+               f"FROM buckets b JOIN bucket_tags t ON t.bucket = b.bucket WHERE ({tag_sql}) ORDER BY b.bucket")
+        with self._lock:
+            rows = self._connection.execute(sql, params).fetchall()
+        result = []
+        for (name, creation_date), group in groupby(rows, lambda row: row[:2]):
+            tag_dict = dict((row[2], row[3]) for row in group)
+            bucket = {"Name": name,
+                      "CreationDate": datetime.datetime.fromisoformat(creation_date) if creation_date else None}
+            result.append((bucket, gen_tagging_list_from_python_dict(tag_dict)))
+        return result
@@ -0,0 +1,257 @@
+import datetime
+import hashlib
+import json
+import math
+import os
+import re
+from urllib import parse
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+# pyarrow must be installed to use this module
+
+from s3_client import get_client
+from s3_get import helper_date_intervals, helper_filter_page, helper_list_object_pages, iter_objects
+from s3_index import default_cache_dir
+from s3_metrics import traced
+from s3_parallel import bounded_map
+
+# S3 Inventory writes a daily or weekly list of every object of a bucket to a destination bucket:
+# <destination prefix>/<source bucket>/<configuration id>/<YYYY-MM-DDTHH-MMZ>/manifest.json
+# lists the data files (gzipped CSV without header, ORC or parquet) and their schema.
+# Reading the report is a few large GETs instead of one list request per 1,000 keys,
+# and the filters run over whole columns at once. The normalized report is cached locally
+# as parquet, keyed by the manifest's checksum, so later queries only read the cache.
+# The cache is written one data file at a time in sorted row groups, and queries read it with the filters
+# pushed down to the row groups, so neither loading nor querying holds the whole report in memory.
+# A report is a snapshot: objects written or deleted after it was made are not in it. Queries can list
+# the prefix live to add the objects modified since the report, deleted objects are only seen in the next report.
+
+CACHE_ROW_GROUP_SIZE = 64 * 1024 #rows per row group of the cached report, the unit of predicate pushdown
+
+COLUMNS = {"Key": "Key", "Size": "Size", "LastModifiedDate": "LastModified", "ETag": "ETag",
+           "StorageClass": "StorageClass"}
+# ORC and parquet reports name their columns in snake case
+COLUMNS_SNAKE_CASE = {"key": "Key", "size": "Size", "last_modified_date": "LastModified", "e_tag": "ETag",
+                      "storage_class": "StorageClass"}
+# reports of versioned buckets list every version, only current versions that are not delete markers are kept
+VERSION_FLAGS = {"IsLatest": True, "IsDeleteMarker": False, "is_latest": True, "is_delete_marker": False}
+CACHE_VERSION = 2 #part of the cache file names, bumped when the cached columns or rows change
+
+@traced
+def find_latest_manifest(session, inventory_bucket_name: str, inventory_prefix: str) -> str:
+    '''
+    Returns the key of the newest manifest.json under `inventory_prefix`.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `inventory_bucket_name` str
+        the destination bucket of the inventory configuration
+    `inventory_prefix` str
+        "<destination prefix>/<source bucket>/<configuration id>/"
+    '''
+    if inventory_prefix and not inventory_prefix.endswith("/"): inventory_prefix += "/"
+    s3_client = get_client(session)
+    #report folders are named by their date, the last one listed is the newest
+    folders = []
+    request = {"Bucket": inventory_bucket_name, "Prefix": inventory_prefix, "Delimiter": "/"}
+    while True:
+        page = s3_client.list_objects_v2(**request)
+        folders.extend(common["Prefix"] for common in page.get("CommonPrefixes", []))
+        if not page.get("IsTruncated"): break
+        request["ContinuationToken"] = page["NextContinuationToken"]
+    for folder in sorted(folders, reverse = True):
+        key = folder + "manifest.json"
+        if any(obj["Key"] == key for obj in iter_objects(session, inventory_bucket_name, key)):
+            return key
+    raise FileNotFoundError(f"No inventory manifest under {inventory_bucket_name}/{inventory_prefix}")
+
+def helper_read_data_file(session, bucket_name: str, file: dict, file_format: str, schema: list[str]) -> pa.Table:
+    '''helper for Inventory, reads one data file of the report into the normalized columns'''
+    body = get_client(session).get_object(Bucket = bucket_name, Key = file["key"])["Body"].read()
+    if file_format == "CSV":
+        table = pa_csv.read_csv(
+            pa.input_stream(pa.BufferReader(body), compression = "gzip" if file["key"].endswith(".gz") else None),
+            read_options = pa_csv.ReadOptions(column_names = schema),
+            convert_options = pa_csv.ConvertOptions(column_types = dict((name, pa.string()) for name in schema)))
+        names = COLUMNS
+    else:
+        if file_format == "ORC":
+            import pyarrow.orc as orc #not in every pyarrow build, only needed for ORC reports
+            table = orc.ORCFile(pa.BufferReader(body)).read()
+        else:
+            table = pq.read_table(pa.BufferReader(body))
+        names = COLUMNS_SNAKE_CASE
+    for name, keep in VERSION_FLAGS.items():
+        if name in table.column_names:
+            flags = table[name]
+            if not pa.types.is_boolean(flags.type): #"true" or "false" in CSV reports
+                flags = pc.equal(pc.utf8_lower(pc.cast(flags, pa.string())), "true")
+            table = table.filter(pc.fill_null(flags if keep else pc.invert(flags), not keep))
+    table = table.select([name for name in table.column_names if name in names])
+    table = table.rename_columns([names[name] for name in table.column_names])
+
+    columns = {}
+    keys = table["Key"]
+    if file_format == "CSV": #CSV keys are url-encoded, only the ones with an escape are decoded
+        escaped = pc.or_(pc.match_substring(keys, "%"), pc.match_substring(keys, "+"))
+        if pc.any(escaped).as_py():
+            keys = pa.array([parse.unquote_plus(key) if needs else key
+                             for key, needs in zip(keys.to_pylist(), escaped.to_pylist())], pa.string())
+    columns["Key"] = pc.cast(keys, pa.string())
+    columns["Size"] = pc.cast(table["Size"], pa.int64()) if "Size" in table.column_names else pa.nulls(len(table), pa.int64())
+    if "LastModified" in table.column_names:
+        #CSV dates are ISO 8601 strings like "2024-01-01T00:00:00.000Z", cast parses them
+        columns["LastModified"] = pc.cast(table["LastModified"], pa.timestamp("ms", tz = "UTC"))
+    else:
+        columns["LastModified"] = pa.nulls(len(table), pa.timestamp("ms", tz = "UTC"))
+    for name in ("ETag", "StorageClass"):
+        columns[name] = pc.cast(table[name], pa.string()) if name in table.column_names else pa.nulls(len(table), pa.string())
+    return pa.table(columns)
+
+class Inventory:
+    '''
+    S3 Inventory report of a bucket, cached as parquet to answer listing queries without listing.
+
+    The report has the columns Key, Size, LastModified (UTC), ETag and StorageClass.
+    Give it to s3_get.get_objects_with_name_date() with `inventory` to filter the report instead of listing.
+    Results are as fresh as the report, made at `created`, unless iter_objects_with_name_date() lists
+    the prefix live. Only the current versions of reports of versioned buckets are kept, without delete markers.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `inventory_bucket_name` str
+        the destination bucket of the inventory configuration
+    `manifest_key` str
+        the key of a manifest.json, or the prefix "<destination prefix>/<source bucket>/<configuration id>/"
+        to use the newest report under it, see find_latest_manifest().
+    `cache_dir` str
+        the local cache directory, defaults to None, which is s3_index.default_cache_dir().
+    `max_workers` int
+        the number of data files downloaded at once.
+    '''
+    def __init__(self, session, inventory_bucket_name: str, manifest_key: str, cache_dir: str = None,
+                 max_workers: int = 16):
+        if not manifest_key.endswith("manifest.json"):
+            manifest_key = find_latest_manifest(session, inventory_bucket_name, manifest_key)
+        self.session = session
+        self.manifest_key = manifest_key
+        manifest_body = get_client(session).get_object(Bucket = inventory_bucket_name, Key = manifest_key)["Body"].read()
+        self.manifest = json.loads(manifest_body)
+        self.bucket_name = self.manifest["sourceBucket"]
+        self.created = datetime.datetime.fromtimestamp(int(self.manifest["creationTimestamp"]) / 1000,
+                                                       datetime.timezone.utc)
+
+        name = hashlib.sha256(f"{CACHE_VERSION}/{inventory_bucket_name}/{manifest_key}".encode() + manifest_body).hexdigest()
+        self.cache_path = os.path.join(cache_dir or default_cache_dir(), "inventories", f"{name}.parquet")
+        if not os.path.exists(self.cache_path):
+            data_bucket = self.manifest["destinationBucket"].split(":::", 1)[-1]
+            file_format = self.manifest["fileFormat"].upper()
+            schema = [column.strip() for column in self.manifest["fileSchema"].split(",")]
+            tables = bounded_map(
+                lambda file: helper_read_data_file(session, data_bucket, file, file_format, schema),
+                self.manifest["files"], max_workers)
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok = True)
+            with pq.ParquetWriter(self.cache_path + ".tmp", helper_cache_schema()) as writer:
+                for table in tables: #sorted per data file, so each row group covers a narrow key range
+                    writer.write_table(table.sort_by("Key"), row_group_size = CACHE_ROW_GROUP_SIZE)
+            os.replace(self.cache_path + ".tmp", self.cache_path)
+        self.num_rows = pq.ParquetFile(self.cache_path).metadata.num_rows
+
+    @property
+    def table(self) -> pa.Table:
+        '''The whole report sorted by Key, read from the cache at every access, filter() reads only the matches'''
+        return pq.read_table(self.cache_path).sort_by("Key")
+
+    def filter(self, object_prefix: str = "", use_date = None, min_size: int = None, max_size: int = None,
+               storage_class: str|list[str] = None, regex: str = None) -> pa.Table:
+        '''
+        Returns the rows of the report matching all the given filters, sorted by Key.
+
+        The filters are pushed down to the cached report: row groups whose statistics cannot match are
+        skipped and only the matching rows of the others are kept in memory.
+
+        Parameters:
+        `object_prefix` str
+            only keys starting with `object_prefix`
+        `use_date` list[str|datetime.datetime|datetime.date] or str|datetime.datetime|datetime.date
+            objects modified on that date, in that [start, end] interval or in one of several intervals,
+            like s3_get.get_objects_with_name_date(). Dates without time zone are UTC. Defaults to None, any date.
+        `min_size` int
+            only objects of at least `min_size` bytes
+        `max_size` int
+            only objects of at most `max_size` bytes
+        `storage_class` str|list[str]
+            only objects in that storage class or one of those storage classes
+        `regex` str
+            only keys containing a match of the regular expression `regex`
+        '''
+        key = pc.field("Key")
+        expression = None
+        def add(condition):
+            nonlocal expression
+            expression = condition if expression is None else expression & condition
+        if object_prefix:
+            #a prefix is a key range, which the row group statistics of the sorted keys can skip
+            add((key >= object_prefix) & (key < object_prefix[:-1] + chr(ord(object_prefix[-1]) + 1)))
+        intervals = helper_date_intervals(use_date)
+        if intervals is not None:
+            in_interval = None
+            for start, end in intervals:
+                condition = ((pc.field("LastModified") >= helper_timestamp(math.ceil(start * 1000))) &
+                             (pc.field("LastModified") <= helper_timestamp(math.floor(end * 1000))))
+                in_interval = condition if in_interval is None else in_interval | condition
+            add(in_interval)
+        if min_size is not None: add(pc.field("Size") >= min_size)
+        if max_size is not None: add(pc.field("Size") <= max_size)
+        if storage_class is not None:
+            add(pc.field("StorageClass").isin([storage_class] if isinstance(storage_class, str) else storage_class))
+        if regex is not None: add(pc.match_substring_regex(key, regex))
+        return pq.read_table(self.cache_path, filters = expression).sort_by("Key")
+
+    def iter_objects_with_name_date(self, session, object_prefix: str = "", use_date = None,
+                                    min_size: int = None, max_size: int = None,
+                                    storage_class: str|list[str] = None, regex: str = None, live: bool = False):
+        '''
+        Lazily yields the object dicts matching the filters, like s3_get.iter_objects_with_name_date().
+
+        By default the result is a snapshot, as fresh as the report made at `created`: objects written since
+        then are missing, objects deleted since then are still yielded, until the next report.
+        With `live`, `object_prefix` is also listed live and the objects modified after the report are added:
+        the report's matches come first, without the keys rewritten since the report, then the matching
+        objects written since the report, in listing order. Deleted objects are still yielded.
+
+        Parameters:
+        `session` boto3.session.Session()
+        `live` bool
+            if True, the prefix is listed live to add the objects written since the report, the listing is
+            skipped when `use_date` ends before the report. The live matches are held in memory until the
+            listing ends.
+        see filter() for the other parameters.
+        '''
+        intervals = helper_date_intervals(use_date)
+        rewritten, newer = set(), []
+        if live and (intervals is None or intervals[:, 1].max() >= self.created.timestamp()):
+            pattern = re.compile(regex) if regex else None
+            for contents in helper_list_object_pages(get_client(session), self.bucket_name, object_prefix):
+                recent = [obj for obj in contents if obj["LastModified"] > self.created]
+                rewritten.update(obj["Key"] for obj in recent)
+                newer.extend(helper_filter_page(recent, intervals, min_size, max_size, storage_class, pattern))
+        table = self.filter(object_prefix, use_date, min_size, max_size, storage_class, regex)
+        for batch in table.to_batches(max_chunksize = 10000):
+            for obj in batch.to_pylist():
+                if obj["Key"] in rewritten: continue
+                if obj["ETag"] and not obj["ETag"].startswith('"'): obj["ETag"] = f'"{obj["ETag"]}"' #as listed
+                yield obj
+        yield from newer
+
+def helper_cache_schema() -> pa.Schema:
+    '''helper for Inventory, the schema of the cached report, the one helper_read_data_file() returns'''
+    return pa.schema([("Key", pa.string()), ("Size", pa.int64()), ("LastModified", pa.timestamp("ms", tz = "UTC")),
+                      ("ETag", pa.string()), ("StorageClass", pa.string())])
+
+def helper_timestamp(milliseconds: int) -> pa.Scalar:
+    '''helper for Inventory.filter(), a LastModified scalar for the pushed down date filters'''
+    return pa.scalar(milliseconds, pa.timestamp("ms", tz = "UTC"))
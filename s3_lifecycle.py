@@ -0,0 +1,455 @@
+from botocore.exceptions import ClientError
+import datetime
+import json
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+# numpy and pyarrow must be installed to use this module
+
+from s3_client import get_client
+from s3_get import iter_objects
+from s3_metrics import output, traced
+from s3_set import merge_lifecycle_rules
+
+# The planner replays lifecycle rules over the listing metadata of a bucket (key, size, LastModified,
+# storage class and, if known, tags) to estimate what they would do before they are applied.
+# Every rule is evaluated over whole columns: its filter is one mask, and each object gets the day it
+# would enter every storage class and the day it would expire. S3 moves objects down the waterfall
+# STANDARD > STANDARD_IA > INTELLIGENT_TIERING > ONEZONE_IA > GLACIER_IR > GLACIER > DEEP_ARCHIVE only,
+# runs a transition or expiration at the first midnight UTC after LastModified + Days, lets an
+# expiration win over a transition, and skips transitions of objects under 128 KiB by default.
+# Costs are then integrated over the time each object spends in each class, so the work is
+# O(objects * storage classes) whatever the horizon, and millions of objects take seconds.
+# Only current versions are listed: noncurrent version rules and aborted multipart uploads are not simulated.
+
+KiB = 1024
+GiB = 1024 ** 3
+MONTH_DAYS = 30 #prices are per GB-month, a simulated month is 30 days
+
+#waterfall order, an object only ever transitions to a class further down
+STORAGE_CLASSES = ("STANDARD", "REDUCED_REDUNDANCY", "STANDARD_IA", "INTELLIGENT_TIERING", "ONEZONE_IA",
+                   "GLACIER_IR", "GLACIER", "DEEP_ARCHIVE")
+
+# us-east-1 list prices, override them with the `prices` of LifecycleSimulator.
+# "Storage": [(days in the class, $ per GiB-month from then on)], INTELLIGENT_TIERING assumes the objects
+#   are not read: frequent tier, infrequent tier after 30 days, archive instant tier after 90 days.
+# "Transition": $ per 1,000 lifecycle transitions into the class
+# "Monitoring": $ per 1,000 objects-month of at least "MinimumSize" bytes, smaller ones stay in the first tier
+# "MinimumDays": objects leaving the class earlier are billed for the remaining days
+# "MinimumSize": smaller objects are billed as "MinimumSize" bytes
+# "Overhead": bytes of index data billed at the class's price, "StandardOverhead" at the STANDARD price
+PRICES = {
+    "STANDARD": {"Storage": [(0, 0.023)], "Transition": 0.0},
+    "REDUCED_REDUNDANCY": {"Storage": [(0, 0.024)], "Transition": 0.0},
+    "STANDARD_IA": {"Storage": [(0, 0.0125)], "Transition": 0.01, "MinimumDays": 30, "MinimumSize": 128 * KiB},
+    "INTELLIGENT_TIERING": {"Storage": [(0, 0.023), (30, 0.0125), (90, 0.004)], "Transition": 0.01,
+                            "Monitoring": 0.0025, "MinimumSize": 128 * KiB},
+    "ONEZONE_IA": {"Storage": [(0, 0.01)], "Transition": 0.01, "MinimumDays": 30, "MinimumSize": 128 * KiB},
+    "GLACIER_IR": {"Storage": [(0, 0.004)], "Transition": 0.02, "MinimumDays": 90, "MinimumSize": 128 * KiB},
+    "GLACIER": {"Storage": [(0, 0.0036)], "Transition": 0.03, "MinimumDays": 90,
+                "Overhead": 32 * KiB, "StandardOverhead": 8 * KiB},
+    "DEEP_ARCHIVE": {"Storage": [(0, 0.00099)], "Transition": 0.05, "MinimumDays": 180,
+                     "Overhead": 32 * KiB, "StandardOverhead": 8 * KiB},
+}
+
+@traced
+def get_lifecycle_rules(session, bucket_name: str) -> list[dict]:
+    '''
+    Returns the rules of `bucket_name`'s lifecycle configuration, [] if it has none.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+    '''
+    try:
+        return get_client(session).get_bucket_lifecycle_configuration(Bucket = bucket_name)["Rules"]
+    except ClientError as err:
+        if err.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
+        return []
+
+def helper_rule_filter(rule: dict) -> tuple[str, list[dict], int, int]:
+    '''helper for LifecycleSimulator.matches(), the (prefix, S3 tags, size greater than, size less than) of `rule`'''
+    rule_filter = rule.get("Filter")
+    if rule_filter is None: #deprecated rule level prefix
+        return rule.get("Prefix", ""), [], None, None
+    conditions = rule_filter.get("And", rule_filter)
+    tags = list(conditions.get("Tags", []))
+    if "Tag" in conditions: tags.append(conditions["Tag"])
+    return (conditions.get("Prefix", ""), tags,
+            conditions.get("ObjectSizeGreaterThan"), conditions.get("ObjectSizeLessThan"))
+
+def helper_days(value) -> float:
+    '''helper for LifecycleSimulator, a lifecycle "Date" (datetime, date or ISO string) in days since the epoch'''
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time(0))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo = datetime.timezone.utc)
+    return value.timestamp() / 86400
+
+class LifecycleSimulator:
+    '''
+    Columns of listing metadata the lifecycle rules are simulated over, see simulate() and compare().
+
+    Parameters:
+    `objects` pyarrow.Table or iterable of dict or of (dict, dict)
+        the objects: a table with the columns Key, Size, LastModified and StorageClass like
+        s3_inventory.Inventory.table, listed object dicts like s3_get.iter_objects() yields, or
+        (object dict, tag dict) pairs like s3_index.TagIndex.query_objects() returns.
+    `tags` dict
+        {key: tag dict} of the objects, needed by rules filtering on tags when `objects` has no tags.
+    `now` datetime.datetime
+        the start of the simulation, defaults to None, the current time.
+    `min_transition_size` int
+        objects smaller than this are not transitioned by rules without size filter, like S3's default
+        TransitionDefaultMinimumObjectSize. 0 transitions every object.
+    `prices` dict
+        {storage class: price dict} replacing entries of PRICES, e.g. for another region.
+    '''
+    def __init__(self, objects, tags: dict = None, now: datetime.datetime = None,
+                 min_transition_size: int = 128 * KiB, prices: dict = None):
+        if not isinstance(objects, pa.Table):
+            columns = {"Key": [], "Size": [], "LastModified": [], "StorageClass": []}
+            object_tags = []
+            for obj in objects:
+                if isinstance(obj, tuple):
+                    obj, tag_dict = obj
+                    object_tags.append(tag_dict)
+                for name, values in columns.items():
+                    values.append(obj.get(name))
+            if object_tags and tags is None:
+                tags = dict(zip(columns["Key"], object_tags))
+            objects = pa.table({"Key": pa.array(columns["Key"], pa.string()),
+                                "Size": pa.array(columns["Size"], pa.int64()),
+                                "LastModified": pa.array(columns["LastModified"], pa.timestamp("ms", tz = "UTC")),
+                                "StorageClass": pa.array(columns["StorageClass"], pa.string())})
+        self.keys = pc.cast(objects["Key"], pa.string())
+        self.sizes = pc.fill_null(pc.cast(objects["Size"], pa.int64()), 0).to_numpy().astype(np.float64)
+        milliseconds = pc.cast(pc.cast(objects["LastModified"], pa.timestamp("ms")), pa.int64())
+        self.modified = pc.fill_null(milliseconds, 0).to_numpy() / 86400000.0 #days since the epoch
+        #unknown storage classes are billed and transitioned like STANDARD
+        ranks = pc.index_in(pc.fill_null(pc.cast(objects["StorageClass"], pa.string()), "STANDARD"),
+                            value_set = pa.array(STORAGE_CLASSES))
+        self.ranks = pc.fill_null(ranks, 0).to_numpy().astype(np.int8)
+        self.now = helper_days(now or datetime.datetime.now(datetime.timezone.utc))
+        self.min_transition_size = min_transition_size
+        self.prices = PRICES | (prices or {})
+        self.tags = tags
+        self._tag_columns = {}
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.sizes)
+
+    @classmethod
+    @traced
+    def from_bucket(cls, session, bucket_name: str, object_prefix: str = "", inventory = None,
+                    tag_index = None, **kwargs) -> "LifecycleSimulator":
+        '''
+        Returns the simulator of the objects of `bucket_name` under `object_prefix`.
+
+        Parameters:
+        `session` boto3.session.Session()
+        `bucket_name` str
+        `object_prefix` str
+        `inventory` s3_inventory.Inventory
+            if given, the objects are read from the report instead of being listed.
+        `tag_index` s3_index.TagIndex
+            if given, it is refreshed for `object_prefix` and provides the objects' tags,
+            only needed by rules filtering on tags.
+        the other parameters are the ones of LifecycleSimulator.
+        '''
+        tags = None
+        if tag_index is not None:
+            tag_index.refresh_objects(session, bucket_name, object_prefix)
+            pairs = tag_index.query_objects(bucket_name, {}, object_prefix)
+            if inventory is None:
+                return cls(pairs, **kwargs)
+            tags = dict((obj["Key"], tag_dict) for obj, tag_dict in pairs)
+        if inventory is not None:
+            return cls(inventory.filter(object_prefix), tags = tags, **kwargs)
+        return cls(iter_objects(session, bucket_name, object_prefix), tags = tags, **kwargs)
+
+    def helper_tag_column(self, tag_key: str) -> pa.Array:
+        '''helper for matches(), the values of the tag `tag_key` of every object, null if it does not have it'''
+        column = self._tag_columns.get(tag_key)
+        if column is None:
+            column = self._tag_columns[tag_key] = pa.array(
+                [(self.tags.get(key) or {}).get(tag_key) for key in self.keys.to_pylist()], pa.string())
+        return column
+
+    def matches(self, rule: dict) -> np.ndarray:
+        '''
+        Returns the boolean mask of the objects `rule`'s filter applies to, all False if the rule is disabled.
+
+        Parameters:
+        `rule` dict
+            an S3 formatted lifecycle rule
+        '''
+        name = json.dumps(rule, sort_keys = True, default = str)
+        mask = self._masks.get(name)
+        if mask is not None:
+            return mask
+        mask = np.full(len(self), rule.get("Status", "Enabled") == "Enabled")
+        prefix, tags, greater_than, less_than = helper_rule_filter(rule)
+        if prefix:
+            mask &= pc.starts_with(self.keys, prefix).to_numpy(zero_copy_only = False)
+        if greater_than is not None: mask &= self.sizes > greater_than
+        if less_than is not None: mask &= self.sizes < less_than
+        if tags:
+            assert self.tags is not None, f"Rule {rule.get('ID')} filters on tags, give the simulator the objects' tags"
+            for tag in tags:
+                equal = pc.equal(self.helper_tag_column(tag["Key"]), tag["Value"])
+                mask &= pc.fill_null(equal, False).to_numpy(zero_copy_only = False)
+        self._masks[name] = mask
+        return mask
+
+    def helper_event_day(self, action: dict, mask: np.ndarray) -> np.ndarray:
+        '''helper for schedule(), the simulation day `action` (a transition or expiration) happens to each object'''
+        days = np.full(len(self), np.inf)
+        if "Days" in action:
+            #S3 rounds LastModified + Days up to the next midnight UTC
+            days[mask] = np.ceil(self.modified[mask] + action["Days"]) - self.now
+        elif "Date" in action:
+            days[mask] = helper_days(action["Date"]) - self.now
+        return np.maximum(days, 0)
+
+    def schedule(self, rules: list[dict]) -> dict:
+        '''
+        Returns when `rules` move every object, as arrays of simulation days (inf: never):
+        {"Enter": {storage class: day the object enters it}, "Expire": day it expires,
+         "EnterRule": {storage class: index of the rule}, "ExpireRule": index of the rule}
+        The objects' current class is entered on day 0, the earliest matching rule wins.
+
+        Parameters:
+        `rules` list[dict]
+            S3 formatted lifecycle rules
+        '''
+        n = len(self)
+        expire, expire_rule = np.full(n, np.inf), np.full(n, -1, np.int16)
+        enter, enter_rule = {}, {}
+        for index, rule in enumerate(rules):
+            mask = self.matches(rule)
+            if not mask.any(): continue
+            if "Expiration" in rule:
+                days = self.helper_event_day(rule["Expiration"], mask)
+                earlier = days < expire
+                expire[earlier], expire_rule[earlier] = days[earlier], index
+            *_, greater_than, less_than = helper_rule_filter(rule)
+            transition_mask = mask
+            if greater_than is None and less_than is None and self.min_transition_size:
+                transition_mask = mask & (self.sizes >= self.min_transition_size)
+            for transition in rule.get("Transitions", []):
+                storage_class = transition["StorageClass"].upper()
+                assert storage_class in STORAGE_CLASSES, f"Invalid transition StorageClass = {storage_class}"
+                rank = STORAGE_CLASSES.index(storage_class)
+                days = self.helper_event_day(transition, transition_mask & (self.ranks < rank))
+                if storage_class not in enter:
+                    enter[storage_class] = np.full(n, np.inf)
+                    enter_rule[storage_class] = np.full(n, -1, np.int16)
+                earlier = days < enter[storage_class]
+                enter[storage_class][earlier], enter_rule[storage_class][earlier] = days[earlier], index
+        for storage_class, days in enter.items():
+            days[days >= expire] = np.inf #an expiration wins over a transition of the same day or later
+        for rank, storage_class in enumerate(STORAGE_CLASSES):
+            current = np.where(self.ranks == rank, 0.0, np.inf)
+            if storage_class in enter:
+                current = np.minimum(current, enter[storage_class])
+            enter[storage_class] = current
+        return {"Enter": enter, "Expire": expire, "EnterRule": enter_rule, "ExpireRule": expire_rule}
+
+    def helper_stays(self, schedule: dict) -> dict:
+        '''helper for simulate(), {storage class: (start, end)} of the days each object spends in the class'''
+        stays = {}
+        end = schedule["Expire"]
+        #walking up the waterfall, a class is left when a later class is entered
+        for storage_class in reversed(STORAGE_CLASSES):
+            start = schedule["Enter"][storage_class]
+            occupied = start < end
+            stays[storage_class] = (np.where(occupied, start, np.inf), np.where(occupied, end, np.inf))
+            end = np.where(occupied, start, end)
+        return stays
+
+    def helper_storage_cost(self, storage_class: str, start: np.ndarray, end: np.ndarray,
+                            first: float, last: float) -> tuple[float, float]:
+        '''helper for simulate(), the (storage, monitoring) cost of the stays [start, end) within the days [first, last)'''
+        price = self.prices[storage_class]
+        sizes = np.maximum(self.sizes, price.get("MinimumSize", 0)) + price.get("Overhead", 0)
+        tiered = self.sizes >= price.get("MinimumSize", 0)
+        low, high = np.maximum(start, first), np.minimum(end, last)
+        days = np.maximum(high - low, 0)
+        if not days.any():
+            return 0.0, 0.0
+        #untiered objects spend all their days in the first tier
+        bounds = [tier_start for tier_start, _ in price["Storage"]] + [np.inf]
+        cost = 0.0
+        for index, (_, tier_price) in enumerate(price["Storage"]):
+            if index == 0:
+                tier_low, tier_high = start, np.where(tiered, start + bounds[1], np.inf)
+            else:
+                tier_low, tier_high = np.where(tiered, start + bounds[index], np.inf), start + bounds[index + 1]
+            tier_days = np.maximum(np.minimum(high, tier_high) - np.maximum(low, tier_low), 0)
+            cost += float(tier_days @ sizes) / GiB / MONTH_DAYS * tier_price
+        cost += float(days.sum()) * price.get("StandardOverhead", 0) / GiB / MONTH_DAYS \
+            * self.prices["STANDARD"]["Storage"][0][1]
+        monitoring = float(days[tiered].sum()) / MONTH_DAYS / 1000 * price.get("Monitoring", 0.0)
+        return cost, monitoring
+
+    @traced
+    def simulate(self, rules: list[dict], horizon_days: int = 365, period_days: int = 30) -> dict:
+        '''
+        Returns what `rules` would do to the objects over the next `horizon_days` days.
+
+        {"Periods": [{"Day", "Days", "Objects": {storage class: count at the end of the period},
+                      "Bytes": {storage class: bytes at the end}, "Transitions": {storage class: count},
+                      "Expirations", "ExpiredBytes", "StorageCost", "MonitoringCost", "TransitionCost",
+                      "EarlyDeletionCost", "Cost"}],
+         "Rules": [{"ID", "Objects", "Bytes", "Transitions", "Expirations"} matched and acted on per rule],
+         "Totals": same fields as a period over the whole horizon}
+        Costs are in dollars at `prices`, transitions are counted once per storage class entered,
+        early deletion is charged when an object leaves a class before its "MinimumDays"
+        (objects already in a class count their days since LastModified).
+
+        Parameters:
+        `rules` list[dict]
+            S3 formatted lifecycle rules, e.g. get_lifecycle_rules() or helper_lifecycle()["Rules"].
+        `horizon_days` int
+            the number of simulated days.
+        `period_days` int
+            the length in days of the reported periods.
+        '''
+        assert horizon_days > 0 and period_days > 0, "Invalid horizon_days or period_days"
+        schedule = self.schedule(rules)
+        stays = self.helper_stays(schedule)
+        expire = schedule["Expire"]
+        #most classes are never entered, their columns are skipped
+        occupied = set(storage_class for storage_class, (start, _) in stays.items() if (start < horizon_days).any())
+        periods = []
+        for first in range(0, horizon_days, period_days):
+            last = min(first + period_days, horizon_days)
+            period = {"Day": first, "Days": last - first, "Objects": {}, "Bytes": {}, "Transitions": {},
+                      "StorageCost": 0.0, "MonitoringCost": 0.0, "TransitionCost": 0.0, "EarlyDeletionCost": 0.0}
+            for rank, storage_class in enumerate(STORAGE_CLASSES):
+                if storage_class not in occupied:
+                    period["Objects"][storage_class] = period["Bytes"][storage_class] = 0
+                    period["Transitions"][storage_class] = 0
+                    continue
+                start, end = stays[storage_class]
+                present = (start <= last) & (end > last)
+                period["Objects"][storage_class] = int(present.sum())
+                period["Bytes"][storage_class] = int(self.sizes[present].sum())
+                storage, monitoring = self.helper_storage_cost(storage_class, start, end, first, last)
+                period["StorageCost"] += storage
+                period["MonitoringCost"] += monitoring
+                transitioned = (self.ranks != rank) & (start >= first) & (start < last)
+                period["Transitions"][storage_class] = int(transitioned.sum())
+                period["TransitionCost"] += period["Transitions"][storage_class] / 1000 \
+                    * self.prices[storage_class]["Transition"]
+                minimum_days = self.prices[storage_class].get("MinimumDays", 0)
+                if minimum_days:
+                    #objects already in the class entered it when they were last modified
+                    entered = np.where(self.ranks == rank, self.modified - self.now, start)
+                    left = (end >= first) & (end < last)
+                    left[left] = end[left] - entered[left] < minimum_days
+                    sizes = np.maximum(self.sizes[left], self.prices[storage_class].get("MinimumSize", 0))
+                    remaining = minimum_days - (end[left] - entered[left])
+                    period["EarlyDeletionCost"] += float(remaining @ sizes) / GiB / MONTH_DAYS \
+                        * self.prices[storage_class]["Storage"][0][1]
+            expired = (expire >= first) & (expire < last)
+            period["Expirations"] = int(expired.sum())
+            period["ExpiredBytes"] = int(self.sizes[expired].sum())
+            period["Cost"] = (period["StorageCost"] + period["MonitoringCost"] + period["TransitionCost"]
+                              + period["EarlyDeletionCost"])
+            periods.append(period)
+
+        totals = {"Day": 0, "Days": horizon_days, "Objects": dict(periods[-1]["Objects"]),
+                  "Bytes": dict(periods[-1]["Bytes"])}
+        totals["Transitions"] = dict((storage_class, sum(period["Transitions"][storage_class] for period in periods))
+                                     for storage_class in STORAGE_CLASSES)
+        for name in ("Expirations", "ExpiredBytes", "StorageCost", "MonitoringCost", "TransitionCost",
+                     "EarlyDeletionCost", "Cost"):
+            totals[name] = sum(period[name] for period in periods)
+
+        report_rules = []
+        for index, rule in enumerate(rules):
+            mask = self.matches(rule)
+            transitions = sum(int(((schedule["EnterRule"][storage_class] == index) & (stays[storage_class][0] < horizon_days)).sum())
+                              for storage_class in schedule["EnterRule"])
+            report_rules.append({"ID": rule.get("ID"), "Objects": int(mask.sum()), "Bytes": int(self.sizes[mask].sum()),
+                                 "Transitions": transitions,
+                                 "Expirations": int(((schedule["ExpireRule"] == index) & (expire < horizon_days)).sum())})
+        return {"Periods": periods, "Rules": report_rules, "Totals": totals}
+
+    def compare(self, plans: dict, horizon_days: int = 365, period_days: int = 30) -> dict:
+        '''
+        Returns {plan name: simulate() totals with "Savings"}, the savings being relative to keeping no rules.
+
+        Parameters:
+        `plans` dict
+            {plan name: list of S3 formatted rules}, e.g. {"ia-30": [...], "onezone-30": [...]}
+        `horizon_days` int
+        `period_days` int
+            see simulate()
+        '''
+        baseline = self.simulate([], horizon_days, period_days)["Totals"]["Cost"]
+        result = {}
+        for name, rules in plans.items():
+            totals = self.simulate(rules, horizon_days, period_days)["Totals"]
+            totals["Savings"] = baseline - totals["Cost"]
+            result[name] = totals
+        return result
+
+@traced
+def plan_bucket_lifecycle(session, bucket_name: str, rules: list[dict], object_prefix: str = "",
+                          inventory = None, tag_index = None, horizon_days: int = 365, period_days: int = 30,
+                          apply: bool = False, expected_owner: str = None, verbose: bool = True) -> dict:
+    '''
+    Simulates `bucket_name`'s current lifecycle rules and the same rules merged with `rules`, and applies
+    the merged rules if `apply` is True.
+
+    Returns {"Rules": merged rules, "Current": simulate() result, "Planned": simulate() result,
+             "Savings": dollars saved over the horizon, "Applied": bool}
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+    `rules` list[dict]
+        the S3 formatted rules to add, a rule replaces the existing rule with its ID, see s3_set.merge_lifecycle_rules()
+    `object_prefix` str
+        only the objects under this prefix are simulated, defaults to "", the whole bucket.
+    `inventory` s3_inventory.Inventory
+    `tag_index` s3_index.TagIndex
+        see LifecycleSimulator.from_bucket()
+    `horizon_days` int
+    `period_days` int
+        see LifecycleSimulator.simulate()
+    `apply` bool
+        if True, the merged rules are put as the bucket's lifecycle configuration when they differ from the current ones.
+    `expected_owner` str
+        The account ID of the S3 bucket's expected owner. Unnecessary if you are the bucket owner.
+    `verbose` bool
+        if True, the current and planned costs are printed.
+    '''
+    current_rules = get_lifecycle_rules(session, bucket_name)
+    merged_rules = merge_lifecycle_rules(current_rules, rules)
+    simulator = LifecycleSimulator.from_bucket(session, bucket_name, object_prefix, inventory, tag_index)
+    current = simulator.simulate(current_rules, horizon_days, period_days)
+    planned = simulator.simulate(merged_rules, horizon_days, period_days)
+    savings = current["Totals"]["Cost"] - planned["Totals"]["Cost"]
+    if verbose:
+        output(f"{bucket_name}/{object_prefix}: {len(simulator)} objects over {horizon_days} days, "
+               f"current rules ${current['Totals']['Cost']:.2f}, planned rules ${planned['Totals']['Cost']:.2f}, "
+               f"savings ${savings:.2f}")
+        for report in planned["Rules"]:
+            output(f"\t{report['ID']}: {report['Objects']} objects, {report['Transitions']} transitions, "
+                   f"{report['Expirations']} expirations")
+    applied = False
+    if apply and merged_rules != current_rules:
+        request = {"Bucket": bucket_name, "LifecycleConfiguration": {"Rules": merged_rules}}
+        if expected_owner: request["ExpectedBucketOwner"] = expected_owner
+        get_client(session).put_bucket_lifecycle_configuration(**request)
+        applied = True
+    return {"Rules": merged_rules, "Current": current, "Planned": planned, "Savings": savings, "Applied": applied}
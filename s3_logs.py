@@ -0,0 +1,256 @@
+from datetime import datetime, timedelta
+import hashlib
+import io
+import json
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+# pyarrow must be installed to use this module
+
+from s3_client import get_client
+from s3_generate import upload_object
+from s3_get import iter_objects
+from s3_index import default_cache_dir
+from s3_metrics import traced
+from s3_parallel import bounded_map, chunked, ProgressCounter
+from s3_throttle import get_limiter
+
+# Server access logs are delivered as many small text objects, one record per line:
+# bucket_owner bucket [time] remote_ip requester request_id operation key "request_uri" http_status
+# error_code bytes_sent object_size total_time turn_around_time "referer" "user_agent" version_id
+# host_id signature_version cipher_suite authentication_type host_header tls_version ...
+# "-" marks a missing value. Log keys are [prefix][YYYY/MM/DD/]YYYY-MM-DD-HH-MM-SS-<random suffix>
+# with their delivery time in UTC, but logs of the same second sort by their random suffix and
+# logs can arrive late, so a later log can list before the last processed key. The checkpoint keeps
+# the keys processed during the last `overlap` seconds and the next run lists from that far back.
+
+LOG_PATTERN = (
+    r'^(?P<bucket_owner>\S+) (?P<bucket>\S+) \[(?P<time>[^\]]+)\] (?P<remote_ip>\S+) (?P<requester>\S+) '
+    r'(?P<request_id>\S+) (?P<operation>\S+) (?P<key>\S+) "(?P<request_uri>[^"]*)" (?P<http_status>\S+) '
+    r'(?P<error_code>\S+) (?P<bytes_sent>\S+) (?P<object_size>\S+) (?P<total_time>\S+) (?P<turn_around_time>\S+) '
+    r'"(?P<referer>[^"]*)" "(?P<user_agent>[^"]*)" (?P<version_id>\S+)'
+    r'(?: (?P<host_id>\S+) (?P<signature_version>\S+) (?P<cipher_suite>\S+) (?P<authentication_type>\S+) '
+    r'(?P<host_header>\S+) (?P<tls_version>\S+))?'
+)
+INTEGER_COLUMNS = ("http_status", "bytes_sent", "object_size", "total_time", "turn_around_time")
+TIME_FORMAT = "%d/%b/%Y:%H:%M:%S %z"
+KEY_TIME_FORMAT = "%Y-%m-%d-%H-%M-%S"
+
+@traced
+def parse_access_logs(text: str|bytes|list[str]) -> pa.Table:
+    '''
+    Parses server access log records into a pyarrow Table with one row per request.
+
+    The lines are matched with one regular expression over the whole batch in pyarrow, no python loop per line.
+    Lines that are not log records are dropped. "-" becomes null, `time` is a UTC timestamp,
+    `http_status`, `bytes_sent`, `object_size`, `total_time` and `turn_around_time` (milliseconds) are integers
+    and `date` ("YYYY-MM-DD") is added for partitioning. `key` stays url-encoded like in the logs.
+
+    Parameters:
+    `text` str|bytes|list[str]
+        the content of one or more log objects, or their lines
+    '''
+    if isinstance(text, bytes): text = text.decode("utf-8", errors = "replace")
+    lines = pa.array(text.splitlines() if isinstance(text, str) else text, pa.string())
+    lines = lines.filter(pc.match_substring_regex(lines, LOG_PATTERN))
+    fields = pc.extract_regex(lines, LOG_PATTERN)
+    columns = {}
+    for i in range(fields.type.num_fields):
+        column = fields.field(i)
+        #unmatched optional fields are "" and missing values "-"
+        columns[fields.type.field(i).name] = pc.if_else(pc.is_in(column, pa.array(["-", ""])),
+                                                        pa.scalar(None, pa.string()), column)
+    for name in INTEGER_COLUMNS:
+        columns[name] = pc.cast(columns[name], pa.int64())
+    columns["time"] = pc.strptime(columns["time"], format = TIME_FORMAT, unit = "ms")
+    columns["date"] = pc.strftime(columns["time"], format = "%Y-%m-%d")
+    return pa.table(columns)
+
+def helper_checkpoint_path(cache_dir: str) -> str:
+    '''helper for log functions, the local JSON file with the checkpoint of every logging prefix'''
+    return os.path.join(cache_dir, "access_log_checkpoints.json")
+
+def helper_key_time(key: str) -> datetime|None:
+    '''helper for log functions, the delivery time in a log key, None if the key has none'''
+    try:
+        return datetime.strptime(key.rsplit("/", 1)[-1][:19], KEY_TIME_FORMAT)
+    except ValueError:
+        return None
+
+def helper_listing_start(checkpoint: dict, overlap: int) -> str|None:
+    '''
+    helper for ingest_access_logs(), the key to list after: `overlap` seconds before the last processed log.
+    Date partitioned prefixes (.../YYYY/MM/DD/) are moved back with the time.
+    '''
+    last_key = checkpoint.get("LastKey")
+    last_time = helper_key_time(last_key or "")
+    if last_time is None:
+        return last_key
+    start = last_time - timedelta(seconds = overlap)
+    directory = last_key[:last_key.rfind("/") + 1]
+    if directory.endswith(last_time.strftime("%Y/%m/%d/")):
+        directory = directory[:-len("YYYY/MM/DD/")] + start.strftime("%Y/%m/%d/")
+    return directory + start.strftime(KEY_TIME_FORMAT)
+
+def read_checkpoint(logging_bucket_name: str, logging_prefix: str, cache_dir: str = None) -> dict:
+    '''
+    Returns the checkpoint of `logging_prefix` in `logging_bucket_name`, {} if nothing was processed.
+
+    Returns {"LastKey": the last processed log key, "Recent": the keys processed during the overlap window before it}
+
+    Parameters:
+    `logging_bucket_name` str
+    `logging_prefix` str
+    `cache_dir` str
+        the local cache directory, defaults to None, which is s3_index.default_cache_dir().
+    '''
+    path = helper_checkpoint_path(cache_dir or default_cache_dir())
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        checkpoint = json.load(file).get(f"{logging_bucket_name}/{logging_prefix}") or {}
+    #checkpoints of older versions were the last key only
+    return {"LastKey": checkpoint, "Recent": []} if isinstance(checkpoint, str) else checkpoint
+
+def write_checkpoint(logging_bucket_name: str, logging_prefix: str, checkpoint: dict, cache_dir: str = None):
+    '''
+    Saves `checkpoint` as the checkpoint of `logging_prefix` in `logging_bucket_name`.
+
+    Parameters:
+    `logging_bucket_name` str
+    `logging_prefix` str
+    `checkpoint` dict
+        {"LastKey": the last processed log key, "Recent": the keys processed during the overlap window before it}
+    `cache_dir` str
+        the local cache directory, defaults to None, which is s3_index.default_cache_dir().
+    '''
+    path = helper_checkpoint_path(cache_dir or default_cache_dir())
+    checkpoints = {}
+    if os.path.exists(path):
+        with open(path) as file:
+            checkpoints = json.load(file)
+    checkpoints[f"{logging_bucket_name}/{logging_prefix}"] = checkpoint
+    os.makedirs(os.path.dirname(path), exist_ok = True)
+    with open(path + ".tmp", "w") as file: #replaced atomically, a crash never leaves half a checkpoint
+        json.dump(checkpoints, file, indent = 1)
+    os.replace(path + ".tmp", path)
+
+@traced
+def ingest_access_logs(session, logging_bucket_name: str, logging_prefix: str, output_bucket_name: str,
+                       output_prefix: str, batch_size: int = 1000, max_workers: int = 32, overlap: int = 600,
+                       start_after: str = None, cache_dir: str = None, verbose: bool = True) -> dict:
+    '''
+    Converts the server access logs delivered since the last run to parquet files partitioned by day.
+
+    Returns {"Processed": number of log objects, "Rows": number of requests, "Written": list of keys,
+             "Checkpoint": last processed log key}
+
+    The log objects are listed from `overlap` seconds before the checkpoint, the ones already processed
+    are skipped and the new ones are handled `batch_size` at a time:
+    downloaded concurrently, parsed together by parse_access_logs() and written as one parquet file
+    per day at `output_prefix`date=YYYY-MM-DD/<batch id>.parquet, which compacts thousands of small logs
+    into a few files. The checkpoint moves after every written batch, so an interrupted run resumes
+    where it stopped and running again only reads the logs delivered since.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `logging_bucket_name` str
+        the bucket the logs are delivered to, see s3_set.set_bucket_server_access_logging_on()
+    `logging_prefix` str
+        the logs' path prefix, e.g. "melon_bucket/"
+    `output_bucket_name` str
+        the bucket the parquet files are written to
+    `output_prefix` str
+        the path prefix of the parquet files, e.g. "access-logs/melon/"
+    `batch_size` int
+        the number of log objects compacted together.
+    `max_workers` int
+        the number of log objects downloaded at once.
+    `overlap` int
+        how many seconds before the last processed log the listing starts, to catch the logs delivered
+        in the same second with a lower random suffix or delivered late.
+    `start_after` str
+        the log key to start after, defaults to None, the saved checkpoint.
+    `cache_dir` str
+        the local cache directory holding the checkpoint, defaults to None, which is s3_index.default_cache_dir().
+    `verbose` bool
+        if True, the progress and throughput are printed while ingesting.
+    '''
+    checkpoint = read_checkpoint(logging_bucket_name, logging_prefix, cache_dir)
+    if start_after is None:
+        start_after = helper_listing_start(checkpoint, overlap)
+        recent = set(checkpoint.get("Recent", []))
+    else:
+        checkpoint, recent = {"LastKey": start_after}, set()
+    result = {"Processed": 0, "Rows": 0, "Written": [], "Checkpoint": checkpoint.get("LastKey")}
+    progress = ProgressCounter(f"Ingested logs of {logging_bucket_name}/{logging_prefix}",
+                               unit = "logs", verbose = verbose)
+
+    def download(obj):
+        return get_limiter().call(logging_bucket_name, obj["Key"], lambda: get_client(session).get_object(
+            Bucket = logging_bucket_name, Key = obj["Key"])["Body"].read())
+
+    new_objects = (obj for obj in iter_objects(session, logging_bucket_name, logging_prefix, start_after)
+                   if obj["Key"] not in recent)
+    for batch in chunked(new_objects, batch_size):
+        texts = list(bounded_map(download, batch, max_workers))
+        table = parse_access_logs(b"\n".join(texts))
+        batch_id = hashlib.sha256(batch[-1]["Key"].encode()).hexdigest()[:16]
+        for date in pc.unique(table["date"]).to_pylist() if table.num_rows else []:
+            buffer = io.BytesIO()
+            pq.write_table(table.filter(pc.equal(table["date"], date)).drop_columns(["date"]), buffer,
+                           compression = "zstd")
+            key = f"{output_prefix}date={date}/{batch_id}.parquet"
+            buffer.seek(0)
+            upload_object(session, output_bucket_name, key, buffer, verbose = False)
+            result["Written"].append(key)
+        #late logs can list before the checkpoint, it only moves forward
+        last_key = max(filter(None, (checkpoint.get("LastKey"), batch[-1]["Key"])))
+        last_time = helper_key_time(last_key)
+        recent.update(obj["Key"] for obj in batch)
+        if last_time is not None:
+            recent = {key for key in recent
+                      if (helper_key_time(key) or last_time) >= last_time - timedelta(seconds = overlap)}
+        checkpoint = {"LastKey": last_key, "Recent": sorted(recent)}
+        write_checkpoint(logging_bucket_name, logging_prefix, checkpoint, cache_dir)
+        result["Processed"] += len(batch)
+        result["Rows"] += table.num_rows
+        result["Checkpoint"] = last_key
+        progress.add(len(batch))
+    progress.close()
+    return result
+
+@traced
+def summarize_access_logs(table: pa.Table, top: int = 20) -> dict:
+    '''
+    Returns the hot keys and slow operations of parsed access logs.
+
+    Returns {"HotKeys": pa.Table, "Operations": pa.Table}
+    "HotKeys" has the `top` keys with the most requests: key, requests, bytes_sent.
+    "Operations" has per operation: requests, errors (http_status >= 400), bytes_sent,
+    mean and max total_time, sorted by max total_time.
+
+    Parameters:
+    `table` pa.Table
+        requests from parse_access_logs() or read back from the ingested parquet files
+    `top` int
+        the number of hot keys
+    '''
+    names = {"key_count": "requests", "operation_count": "requests", "is_error_sum": "errors",
+             "bytes_sent_sum": "bytes_sent", "total_time_mean": "mean_total_time", "total_time_max": "max_total_time"}
+    def renamed(aggregated):
+        return aggregated.rename_columns([names.get(name, name) for name in aggregated.column_names])
+
+    table = table.append_column("is_error", pc.cast(pc.greater_equal(table["http_status"], 400), pa.int64()))
+    hot_keys = (renamed(table.filter(pc.is_valid(table["key"]))
+                        .group_by("key").aggregate([("key", "count"), ("bytes_sent", "sum")]))
+                .sort_by([("requests", "descending")]).slice(0, top)
+                .select(["key", "requests", "bytes_sent"]))
+    operations = (renamed(table.group_by("operation")
+                          .aggregate([("operation", "count"), ("is_error", "sum"), ("bytes_sent", "sum"),
+                                      ("total_time", "mean"), ("total_time", "max")]))
+                  .sort_by([("max_total_time", "descending")])
+                  .select(["operation", "requests", "errors", "bytes_sent", "mean_total_time", "max_total_time"]))
+    return {"HotKeys": hot_keys, "Operations": operations}
@@ -0,0 +1,384 @@
+import bisect
+import contextlib
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import logging
+import threading
+import time
+
+# In-process instrumentation of the S3 calls made by every module.
+# s3_client attaches instrument_client() to each pooled client, whose botocore event hooks record
+# per operation: call latency histogram, calls, errors, retries, throttles (503 and SlowDown-like codes)
+# and bytes sent/received. Public functions are wrapped in tracing spans with @traced, their
+# durations are aggregated per function as well. Recording is a few dict updates under a lock.
+# Exporters receive every finished span and the metrics snapshots given to export_metrics(),
+# output() replaces print() so the modules' messages can become structured log records.
+
+THROTTLE_CODES = ("SlowDown", "Throttling", "ThrottlingException", "RequestLimitExceeded",
+                  "TooManyRequestsException", "RequestThrottled", "503")
+# latency histogram bucket upper bounds in seconds: 0.5 ms to ~2 min, 4 buckets per doubling
+LATENCY_BUCKETS = [0.0005 * 2 ** (i / 4) for i in range(73)]
+
+_enabled = True
+_structured = False
+_logger = logging.getLogger("aws_project")
+_exporters = []
+_current_span = contextvars.ContextVar("s3_metrics_span", default = None)
+_span_ids = itertools.count(1)
+_thread_state = threading.local() #throttled attempts seen by each thread, read by s3_throttle
+
+def helper_percentile(histogram: list[int], count: int, fraction: float) -> float:
+    '''helper for MetricsRegistry.snapshot(), the upper bound of the bucket holding the `fraction` quantile'''
+    rank = fraction * count
+    seen = 0
+    for i, bucket_count in enumerate(histogram):
+        seen += bucket_count
+        if seen >= rank and bucket_count:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else float("inf")
+    return 0.0
+
+class MetricsRegistry:
+    '''
+    Thread-safe aggregator of call and span metrics, keyed by operation or function name.
+
+    `registry` is the instance the hooks and @traced record into.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forgets every recorded metric'''
+        with self._lock:
+            self.operations = {}
+            self.functions = {}
+
+    def helper_entry(self, table: dict, name: str) -> dict:
+        '''helper for the record methods, the metrics of `name` in `table`, created on first use'''
+        entry = table.get(name)
+        if entry is None:
+            entry = table[name] = {"calls": 0, "errors": 0, "retries": 0, "throttles": 0, "bytes_sent": 0,
+                                   "bytes_received": 0, "seconds": 0.0, "max_seconds": 0.0,
+                                   "histogram": [0] * (len(LATENCY_BUCKETS) + 1)}
+        return entry
+
+    def record_call(self, operation: str, seconds: float, error: bool, retries: int):
+        '''Records one API call of `operation` (all its attempts) that took `seconds`'''
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            entry = self.helper_entry(self.operations, operation)
+            entry["calls"] += 1
+            entry["errors"] += error
+            entry["retries"] += retries
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["histogram"][i] += 1
+
+    def record_attempt(self, operation: str, throttled: bool, bytes_received: int):
+        '''Records one HTTP attempt of `operation`'''
+        with self._lock:
+            entry = self.helper_entry(self.operations, operation)
+            entry["throttles"] += throttled
+            entry["bytes_received"] += bytes_received
+
+    def record_bytes_sent(self, operation: str, bytes_sent: int):
+        '''Records the request body size of one HTTP attempt of `operation`'''
+        with self._lock:
+            self.helper_entry(self.operations, operation)["bytes_sent"] += bytes_sent
+
+    def record_span(self, function: str, seconds: float, error: bool):
+        '''Records one finished span of `function`'''
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            entry = self.helper_entry(self.functions, function)
+            entry["calls"] += 1
+            entry["errors"] += error
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["histogram"][i] += 1
+
+    def snapshot(self) -> dict:
+        '''
+        Returns {"operations": {operation: metrics}, "functions": {function: metrics}}
+
+        The metrics dicts hold calls, errors, retries, throttles, bytes_sent, bytes_received (operations only),
+        seconds (total), mean_seconds, max_seconds and p50/p90/p99 in seconds, estimated from the histogram.
+        '''
+        with self._lock:
+            tables = {"operations": self.operations, "functions": self.functions}
+            result = {}
+            for table_name, table in tables.items():
+                result[table_name] = {}
+                for name, entry in table.items():
+                    metrics = dict((key, val) for key, val in entry.items() if key != "histogram")
+                    if table_name == "functions":
+                        for key in ("retries", "throttles", "bytes_sent", "bytes_received"): del metrics[key]
+                    metrics["mean_seconds"] = entry["seconds"] / entry["calls"] if entry["calls"] else 0.0
+                    for label, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                        metrics[label] = min(entry["max_seconds"],
+                                             helper_percentile(entry["histogram"], entry["calls"], fraction))
+                    result[table_name][name] = metrics
+        return result
+
+registry = MetricsRegistry()
+
+def enable_metrics(enabled: bool = True):
+    '''
+    Turns the recording of S3 call metrics and spans on or off, it is on by default.
+
+    Parameters:
+    `enabled` bool
+    '''
+    global _enabled
+    _enabled = enabled
+
+## botocore hooks
+def helper_operation_name(event_name: str) -> str:
+    '''helper for the hooks, "s3.GetObject" from an event name like "after-call.s3.GetObject"'''
+    return event_name.split(".", 1)[1]
+
+def helper_before_call(context, event_name, **kwargs):
+    '''helper for instrument_client(), starts the call timer'''
+    if _enabled:
+        context["s3_metrics_start"] = time.perf_counter()
+        context["s3_metrics_attempts"] = 0
+
+def helper_before_send(request, event_name, **kwargs):
+    '''helper for instrument_client(), counts the bytes of every attempt's request body'''
+    if _enabled:
+        body = request.body
+        if isinstance(body, (bytes, bytearray)):
+            size = len(body)
+        else: #streamed bodies, aws-chunked uploads announce their size without the chunk framing
+            size = int(request.headers.get("X-Amz-Decoded-Content-Length") or request.headers.get("Content-Length") or 0)
+        if size: registry.record_bytes_sent(helper_operation_name(event_name), size)
+
+def helper_response_received(context, event_name, response_dict = None, parsed_response = None, exception = None, **kwargs):
+    '''helper for instrument_client(), counts the attempts, throttles and response bytes'''
+    throttled = False
+    if response_dict is not None:
+        status = response_dict.get("status_code")
+        code = ((parsed_response or {}).get("Error") or {}).get("Code")
+        throttled = status == 503 or code in THROTTLE_CODES
+    if throttled: #counted even with metrics off, botocore retries these before the caller sees them
+        _thread_state.throttles = getattr(_thread_state, "throttles", 0) + 1
+    if not _enabled:
+        return
+    context["s3_metrics_attempts"] = context.get("s3_metrics_attempts", 0) + 1
+    size = 0
+    if response_dict is not None:
+        size = int(response_dict.get("headers", {}).get("content-length", 0) or 0)
+        if not size and isinstance(response_dict.get("body"), bytes): size = len(response_dict["body"])
+    registry.record_attempt(helper_operation_name(event_name), throttled, size)
+
+def helper_after_call(context, event_name, http_response = None, **kwargs):
+    '''helper for instrument_client(), records the finished call, successful or not'''
+    start = context.pop("s3_metrics_start", None)
+    if not _enabled or start is None:
+        return
+    error = "exception" in kwargs or (http_response is not None and http_response.status_code >= 300)
+    registry.record_call(helper_operation_name(event_name), time.perf_counter() - start,
+                         error, max(0, context.get("s3_metrics_attempts", 1) - 1))
+
+def thread_throttles() -> int:
+    '''Returns the number of throttled attempts (503 or SlowDown-like) seen so far by the calling thread'''
+    return getattr(_thread_state, "throttles", 0)
+
+def instrument_client(client):
+    '''
+    Attaches the metric hooks to a boto3 client, called by s3_client for every pooled client.
+
+    Parameters:
+    `client` boto3.client
+    '''
+    events = client.meta.events
+    events.register("before-call", helper_before_call, unique_id = "s3_metrics_before_call")
+    events.register("before-send", helper_before_send, unique_id = "s3_metrics_before_send")
+    events.register("response-received", helper_response_received, unique_id = "s3_metrics_response_received")
+    events.register("after-call", helper_after_call, unique_id = "s3_metrics_after_call")
+    events.register("after-call-error", helper_after_call, unique_id = "s3_metrics_after_call_error")
+    return client
+
+## tracing
+class Exporter:
+    '''
+    Receives finished spans and metric snapshots, subclass it and give it to add_exporter().
+
+    export_span() is called on the thread that finished the span, keep it fast.
+    '''
+    def export_span(self, span: dict):
+        '''`span` {"id", "parent", "name", "start" (epoch seconds), "seconds", "error", "thread"}'''
+
+    def export_metrics(self, snapshot: dict):
+        '''`snapshot` is MetricsRegistry.snapshot()'''
+
+class LoggingExporter(Exporter):
+    '''
+    Exporter writing spans and metrics as JSON log records.
+
+    Parameters:
+    `logger` logging.Logger
+        defaults to None, the "aws_project" logger.
+    `spans` bool
+        if False, only the metric snapshots are logged.
+    '''
+    def __init__(self, logger: logging.Logger = None, spans: bool = True):
+        self.logger = logger or _logger
+        self.spans = spans
+
+    def export_span(self, span: dict):
+        if self.spans:
+            self.logger.info(json.dumps({"event": "span", **span}))
+
+    def export_metrics(self, snapshot: dict):
+        self.logger.info(json.dumps({"event": "metrics", **snapshot}))
+
+def add_exporter(exporter: Exporter) -> Exporter:
+    '''Registers `exporter` to receive every finished span and exported snapshot, and returns it'''
+    _exporters.append(exporter)
+    return exporter
+
+def remove_exporter(exporter: Exporter):
+    '''Stops sending spans and snapshots to `exporter`'''
+    _exporters.remove(exporter)
+
+def export_metrics(reset: bool = False) -> dict:
+    '''
+    Sends the current metrics snapshot to every exporter and returns it.
+
+    Parameters:
+    `reset` bool
+        if True, the metrics are reset after the snapshot, so the next export covers a new interval.
+    '''
+    snapshot = registry.snapshot()
+    if reset: registry.reset()
+    for exporter in list(_exporters):
+        exporter.export_metrics(snapshot)
+    return snapshot
+
+@contextlib.contextmanager
+def span(name: str, activate: bool = True):
+    '''
+    Context manager timing a span named `name`, nested under the current span of the calling context.
+
+    Parameters:
+    `name` str
+    `activate` bool
+        if True, spans opened inside this one are its children.
+    '''
+    if not _enabled:
+        yield None
+        return
+    record = {"id": next(_span_ids), "parent": _current_span.get(), "name": name,
+              "start": time.time(), "thread": threading.current_thread().name}
+    token = _current_span.set(record["id"]) if activate else None
+    start = time.perf_counter()
+    error = False
+    try:
+        yield record
+    except BaseException as err:
+        error = not isinstance(err, (GeneratorExit, StopIteration))
+        raise
+    finally:
+        if token is not None: _current_span.reset(token)
+        record["seconds"] = time.perf_counter() - start
+        record["error"] = error
+        registry.record_span(name, record["seconds"], error)
+        for exporter in _exporters:
+            exporter.export_span(record)
+
+def traced(func):
+    '''
+    Decorator wrapping every call of `func` in a span named "<module>.<function>".
+
+    Works on functions, generators, coroutines and async generators. Generator spans last until
+    the generator is exhausted or closed but are not the parent of the spans opened while it is suspended.
+    '''
+    name = f"{func.__module__}.{func.__qualname__}"
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name, activate = False):
+                async for item in func(*args, **kwargs):
+                    yield item
+    elif inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+    elif inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, activate = False):
+                return (yield from func(*args, **kwargs))
+    else:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with span(name):
+                return func(*args, **kwargs)
+    return wrapper
+
+## output
+def use_structured_logging(structured: bool = True, logger: logging.Logger = None):
+    '''
+    Makes output() write JSON log records instead of printing, for every module's messages.
+
+    Parameters:
+    `structured` bool
+        if False, output() prints again.
+    `logger` logging.Logger
+        the logger of the records, defaults to None, the "aws_project" logger.
+    '''
+    global _structured, _logger
+    _structured = structured
+    if logger is not None: _logger = logger
+
+def output(*args, sep: str = " ", level: int = logging.INFO, **fields):
+    '''
+    Prints `args` like print(), or logs them as a JSON record with `fields` after use_structured_logging().
+
+    The record is {"message": the printed text, "span": the current span id, **fields}.
+
+    Parameters:
+    `args`
+        the values print() would print
+    `sep` str
+        the separator print() would use
+    `level` int
+        the logging level of the record
+    `fields`
+        extra structured values, e.g. bucket = "melon", ignored when printing.
+    '''
+    if not _structured:
+        print(*args, sep = sep)
+        return
+    _logger.log(level, json.dumps({"message": sep.join(str(arg) for arg in args), "span": _current_span.get(),
+                                   **fields}, default = str))
+
+def summary(top: int = 20) -> str:
+    '''
+    Returns and outputs a table of the `top` operations and functions by total time.
+
+    Parameters:
+    `top` int
+        the number of rows of each table
+    '''
+    snapshot = registry.snapshot()
+    lines = []
+    for table_name, table in snapshot.items():
+        lines.append(f"{table_name:<48}{'calls':>8}{'errors':>8}{'retries':>8}{'throttle':>9}"
+                     f"{'total s':>10}{'p50 ms':>9}{'p99 ms':>9}{'MiB':>9}")
+        rows = sorted(table.items(), key = lambda item: item[1]["seconds"], reverse = True)[:top]
+        for name, metrics in rows:
+            transferred = (metrics.get("bytes_sent", 0) + metrics.get("bytes_received", 0)) / 1024**2
+            lines.append(f"{name[:47]:<48}{metrics['calls']:>8}{metrics['errors']:>8}{metrics.get('retries', 0):>8}"
+                         f"{metrics.get('throttles', 0):>9}{metrics['seconds']:>10.2f}{metrics['p50'] * 1000:>9.1f}"
+                         f"{metrics['p99'] * 1000:>9.1f}{transferred:>9.1f}")
+    text = "\n".join(lines)
+    output(text, event = "metrics_summary")
+    return text
@@ -0,0 +1,107 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from itertools import islice
+import threading
+import time
+
+from s3_metrics import output
+
+def bounded_map(func, iterable, max_workers: int = 16, max_in_flight: int = None):
+    '''
+    Lazily yields `func(item)` for every item in `iterable`, in the same order as `iterable`.
+
+    The calls run on a pool of `max_workers` threads and at most `max_in_flight` calls are
+    submitted but not yet yielded, so memory stays bounded even if `iterable` is a long generator.
+    Exceptions raised by `func` are re-raised when their result is reached.
+
+    Parameters:
+    `func` callable
+        called with one item at a time, must be thread-safe.
+    `iterable` iterable
+        the items to map over, only consumed as fast as results are yielded.
+    `max_workers` int
+        the number of worker threads.
+    `max_in_flight` int
+        the maximum number of pending calls, defaults to `2 * max_workers`.
+    '''
+    assert isinstance(max_workers, int) and max_workers > 0, f"Invalid max_workers = {max_workers}"
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    assert max_in_flight >= max_workers, "`max_in_flight` must be at least `max_workers`."
+
+    executor = ThreadPoolExecutor(max_workers)
+    pending = deque()
+    try:
+        for item in iterable:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        #only reached with pending futures if the consumer stopped early or func raised
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def chunked(iterable, size: int):
+    '''Lazily yields lists of up to `size` consecutive items from `iterable`'''
+    assert isinstance(size, int) and size > 0, f"Invalid chunk size = {size}"
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+class ProgressCounter:
+    '''
+    Thread-safe counter that prints how many items are done and the throughput while a bulk operation runs.
+
+    Parameters:
+    `label` str
+        printed at the start of every progress line.
+    `total` int|float
+        the number of items expected, defaults to None when it is not known in advance.
+        Use floats for `total` and `add()` to count fractional units such as MiB.
+    `unit` str
+        the name of the items counted, used in the printed lines.
+    `interval` float
+        the minimum number of seconds between two printed lines.
+    `verbose` bool
+        if False, the counter only counts and nothing is printed.
+    '''
+    def __init__(self, label: str, total: int|float = None, unit: str = "objects",
+                 interval: float = 1.0, verbose: bool = True):
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.verbose = verbose
+        self.done = 0
+        self.start = time.perf_counter()
+        self._last_print = self.start
+        self._lock = threading.Lock()
+
+    def add(self, count: int|float = 1):
+        '''Adds `count` finished items and prints a progress line if `interval` has passed'''
+        with self._lock:
+            self.done += count
+            now = time.perf_counter()
+            if self.verbose and now - self._last_print >= self.interval:
+                self._last_print = now
+                output(self.status())
+
+    def rate(self) -> float:
+        '''Returns the items finished per second since the counter was made'''
+        return self.done / max(time.perf_counter() - self.start, 1e-9)
+
+    def status(self) -> str:
+        '''Returns the progress line'''
+        done = f"{self.done:.1f}" if isinstance(self.done, float) or isinstance(self.total, float) else self.done
+        total = f"/{self.total:.1f}" if isinstance(self.total, float) else (
+            f"/{self.total}" if self.total is not None else "")
+        return (f"{self.label}: {done}{total} {self.unit} in "
+                f"{time.perf_counter() - self.start:.1f}s ({self.rate():.1f} {self.unit}/s)")
+
+    def close(self):
+        '''Prints the final progress line'''
+        if self.verbose:
+            output(self.status())
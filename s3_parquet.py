@@ -0,0 +1,300 @@
+import bisect
+import hashlib
+import io
+import os
+import struct
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+# pyarrow must be installed to use this module
+
+from s3_client import get_client
+from s3_get import helper_get_range
+from s3_index import default_cache_dir
+from s3_metrics import traced
+from s3_parallel import bounded_map
+
+# Parquet files end with the footer: the thrift FileMetaData, its 4 byte little-endian length and b"PAR1".
+# The metadata lists the byte range of every column chunk of every row group with its min/max statistics,
+# so only the footer is needed to decide which ranges of the file a query has to download.
+FOOTER_GUESS = 64 * 1024
+MAGIC = b"PAR1"
+FILTER_OPERATORS = ("==", "!=", "<", "<=", ">", ">=", "in", "not in")
+
+class S3RangeFile(io.RawIOBase):
+    '''
+    Read-only, seekable file-like view of an S3 object that downloads byte ranges on demand.
+
+    Ranges fetched with prefetch() are kept in memory and reads falling inside them do not call S3,
+    which lets pyarrow read a parquet file after its needed column chunks were downloaded concurrently.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+    `object_name` str
+    `size` int
+        the object's size in bytes
+    `etag` str
+        the object's ETag, every range GET fails if the object changed.
+    '''
+    def __init__(self, session, bucket_name: str, object_name: str, size: int, etag: str):
+        self.session = session
+        self.bucket_name = bucket_name
+        self.object_name = object_name
+        self.size = size
+        self.etag = etag
+        self.bytes_fetched = 0
+        self._position = 0
+        self._starts = [] #sorted starts of the cached ranges
+        self._ranges = {} #start: bytes
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: self.size}[whence]
+        self._position = max(0, start + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def cache(self, start: int, data: bytes):
+        '''Keeps `data`, the bytes of the object starting at `start`, to answer later reads'''
+        if start not in self._ranges:
+            bisect.insort(self._starts, start)
+        self._ranges[start] = data
+
+    def helper_cached(self, start: int, end: int):
+        '''helper for read(), the bytes `start` to `end` if a cached range holds all of them, None otherwise'''
+        i = bisect.bisect_right(self._starts, start) - 1
+        if i < 0:
+            return None
+        range_start = self._starts[i]
+        data = self._ranges[range_start]
+        if end - range_start <= len(data):
+            return data[start - range_start:end - range_start]
+        return None
+
+    def read(self, size = -1):
+        end = self.size if size is None or size < 0 else min(self.size, self._position + size)
+        if end <= self._position:
+            return b""
+        data = self.helper_cached(self._position, end)
+        if data is None:
+            data = helper_get_range(self.session, self.bucket_name, self.object_name,
+                                    self._position, end, self.etag)
+            self.bytes_fetched += len(data)
+        self._position = end
+        return data
+
+    def readinto(self, destination):
+        data = self.read(len(destination))
+        destination[:len(data)] = data
+        return len(data)
+
+    def prefetch(self, byte_ranges: list[tuple[int, int]], max_workers: int = 8, max_gap: int = 1024**2):
+        '''
+        Downloads `byte_ranges` concurrently and caches them.
+
+        Ranges closer than `max_gap` bytes are merged into one GET, trading a few unneeded bytes for fewer requests.
+        '''
+        merged = []
+        for start, end in sorted(byte_ranges):
+            if merged and start - merged[-1][1] <= max_gap:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        fetched = bounded_map(
+            lambda byte_range: (byte_range[0], helper_get_range(self.session, self.bucket_name, self.object_name,
+                                                                *byte_range, self.etag)),
+            merged, max_workers)
+        for start, data in fetched:
+            self.bytes_fetched += len(data)
+            self.cache(start, data)
+
+def helper_footer_cache_path(cache_dir: str, bucket_name: str, object_name: str, etag: str) -> str:
+    '''helper for S3ParquetFile, the local file caching the footer of an object version'''
+    name = hashlib.sha256(f"{bucket_name}/{object_name}".encode()).hexdigest()
+    return os.path.join(cache_dir, "parquet_footers", f"{name}-{etag.strip(chr(34))}.footer")
+
+def helper_row_group_may_match(row_group, column_index: dict, filters: list[tuple]) -> bool:
+    '''helper for S3ParquetFile.select_row_groups(), False only if the statistics prove no row can match `filters`'''
+    for column, operator, value in filters:
+        if column not in column_index:
+            continue
+        statistics = row_group.column(column_index[column]).statistics
+        if statistics is None or not statistics.has_min_max:
+            continue
+        low, high = statistics.min, statistics.max
+        if operator == "==" and not low <= value <= high: return False
+        if operator == "!=" and low == high == value: return False
+        if operator == "<" and not low < value: return False
+        if operator == "<=" and not low <= value: return False
+        if operator == ">" and not high > value: return False
+        if operator == ">=" and not high >= value: return False
+        if operator == "in" and not any(low <= v <= high for v in value): return False
+        if operator == "not in" and low == high and low in value: return False
+    return True
+
+def helper_filter_expression(filters: list[tuple]):
+    '''helper for S3ParquetFile.read(), the pyarrow compute expression AND-ing `filters`'''
+    expression = None
+    for column, operator, value in filters:
+        field = pc.field(column)
+        condition = {"==": lambda: field == value, "!=": lambda: field != value,
+                     "<": lambda: field < value, "<=": lambda: field <= value,
+                     ">": lambda: field > value, ">=": lambda: field >= value,
+                     "in": lambda: field.isin(list(value)),
+                     "not in": lambda: ~field.isin(list(value))}[operator]()
+        expression = condition if expression is None else expression & condition
+    return expression
+
+class S3ParquetFile:
+    '''
+    Parquet file in S3 read with range requests: the footer once, then only the needed column chunks.
+
+    The footer is cached under `cache_dir`, keyed by the object's ETag, so opening the same
+    version of a file again costs a single HEAD request.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the name of the bucket containing the parquet file
+    `object_name` str
+        the key of the parquet file
+    `cache_dir` str
+        the local cache directory, defaults to None, which is s3_index.default_cache_dir().
+    `max_workers` int
+        the number of column chunk range GETs running at once.
+    '''
+    def __init__(self, session, bucket_name: str, object_name: str, cache_dir: str = None, max_workers: int = 8):
+        if cache_dir is None:
+            cache_dir = default_cache_dir()
+        head = get_client(session).head_object(Bucket = bucket_name, Key = object_name)
+        self.max_workers = max_workers
+        self.file = S3RangeFile(session, bucket_name, object_name, head["ContentLength"], head["ETag"])
+        footer_path = helper_footer_cache_path(cache_dir, bucket_name, object_name, head["ETag"])
+        if os.path.exists(footer_path):
+            with open(footer_path, "rb") as footer_file:
+                footer = footer_file.read()
+        else:
+            footer = self.helper_fetch_footer()
+            os.makedirs(os.path.dirname(footer_path), exist_ok = True)
+            with open(footer_path + ".tmp", "wb") as footer_file:
+                footer_file.write(footer)
+            os.replace(footer_path + ".tmp", footer_path)
+        self.file.cache(self.file.size - len(footer), footer)
+        self.metadata = pq.read_metadata(pa.BufferReader(MAGIC + footer))
+        self.schema = self.metadata.schema.to_arrow_schema()
+
+    def helper_fetch_footer(self) -> bytes:
+        '''helper for __init__(), downloads the footer: the metadata, its length and the magic bytes'''
+        size = self.file.size
+        self.file.seek(max(0, size - FOOTER_GUESS))
+        tail = self.file.read()
+        assert tail[-4:] == MAGIC, f"{self.file.object_name} is not a parquet file"
+        footer_size = struct.unpack("<I", tail[-8:-4])[0] + 8
+        if footer_size > len(tail): #metadata larger than the first guess
+            self.file.seek(size - footer_size)
+            tail = self.file.read(footer_size - len(tail)) + tail
+        return tail[-footer_size:]
+
+    def select_row_groups(self, filters: list[tuple] = None) -> list[int]:
+        '''
+        Returns the indices of the row groups that may contain rows matching `filters`, from their min/max statistics.
+
+        Parameters:
+        `filters` list[tuple]
+            (column, operator, value) conditions that must all hold, see read() for the operators.
+        '''
+        filters = filters or []
+        for _, operator, _ in filters:
+            assert operator in FILTER_OPERATORS, f"Invalid filter operator = {operator}"
+        column_index = dict((self.metadata.schema.column(i).path, i) for i in range(self.metadata.num_columns))
+        return [i for i in range(self.metadata.num_row_groups)
+                if helper_row_group_may_match(self.metadata.row_group(i), column_index, filters)]
+
+    def column_chunk_ranges(self, row_groups: list[int], columns: list[str] = None) -> list[tuple[int, int]]:
+        '''
+        Returns the (start, end) byte ranges of the column chunks of `columns` in `row_groups`.
+
+        Parameters:
+        `row_groups` list[int]
+            row group indices, see select_row_groups()
+        `columns` list[str]
+            top-level column names, defaults to None, all columns.
+        '''
+        ranges = []
+        for i in row_groups:
+            row_group = self.metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                chunk = row_group.column(j)
+                if columns is not None and chunk.path_in_schema.split(".")[0] not in columns:
+                    continue
+                start = chunk.data_page_offset
+                if chunk.has_dictionary_page and chunk.dictionary_page_offset:
+                    start = min(start, chunk.dictionary_page_offset)
+                ranges.append((start, start + chunk.total_compressed_size))
+        return ranges
+
+    def read(self, columns: list[str] = None, filters: list[tuple] = None, row_groups: list[int] = None) -> pa.Table:
+        '''
+        Returns the rows matching `filters` of `columns` as a pyarrow Table, downloading only what they need.
+
+        The row groups whose statistics rule out `filters` are skipped, the column chunks of the others
+        are downloaded concurrently, then `filters` are applied to the rows.
+
+        Parameters:
+        `columns` list[str]
+            the top-level columns to read, defaults to None, all columns.
+        `filters` list[tuple]
+            (column, operator, value) conditions that must all hold.
+            operators: "==", "!=", "<", "<=", ">", ">=", "in", "not in" (value is a collection for the last two).
+            e.g. [("cell_type", "in", {"A", "B"}), ("voltage", ">", 3.6)]
+        `row_groups` list[int]
+            the row groups to read, defaults to None, select_row_groups(`filters`).
+        '''
+        filters = filters or []
+        if row_groups is None:
+            row_groups = self.select_row_groups(filters)
+        read_columns = columns
+        if columns is not None:
+            read_columns = list(columns) + [c for c, _, _ in filters if c not in columns]
+        if not row_groups:
+            schema = self.schema if columns is None else pa.schema([self.schema.field(c) for c in columns])
+            return schema.empty_table()
+        self.file.prefetch(self.column_chunk_ranges(row_groups, read_columns), self.max_workers)
+        table = pq.ParquetFile(self.file, metadata = self.metadata).read_row_groups(row_groups, columns = read_columns)
+        if filters:
+            table = table.filter(helper_filter_expression(filters))
+        if columns is not None:
+            table = table.select(list(columns))
+        return table
+
+@traced
+def read_parquet(session, bucket_name: str, object_name: str, columns: list[str] = None,
+                 filters: list[tuple] = None, cache_dir: str = None, max_workers: int = 8) -> pa.Table:
+    '''
+    Returns `columns` of the rows matching `filters` in an S3 parquet file, see S3ParquetFile.read().
+
+    Only the footer (cached by ETag) and the column chunks of the row groups that may match are downloaded.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+    `object_name` str
+    `columns` list[str]
+        the top-level columns to read, defaults to None, all columns.
+    `filters` list[tuple]
+        (column, operator, value) conditions that must all hold, e.g. [("voltage", ">", 3.6)]
+    `cache_dir` str
+        the local cache directory for footers, defaults to None, which is s3_index.default_cache_dir().
+    `max_workers` int
+        the number of range GETs running at once.
+    '''
+    return S3ParquetFile(session, bucket_name, object_name, cache_dir, max_workers).read(columns, filters)
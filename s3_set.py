@@ -1,11 +1,18 @@
 from botocore.exceptions import ClientError
 import json
 
-from s3_generate import gen_tagging_list_from_python_dict#, gen_python_dict_from_tagging_list
+from s3_client import get_client, get_resource
+from s3_generate import gen_tagging_list_from_python_dict, gen_python_dict_from_tagging_list
+from s3_get import forget_bucket_tags, iter_objects
+from s3_metrics import output, traced
+from s3_parallel import bounded_map, ProgressCounter
+from s3_throttle import get_limiter
 # from s3_delete import delete_objects__with_prefix
 
 #adding things to buckets/objects
-def add_tags_to_bucket(session, bucket_name:str, tags:list[dict]|dict, s3_format=True, overwrite=False):
+@traced
+def add_tags_to_bucket(session, bucket_name:str, tags:list[dict]|dict, s3_format=True, overwrite=False,
+                       tag_index=None):
     '''
     Adds tags to an s3 bucket. Does not remove existing tags.
 
@@ -25,31 +32,37 @@ def add_tags_to_bucket(session, bucket_name:str, tags:list[dict]|dict, s3_format
     `overwrite` bool
         if True, existing tags are overwritten.
         if False, existing tags are added to.
+    `tag_index` s3_index.TagIndex
+        if given, the bucket's new tag set is written to the index as well.
     '''
     assert isinstance(tags, (list,dict))
     if not s3_format:
         tags = gen_tagging_list_from_python_dict(tags)
-    bucket_tagger = session.resource("s3").BucketTagging(bucket_name)
+    bucket_tagger = get_resource(session).BucketTagging(bucket_name)
     
     if not overwrite:
         try:
             existing_tags = bucket_tagger.tag_set
             tags.extend(existing_tags)
         except ClientError as err:
-            if err.response["Error"]["Code"] == "NoSuchTagSet":
-                pass
+            if err.response["Error"]["Code"] != "NoSuchTagSet": raise
     try:
-        set_tag = bucket_tagger.put(Tagging={"TagSet":tags})
+        set_tag = get_limiter().call(bucket_name, "", bucket_tagger.put, Tagging={"TagSet":tags})
         # bucket_tagger.reload() #useless here
-        print("Bucket tags:", *tags, sep="\n\t")
+        forget_bucket_tags(bucket_name) #cached by s3_get's bucket scans
+        if tag_index is not None:
+            tag_index.put_bucket_tags(bucket_name, tags)
+        output("Bucket tags:", *tags, sep="\n\t")
         return set_tag
     except ClientError as err:
         if err.response["Error"]["Code"] == "InvalidTag":
-            print("There may be a duplicate tag")
+            output("There may be a duplicate tag")
             return None
+        raise #throttles were already retried by botocore, anything else is the caller's to handle
     
+@traced
 def add_tags_to_object(session, bucket_name:str, object_name:str, tags:list[dict]|dict,
-                       s3_format=True, s3_client=None, overwrite=False):
+                       s3_format=True, s3_client=None, overwrite=False, tag_index=None):
     '''
     Adds tags to an s3 bucket. Does not remove existing tags.
 
@@ -69,43 +82,159 @@ def add_tags_to_object(session, bucket_name:str, object_name:str, tags:list[dict
         if True, `tags` is a list S3 tag formatted dicts {"Key":key_arg, "Value":value_arg}
         if False, `tags` is a dict of regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2}
     `s3_client` boto3.client("s3")
-        Gives the option to pass an s3 client if this function is used for many objects in a loop.
-        Saves time and space by not reinitializing a client every function call
+        Gives the option to pass an s3 client, defaults to the pooled client of s3_client.get_client(),
+        so calling this function in a loop does not reinitialize a client every call.
     `overwrite` bool
         if True, existing tags are overwritten.
         if False, existing tags are added to.
+    `tag_index` s3_index.TagIndex
+        if given, the object's new tag set is written to the index as well.
     '''
-    if s3_client == None: s3_client = session.client("s3")
+    if s3_client == None: s3_client = get_client(session)
     if not s3_format:
         tags = gen_tagging_list_from_python_dict(tags)
+    limiter = get_limiter()
     if not overwrite:
-        existing_tags = s3_client.get_object_tagging(Bucket = bucket_name, Key = object_name)["TagSet"]
+        existing_tags = limiter.call(bucket_name, object_name, s3_client.get_object_tagging,
+                                     Bucket = bucket_name, Key = object_name)["TagSet"]
         tags.extend(existing_tags)
     try:
-        set_tag = s3_client.put_object_tagging(
+        set_tag = limiter.call(bucket_name, object_name, s3_client.put_object_tagging,
             Bucket = bucket_name,
             Key = object_name,
             Tagging = {"TagSet" : tags}
         )
-        print("New tag set:", *tags, sep="\n\t")
+        if tag_index is not None:
+            tag_index.put_object_tags(bucket_name, object_name, tags)
+        output("New tag set:", *tags, sep="\n\t")
         return set_tag
     except ClientError as err:
         if err.response["Error"]["Code"] == "InvalidTag":
-            print("There may be a duplicate tag")
+            output("There may be a duplicate tag")
             return None
+        raise
+
+def helper_mutate_tags(existing: dict, tags: dict, mode: str) -> dict:
+    '''helper for bulk_tag_objects(), the tag set after applying `mode` with `tags` to `existing`'''
+    if mode == "add":
+        return existing | tags #one value per key, the new value wins
+    if mode == "overwrite":
+        return dict(tags)
+    return dict((tkey, tval) for tkey, tval in existing.items() if tkey not in tags)
+
+@traced
+def bulk_tag_objects(session, bucket_name:str, tags:list[dict]|dict|list[str], object_names = None,
+                     object_prefix:str = None, mode:str = "add", s3_format=True, max_workers:int = 16,
+                     tag_index=None, verbose:bool = True) -> dict:
+    '''
+    Applies a tag mutation to many objects with concurrent get/put tagging requests.
+
+    Returns {"Updated": int, "Unchanged": int, "Failed": list[dict]}
+    The failure dicts are {"Key": object key, "Code": S3 error code, "Message": S3 error message}.
+
+    Every object's tag set is read, mutated and only written back if it changed, so re-running
+    a bulk tagging costs one request per object. Tags are merged per key, an object never ends up
+    with two values for the same tag key.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `bucket_name` str
+        the name of the s3 bucket containing the objects
+    `tags` list[dict]|dict|list[str]
+        the tags of the mutation, see `s3_format` for more information.
+        With `mode` = "remove" only the tag keys matter and a list of tag key strings is accepted.
+    `object_names` iterable of str or object dicts
+        the keys of the objects to tag, e.g. a generator from s3_get.iter_objects_with_name_date().
+        If None, every object under `object_prefix` is tagged.
+    `object_prefix` str
+        used when `object_names` is None, defaults to None, the whole bucket.
+    `mode` str
+        "add": the tags are added, replacing the values of existing keys.
+        "overwrite": the tag set becomes `tags`.
+        "remove": the tag keys of `tags` are removed.
+    `s3_format` bool
+        if True, `tags` is a list S3 tag formatted dicts {"Key":key_arg, "Value":value_arg}
+        if False, `tags` is a dict of regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2}
+    `max_workers` int
+        the number of objects processed at once.
+    `tag_index` s3_index.TagIndex
+        if given, the new tag sets are written to the index as well.
+    `verbose` bool
+        if True, the progress and throughput are printed while tagging.
+    '''
+    assert mode in ("add", "overwrite", "remove"), f"Invalid mode = {mode}"
+    if mode == "remove" and isinstance(tags, list) and all(isinstance(tkey, str) for tkey in tags):
+        tags = dict.fromkeys(tags)
+    elif s3_format:
+        tags = gen_python_dict_from_tagging_list(tags)
+    if object_names is None:
+        object_names = iter_objects(session, bucket_name, object_prefix)
+    progress = ProgressCounter(f"Tagged in {bucket_name}", unit = "objects", verbose = verbose)
+    limiter = get_limiter() #SlowDown answers shrink the prefix's concurrency, botocore retries them
+
+    def tag_object(object_name):
+        if isinstance(object_name, dict): object_name = object_name["Key"]
+        s3_client = get_client(session)
+        try:
+            existing = gen_python_dict_from_tagging_list(limiter.call(
+                bucket_name, object_name, s3_client.get_object_tagging, Bucket = bucket_name, Key = object_name)["TagSet"])
+            new_tags = helper_mutate_tags(existing, tags, mode)
+            if new_tags == existing:
+                return object_name, False, None
+            new_tag_list = gen_tagging_list_from_python_dict(new_tags)
+            limiter.call(bucket_name, object_name, s3_client.put_object_tagging,
+                         Bucket = bucket_name, Key = object_name, Tagging = {"TagSet": new_tag_list})
+            if tag_index is not None:
+                tag_index.put_object_tags(bucket_name, object_name, new_tag_list)
+            return object_name, True, None
+        except ClientError as err:
+            return object_name, False, err.response["Error"]
+        finally:
+            progress.add()
+
+    result = {"Updated": 0, "Unchanged": 0, "Failed": []}
+    for object_name, updated, error in bounded_map(tag_object, object_names, max_workers):
+        if error is not None:
+            result["Failed"].append({"Key": object_name, "Code": error.get("Code"), "Message": error.get("Message")})
+        elif updated: result["Updated"] += 1
+        else: result["Unchanged"] += 1
+    progress.close()
+    return result
+
 #setting/granting things like bucket server access logging ---------------
+def merge_lifecycle_rules(existing_rules: list[dict], new_rules: list[dict]) -> list[dict]:
+    '''
+    Returns `existing_rules` and `new_rules` merged into one list of lifecycle rules with unique IDs.
+
+    A new rule replaces the existing rule with the same ID in place, so adding the same rule again
+    changes nothing. Rules without ID are kept once, identical copies are dropped.
+
+    Parameters:
+    `existing_rules` list[dict]
+        the rules of the bucket's current configuration, e.g. s3_lifecycle.get_lifecycle_rules()
+    `new_rules` list[dict]
+        the rules to add, S3 formatted like the "Rules" of helper_lifecycle()
+    '''
+    merged = {}
+    for rule in list(existing_rules) + list(new_rules):
+        name = rule.get("ID") or json.dumps(rule, sort_keys = True, default = str)
+        merged[name] = rule
+    assert len(merged) <= 1000, f"A lifecycle configuration holds at most 1000 rules, got {len(merged)}"
+    return list(merged.values())
+
 def helper_lifecycle(**kwargs):
     '''Makes the JSON formatted policy for the set_bucket_lifecycle()'''
     config_json = {
         "Rules": [{
-            "ID": kwargs.get("lifecycle_name"),
             "Status": "Enabled"
         }]}
+    if kwargs.get("lifecycle_name"): #without ID, S3 generates one
+        config_json["Rules"][0]["ID"] = kwargs.get("lifecycle_name")
     
     if kwargs.get("transition") and kwargs.get("transition_days"):
         config_json["Rules"][0]["Transitions"] = [{
             "Days": kwargs.get("transition_days"),
-            "StorageClass": kwargs.get("transition")
+            "StorageClass": kwargs.get("transition").upper()
         }]
     
     if kwargs.get("expiration") and kwargs.get("expiration_days"):
@@ -114,7 +243,7 @@ def helper_lifecycle(**kwargs):
     if kwargs.get("noncurrent_transition") and kwargs.get("noncurrent_transition_days"):
         config_json["Rules"][0]["NoncurrentVersionTransitions"] = [{
             "NoncurrentDays": kwargs.get("noncurrent_transition_days"),
-            "StorageClass": kwargs.get("noncurrent_transition")
+            "StorageClass": kwargs.get("noncurrent_transition").upper()
         }]
 
     if kwargs.get("noncurrent_expiration") and kwargs.get("noncurrent_expiration_days"):
@@ -124,9 +253,10 @@ def helper_lifecycle(**kwargs):
         config_json["Rules"][0]["NoncurrentVersionExpiration"] = use_noncurrent
 
     if kwargs.get("filter"):
+        tag_filter = kwargs.get("tag_filter") or [None]
         use_filter = {
             "p" : {"Prefix": kwargs.get("prefix_filter")},
-            "t" : {"Tag": kwargs.get("tag_filter")},
+            "t" : {"Tag": tag_filter[0]},
             "tt" : {"And": {"Tags": kwargs.get("tag_filter")}}, 
             "pt" : {"And": {"Prefix": kwargs.get("prefix_filter"),
                         "Tags": kwargs.get("tag_filter")}}}
@@ -136,6 +266,72 @@ def helper_lifecycle(**kwargs):
     
     return config_json
 
+def helper_lifecycle_from_arguments(
+    lifecycle_name: str,
+    bucket_name: str,
+    transition: str = "Standard_IA",
+    transition_days: int = 30,
+    expiration: bool = True,
+    expiration_days: int = 90,
+    noncurrent_transition: str = None,
+    noncurrent_transition_days: int = None,
+    noncurrent_expiration: bool = False,
+    noncurrent_expiration_days: int = None,
+    newer_noncurrent_versions: int = None,
+    prefix_filter: str = None,
+    tag_filter: list[dict]|dict = None,
+    s3_format: bool = True,
+    abort_incomplete_days: int = 1
+    ):
+    '''Checks the add_bucket_lifecycle() arguments and makes the policy with helper_lifecycle()'''
+    assert isinstance(lifecycle_name, (str,type(None)))
+    assert isinstance(bucket_name, (str,type(None)))
+    assert isinstance(transition, (str,type(None)))
+    assert isinstance(transition_days, (int,type(None)))
+    assert isinstance(expiration, (bool,type(None)))
+    assert isinstance(expiration_days, (int,type(None)))
+    assert isinstance(noncurrent_transition, (str,type(None)))
+    assert isinstance(noncurrent_transition_days, (int,type(None)))
+    assert isinstance(noncurrent_expiration, (bool,type(None)))
+    assert isinstance(noncurrent_expiration_days, (int,type(None)))
+    assert isinstance(newer_noncurrent_versions, (int,type(None)))
+    if isinstance(newer_noncurrent_versions, int):
+        assert newer_noncurrent_versions <= 100 and newer_noncurrent_versions >= 0
+    assert isinstance(prefix_filter, (str,type(None)))
+    assert isinstance(tag_filter, (list,dict,type(None)))
+    assert isinstance(s3_format, (bool,type(None)))
+    assert isinstance(abort_incomplete_days, int)
+    if isinstance(tag_filter, dict):
+        tag_filter = gen_tagging_list_from_python_dict(tag_filter) if not s3_format else [tag_filter]
+    
+    #setup for the helper function helper_lifecycle()
+    filter = "" #evaluates as False in a conditional.
+    if prefix_filter:
+        filter += "p"
+    if tag_filter:
+        filter += "t" * min( 2, len(tag_filter) )
+    filter = filter[: min( len(filter), 2 )]
+
+    #setting the lifecycle
+    config_json = helper_lifecycle(
+        lifecycle_name = lifecycle_name,
+        transition = transition,
+        transition_days = transition_days,
+        expiration = expiration,
+        expiration_days = expiration_days,
+        noncurrent_transition = noncurrent_transition,
+        noncurrent_transition_days = noncurrent_transition_days,
+        noncurrent_expiration = noncurrent_expiration,
+        noncurrent_expiration_days = noncurrent_expiration_days,
+        newer_noncurrent_versions = newer_noncurrent_versions,
+        prefix_filter = prefix_filter,
+        tag_filter = tag_filter,
+        filter = filter,
+        abort_incomplete_days = abort_incomplete_days
+    ) # this is the lifecycle configuration policy that will be added
+    return config_json
+
+@traced
 def add_bucket_lifecycle(
     session,
     lifecycle_name: str, 
@@ -160,6 +356,9 @@ def add_bucket_lifecycle(
 
     Returns the configuration response.
     Good practice to have one rule per lifecycle configuration.
+    The rule is merged into the bucket's existing rules with merge_lifecycle_rules(): running it again
+    with the same `lifecycle_name` replaces that rule instead of adding a copy.
+    Use s3_lifecycle.LifecycleSimulator to estimate what the rules would cost before adding them.
 
     https://docs.aws.amazon.com/AmazonS3/latest/userguide/intro-lifecycle-rules.html
     Valid storage options to transition:
@@ -206,59 +405,22 @@ def add_bucket_lifecycle(
     Request syntax based on boto3 documentation:
     https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/s3.html#bucketlifecycleconfiguration
     '''
-    assert isinstance(lifecycle_name, (str,type(None)))
-    assert isinstance(bucket_name, (str,type(None)))
-    assert isinstance(transition, (str,type(None)))
-    assert isinstance(transition_days, (int,type(None)))
-    assert isinstance(expiration, (bool,type(None)))
-    assert isinstance(expiration_days, (int,type(None)))
-    assert isinstance(noncurrent_transition, (str,type(None)))
-    assert isinstance(noncurrent_transition_days, (int,type(None)))
-    assert isinstance(noncurrent_expiration, (bool,type(None)))
-    assert isinstance(noncurrent_expiration_days, (int,type(None)))
-    assert isinstance(newer_noncurrent_versions, (int,type(None)))
-    if isinstance(newer_noncurrent_versions, int):
-        assert newer_noncurrent_versions <= 100 and newer_noncurrent_versions >= 0
-    assert isinstance(prefix_filter, (str,type(None)))
-    assert isinstance(tag_filter, (list,dict,type(None)))
-    assert isinstance(s3_format, (bool,type(None)))
-    assert isinstance(abort_incomplete_days, int)
     assert isinstance(expected_owner, (str,type(None)))
-    
-    #setup for the helper function helper_lifecycle()
-    filter = "" #evaluates as False in a conditional.
-    if prefix_filter:
-        filter += "p"
-    if tag_filter:
-        filter += "t" * min( 2, len(tag_filter) )
-    filter = filter[: min( len(filter), 2 )]
-
-    #setting the lifecycle
-    config_json = helper_lifecycle(
-        lifecycle_name = lifecycle_name,
-        transition = transition,
-        transition_days = transition_days,
-        expiration = expiration,
-        expiration_days = expiration_days,
-        noncurrent_transition = noncurrent_transition,
-        noncurrent_transition_days = noncurrent_transition_days,
-        noncurrent_expiration = noncurrent_expiration,
-        noncurrent_expiration_days = noncurrent_expiration_days,
-        newer_noncurrent_versions = newer_noncurrent_versions,
-        prefix_filter = prefix_filter,
-        tag_filter = tag_filter,
-        filter = filter,
-        abort_incomplete_days = abort_incomplete_days
+    config_json = helper_lifecycle_from_arguments(
+        lifecycle_name, bucket_name, transition, transition_days, expiration, expiration_days,
+        noncurrent_transition, noncurrent_transition_days, noncurrent_expiration,
+        noncurrent_expiration_days, newer_noncurrent_versions, prefix_filter, tag_filter,
+        s3_format, abort_incomplete_days
     ) # this is the lifecycle configuration policy that will be added
 
-    bucket_lifecycle_tool = session.resource("s3").BucketLifecycleConfiguration(bucket_name)
+    bucket_lifecycle_tool = get_resource(session).BucketLifecycleConfiguration(bucket_name)
     #check for existing lifecycle policies
     try:
         existing_policies = bucket_lifecycle_tool.rules
-        config_json["Rules"].extend(existing_policies)
+        config_json["Rules"] = merge_lifecycle_rules(existing_policies, config_json["Rules"])
     except ClientError as err:
-        if err.response["Error"]["Code"] == "NoSuchLifecycleConfiguration":
-            pass
+        if err.response["Error"]["Code"] != "NoSuchLifecycleConfiguration":
+            raise
     if expected_owner:
         response = bucket_lifecycle_tool.put(
             LifecycleConfiguration = config_json,
@@ -268,9 +430,41 @@ def add_bucket_lifecycle(
         response = bucket_lifecycle_tool.put(
             LifecycleConfiguration = config_json
         )
-    print("Lifecycle Configuration:\n\t", config_json)
+    output("Lifecycle Configuration:\n\t", config_json)
     return response
 
+def helper_logging_policy(logging_bucket_name: str, source_accounts: str|list[str]) -> str:
+    '''Makes the JSON string policy for grant_logging_permissions_bucket_policy()'''
+    assert isinstance(source_accounts, (str,list)), f"Wrong type: {type(source_accounts)}"
+    if isinstance(source_accounts, str):
+        source_accounts = [source_accounts]
+    else:
+        for account_id in source_accounts:
+            assert isinstance(account_id, str), f"Wrong type: {type(account_id)}"
+
+    policy = {
+        "Version": "2012-10-17",
+        "Statement": [
+            {
+                "Sid": "S3ServerAccessLogsPolicy",
+                "Effect": "Allow",
+                "Principal": {
+                    "Service": "logging.s3.amazonaws.com"
+                },
+                "Action": [
+                    "s3:PutObject"
+                ],
+                "Resource": f"arn:aws:s3:::{logging_bucket_name}/*",
+                "Condition": {
+                    "StringEquals": {"aws:SourceAccount": source_accounts}
+                }
+            }
+        ]
+    }
+    policy = json.dumps(policy) #JSON dict to a string because BucketPolicy needs a string argument
+    return policy
+
+@traced
 def grant_logging_permissions_bucket_policy(session, logging_bucket_name: str, source_accounts: str|list[str]):
     '''
     Gives buckets a bucket policy that will allow it to be used for server access logging.
@@ -303,42 +497,17 @@ def grant_logging_permissions_bucket_policy(session, logging_bucket_name: str, s
     can always use this operation, even if the policy explicitly denies the root user the ability
     to perform this action.
     '''
-    assert isinstance(source_accounts, (str,list)), f"Wrong type: {type(source_accounts)}"
-    if isinstance(source_accounts, str):
-        source_accounts = [source_accounts]
-    else:
-        for account_id in source_accounts:
-            assert isinstance(account_id, str), f"Wrong type: {type(account_id)}"
-
-    policy = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Sid": "S3ServerAccessLogsPolicy",
-                "Effect": "Allow",
-                "Principal": {
-                    "Service": "logging.s3.amazonaws.com"
-                },
-                "Action": [
-                    "s3:PutObject"
-                ],
-                "Resource": f"arn:aws:s3:::{logging_bucket_name}/*",
-                "Condition": {
-                    "StringEquals": {"aws:SourceAccount": source_accounts}
-                }
-            }
-        ]
-    }
-    policy = json.dumps(policy) #JSON dict to a string because BucketPolicy needs a string argument
+    policy = helper_logging_policy(logging_bucket_name, source_accounts)
 
-    s3_policy_resource = session.resource("s3").BucketPolicy(logging_bucket_name)
+    s3_policy_resource = get_resource(session).BucketPolicy(logging_bucket_name)
     response = s3_policy_resource.put(
         Policy = policy
     )
     s3_policy_resource.reload() #same as .load()
-    print(f"Update Policy:\n{s3_policy_resource.policy}")
+    output(f"Update Policy:\n{s3_policy_resource.policy}")
     return response
 
+@traced
 def set_bucket_server_access_logging_on(session,
                                         source_bucket_name: str,
                                         logging_bucket_name: str,
@@ -371,7 +540,7 @@ def set_bucket_server_access_logging_on(session,
         if logging_path_prefix[-1] != "/": logging_path_prefix += "/"
     else: logging_path_prefix = source_bucket_name[:] + "/" #makes a copy to avoid referencing each other
 
-    bucket_logging_settings = session.resource("s3").BucketLogging(source_bucket_name)
+    bucket_logging_settings = get_resource(session).BucketLogging(source_bucket_name)
     response = bucket_logging_settings.put(
         BucketLoggingStatus = {
             "LoggingEnabled": {
@@ -381,9 +550,10 @@ def set_bucket_server_access_logging_on(session,
         }
     )
     bucket_logging_settings.reload() #same as .load()
-    print("Logging settings:", bucket_logging_settings.logging_enabled, sep="\n")
+    output("Logging settings:", bucket_logging_settings.logging_enabled, sep="\n")
     return response
 
+@traced
 def set_bucket_server_access_logging_off(session, source_bucket_name: str):#, delete_logs: bool = False):
     '''
     Turns off logging for `source_bucket_name`
@@ -396,7 +566,7 @@ def set_bucket_server_access_logging_off(session, source_bucket_name: str):#, de
     `session` boto3.session.Session()
     `source_bucket_name` str
     '''
-    resource = session.resource("s3").BucketLogging(source_bucket_name)
+    resource = get_resource(session).BucketLogging(source_bucket_name)
     response = resource.put(BucketLoggingStatus = {}) #empty BLS turns off logging
     # if delete_logs:
     #     try:
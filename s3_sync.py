@@ -0,0 +1,138 @@
+from botocore.exceptions import ClientError
+from fnmatch import fnmatch
+import hashlib
+import os
+
+from s3_generate import upload_object, MAX_PARTS, MiB
+from s3_get import iter_objects
+from s3_metrics import traced
+from s3_parallel import bounded_map, ProgressCounter
+
+def helper_local_etag(path: str, size: int, part_size: int) -> str:
+    '''
+    helper for sync_directory(), the ETag S3 gives `path` when uploaded by upload_object() with `part_size`
+
+    Single part objects have the MD5 of their content as ETag,
+    multipart objects have the MD5 of their parts' MD5s followed by "-<number of parts>".
+    '''
+    if size <= part_size:
+        digest = hashlib.md5()
+        with open(path, "rb") as file:
+            while data := file.read(MiB):
+                digest.update(data)
+        return f'"{digest.hexdigest()}"'
+    part_size = max(part_size, -(-size // MAX_PARTS)) #same rounding as upload_object()
+    part_digests = []
+    with open(path, "rb") as file:
+        while data := file.read(part_size):
+            part_digests.append(hashlib.md5(data).digest())
+    return f'"{hashlib.md5(b"".join(part_digests)).hexdigest()}-{len(part_digests)}"'
+
+def helper_etag_is_md5(head: dict) -> bool:
+    '''
+    helper for ETag checks, False if the ETag of the object described by `head` (a head_object response)
+    is not derived from the MD5 of its content, as with SSE-KMS, DSSE-KMS and SSE-C encryption
+    '''
+    return not (head.get("ServerSideEncryption", "").startswith("aws:kms") or head.get("SSECustomerAlgorithm"))
+
+def helper_iter_local_files(local_dir: str):
+    '''helper for sync_directory(), yields the (relative posix path, absolute path) of every file under `local_dir`'''
+    for root, dirs, files in os.walk(local_dir):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, local_dir).replace(os.sep, "/"), path
+
+def helper_upload_options(relative_path: str, rules: dict, tags: dict, storage_class: str) -> tuple[dict, str]:
+    '''helper for sync_directory(), the tags and storage class of the first rule whose pattern matches `relative_path`'''
+    for pattern, options in rules.items():
+        if fnmatch(relative_path, pattern):
+            return options.get("tags", tags), options.get("storage_class", storage_class)
+    return tags, storage_class
+
+@traced
+def sync_directory(session, local_dir: str, bucket_name: str, prefix: str = "",
+                   rules: dict = None, tags: dict = None, storage_class = "STANDARD",
+                   compare: str = "etag", max_workers: int = 16, part_size: int = 8 * MiB,
+                   dry_run: bool = False, verbose: bool = True) -> dict:
+    '''
+    Uploads the files of `local_dir` that are missing or changed under `prefix` in `bucket_name`.
+
+    Returns {"Uploaded": list of keys, "Skipped": number of unchanged files, "Errors": list of dicts, "DryRun": bool}
+    The error dicts are {"Key": key, "Error": error message}, a failed file does not stop the sync.
+
+    The remote objects are listed once, then every local file is compared with its remote object
+    and the changed ones are uploaded concurrently with upload_object().
+    Remote objects that have no local file are left alone.
+
+    Parameters:
+    `session` boto3.session.Session()
+    `local_dir` str
+        the directory to upload, its subdirectories become "/" separated key parts.
+    `bucket_name` str
+        The S3 bucket's name
+    `prefix` str
+        the key prefix the files are uploaded under, e.g. "raw/cycle-data/".
+    `rules` dict
+        {pattern: {"tags": dict, "storage_class": str}} applied to the files whose path relative to
+        `local_dir` matches the fnmatch `pattern`, e.g. {"*.parquet": {"storage_class": "STANDARD_IA"}}.
+        The first matching pattern is used, missing entries fall back to `tags` and `storage_class`.
+    `tags` dict
+        the default tags of uploaded files, a regular python dictionary like in gen_object().
+    `storage_class` str
+        the default storage class of uploaded files, see gen_object() for the valid values.
+    `compare` str
+        "etag": files with the same size as their object are hashed and compared with its ETag.
+        "size": files with the same size as their object are considered unchanged, no hashing.
+        The ETag is only the MD5 for objects uploaded without SSE-KMS and with the same `part_size`,
+        other objects are uploaded again.
+    `max_workers` int
+        the number of files uploaded at once.
+    `part_size` int
+        the multipart part size given to upload_object(), files larger than it are uploaded in parts.
+    `dry_run` bool
+        if True, nothing is uploaded and "Uploaded" lists the keys that would have been uploaded.
+    `verbose` bool
+        if True, the progress and throughput are printed while uploading.
+    '''
+    assert os.path.isdir(local_dir), f"{local_dir} is not a directory"
+    assert compare in ("etag", "size"), f"Invalid compare = {compare}"
+    if rules is None: rules = {}
+
+    remote = dict((obj["Key"], (obj["Size"], obj["ETag"]))
+                  for obj in iter_objects(session, bucket_name, prefix))
+    changed = []
+    skipped = 0
+    for relative_path, path in helper_iter_local_files(local_dir):
+        key = prefix + relative_path
+        size = os.path.getsize(path)
+        if key in remote and remote[key][0] == size and (
+                compare == "size" or remote[key][1] == helper_local_etag(path, size, part_size)):
+            skipped += 1
+        else:
+            changed.append((key, path, *helper_upload_options(relative_path, rules, tags, storage_class)))
+
+    result = {"Uploaded": [], "Skipped": skipped, "Errors": [], "DryRun": dry_run}
+    if dry_run:
+        result["Uploaded"] = [key for key, *_ in changed]
+        return result
+
+    progress = ProgressCounter(f"Synced {local_dir} to {bucket_name}/{prefix}", len(changed),
+                               unit = "files", verbose = verbose)
+    def upload(change):
+        key, path, file_tags, file_storage_class = change
+        try:
+            #large files are split in parts uploaded on their own small pool
+            upload_object(session, bucket_name, key, path, file_tags, file_storage_class,
+                          part_size = part_size, max_workers = 4, verbose = False)
+            return key, None
+        except (ClientError, OSError) as err:
+            return key, str(err)
+        finally:
+            progress.add()
+
+    for key, error in bounded_map(upload, changed, max_workers):
+        if error is None: result["Uploaded"].append(key)
+        else: result["Errors"].append({"Key": key, "Error": error})
+    progress.close()
+    return result
@@ -0,0 +1,251 @@
+import re
+
+# Tag queries select buckets or objects by their tags with a small expression language:
+#   cell-type in {A, B} and not test-status = failed
+#   (project = battery or project ^= "battery-") and exists owner
+# Comparisons: key = value, key != value, key in {v1, v2}, key not in {v1, v2},
+#              key ^= prefix (or key startswith prefix), exists key (or key exists).
+# Combined with and, or, not and parentheses; "not" binds tighter than "and", "and" tighter than "or".
+# Keys and values with spaces, commas or braces are quoted with " or '. Words are case-sensitive,
+# the keywords are not. A key that is missing never equals a value, so "not key = value" matches it.
+#
+# A query is parsed once into a tree of tuples, e.g. ("and", [("in", "cell-type", {"A", "B"}),
+# ("not", ("eq", "test-status", "failed"))]), which is compiled into nested closures for evaluation
+# against tag dicts and into SQL for s3_index.TagIndex.
+
+TOKEN_PATTERN = re.compile(r'''\s*(?:(?P<string>"[^"]*"|'[^']*')|(?P<symbol>!=|\^=|[=(){},])|(?P<word>[^\s=!^(){},"']+))''')
+KEYWORDS = ("and", "or", "not", "in", "exists", "startswith")
+
+def helper_tokenize(query: str) -> list[tuple[str, str]]:
+    '''helper for TagQuery, the (kind, text) tokens of `query`, kind is "string", "symbol", "keyword" or "word"'''
+    tokens = []
+    position = 0
+    query = query.rstrip()
+    while position < len(query):
+        match = TOKEN_PATTERN.match(query, position)
+        assert match and match.end() > position, f"Invalid tag query near {query[position:]!r}"
+        position = match.end()
+        if match.group("string") is not None:
+            tokens.append(("string", match.group("string")[1:-1]))
+        elif match.group("symbol") is not None:
+            tokens.append(("symbol", match.group("symbol")))
+        elif match.group("word").lower() in KEYWORDS:
+            tokens.append(("keyword", match.group("word").lower()))
+        else:
+            tokens.append(("word", match.group("word")))
+    return tokens
+
+class TagQueryParser:
+    '''helper for TagQuery, recursive descent parser of the token list into the query tree'''
+    def __init__(self, tokens: list[tuple[str, str]], query: str):
+        self.tokens = tokens
+        self.position = 0
+        self.query = query
+
+    def peek(self, kind: str = None, text: str = None) -> bool:
+        if self.position >= len(self.tokens): return False
+        token_kind, token_text = self.tokens[self.position]
+        return (kind is None or token_kind == kind) and (text is None or token_text == text)
+
+    def take(self, kind: str = None, text: str = None) -> str:
+        assert self.peek(kind, text), (f"Invalid tag query {self.query!r}: expected {text or kind} "
+                                       f"at token {self.position + 1}")
+        self.position += 1
+        return self.tokens[self.position - 1][1]
+
+    def name(self) -> str:
+        '''a key or a value, quoted or not'''
+        return self.take("string") if self.peek("string") else self.take("word")
+
+    def parse(self):
+        node = self.parse_or()
+        assert self.position == len(self.tokens), f"Invalid tag query {self.query!r}: unexpected token {self.position + 1}"
+        return node
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        while self.peek("keyword", "or"):
+            self.take()
+            children.append(self.parse_and())
+        return children[0] if len(children) == 1 else ("or", children)
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while self.peek("keyword", "and"):
+            self.take()
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else ("and", children)
+
+    def parse_not(self):
+        if self.peek("keyword", "not"):
+            self.take()
+            return ("not", self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        if self.peek("symbol", "("):
+            self.take()
+            node = self.parse_or()
+            self.take("symbol", ")")
+            return node
+        if self.peek("keyword", "exists"):
+            self.take()
+            return ("exists", self.name())
+        key = self.name()
+        if self.peek("keyword", "exists"):
+            self.take()
+            return ("exists", key)
+        if self.peek("symbol", "="):
+            self.take()
+            return ("eq", key, self.name())
+        if self.peek("symbol", "!="):
+            self.take()
+            return ("not", ("eq", key, self.name()))
+        if self.peek("symbol", "^=") or self.peek("keyword", "startswith"):
+            self.take()
+            return ("prefix", key, self.name())
+        negate = self.peek("keyword", "not")
+        if negate: self.take()
+        self.take("keyword", "in")
+        self.take("symbol", "{")
+        values = {self.name()}
+        while self.peek("symbol", ","):
+            self.take()
+            values.add(self.name())
+        self.take("symbol", "}")
+        return ("not", ("in", key, frozenset(values))) if negate else ("in", key, frozenset(values))
+
+def helper_compile(node):
+    '''helper for TagQuery, the function of a tag dict evaluating the query tree `node`'''
+    kind = node[0]
+    if kind == "true":
+        return lambda tags: True
+    if kind == "and":
+        children = [helper_compile(child) for child in node[1]]
+        return lambda tags: all(child(tags) for child in children)
+    if kind == "or":
+        children = [helper_compile(child) for child in node[1]]
+        return lambda tags: any(child(tags) for child in children)
+    if kind == "not":
+        child = helper_compile(node[1])
+        return lambda tags: not child(tags)
+    key = node[1]
+    if kind == "exists":
+        return lambda tags: key in tags
+    if kind == "eq":
+        value = node[2]
+        return lambda tags: tags.get(key) == value
+    if kind == "in":
+        values = node[2]
+        return lambda tags: tags.get(key) in values
+    prefix = node[2]
+    return lambda tags: key in tags and tags[key].startswith(prefix)
+
+class TagQuery:
+    '''
+    Tag query compiled once and evaluated against many tag sets, see the top of s3_tagquery.py for the syntax.
+
+    Accepted as `tags` by s3_get.get_buckets_with_tags(), s3_get.get_objects_with_tags_from_bucket()
+    and the s3_index.TagIndex queries, which translate it to SQL over the index.
+
+    Parameters:
+    `query` str
+        e.g. 'cell-type in {A, B} and not test-status = failed'
+
+    Example Use:
+        query = TagQuery("cell-type in {A, B} and not test-status = failed")
+        query.matches({"cell-type": "A", "test-status": "passed"}) #True
+    '''
+    def __init__(self, query: str):
+        assert isinstance(query, str), f"Invalid type(query) = {type(query)}"
+        self.query = query
+        self.tree = TagQueryParser(helper_tokenize(query), query).parse() if query.strip() else ("true",)
+        self._matches = helper_compile(self.tree)
+
+    @classmethod
+    def from_tags(cls, tags: dict) -> "TagQuery":
+        '''
+        Returns the query matching the tag sets that contain every key-value pair of `tags`.
+
+        Parameters:
+        `tags` dict
+            regular key-value pairs {key_arg1: value_arg1, key_arg2: value_arg2}
+        '''
+        query = cls.__new__(cls)
+        query.query = " and ".join(f'"{tkey}" = "{tval}"' for tkey, tval in tags.items())
+        children = [("eq", tkey, tval) for tkey, tval in tags.items()]
+        query.tree = ("true",) if not children else children[0] if len(children) == 1 else ("and", children)
+        query._matches = helper_compile(query.tree)
+        return query
+
+    def __repr__(self):
+        return f"TagQuery({self.query!r})"
+
+    def matches(self, tags: dict) -> bool:
+        '''
+        Returns True if the tag set `tags` satisfies the query.
+
+        Parameters:
+        `tags` dict
+            regular key-value pairs, see s3_generate.gen_python_dict_from_tagging_list()
+        '''
+        return self._matches(tags)
+
+    __call__ = matches
+
+    def to_sql(self, column: str, select_column: str, table: str, scope: str = "", scope_params: list = None) -> tuple[str, list]:
+        '''
+        Returns the SQL condition and its parameters selecting the `column` values whose tags satisfy the query.
+
+        Every comparison is an IN subquery on `table` (tag_key, tag_value rows) served by its index.
+
+        Parameters:
+        `column` str
+            the outer column the condition applies to, e.g. "o.key"
+        `select_column` str
+            the matching column of `table`, e.g. "key"
+        `table` str
+            the tag table, e.g. "object_tags"
+        `scope` str
+            SQL prepended to every subquery condition, e.g. "bucket = ? AND "
+        `scope_params` list
+            the parameters of `scope`
+        '''
+        scope_params = scope_params or []
+        def sql(node) -> tuple[str, list]:
+            kind = node[0]
+            if kind == "true":
+                return "1", []
+            if kind in ("and", "or"):
+                parts = [sql(child) for child in node[1]]
+                return (f" {kind.upper()} ".join(f"({part})" for part, _ in parts),
+                        [param for _, params in parts for param in params])
+            if kind == "not":
+                part, params = sql(node[1])
+                return f"NOT ({part})", params
+            subquery = f"{column} IN (SELECT {select_column} FROM {table} WHERE {scope}tag_key = ?"
+            params = [*scope_params, node[1]]
+            if kind == "eq":
+                subquery += " AND tag_value = ?"
+                params.append(node[2])
+            elif kind == "in":
+                subquery += f" AND tag_value IN ({', '.join('?' * len(node[2]))})"
+                params.extend(sorted(node[2]))
+            elif kind == "prefix": #range condition so the index is used
+                subquery += " AND tag_value >= ? AND substr(tag_value, 1, ?) = ?"
+                params.extend([node[2], len(node[2]), node[2]])
+            return subquery + ")", params
+        return sql(self.tree)
+
+def compile_tag_query(tags: "str|dict|TagQuery") -> TagQuery:
+    '''
+    Returns `tags` as a TagQuery: query strings are parsed, dicts become exact AND matches, queries are kept.
+
+    Parameters:
+    `tags` str|dict|TagQuery
+        a query string, regular key-value pairs {key_arg1: value_arg1}, or a compiled query
+    '''
+    if isinstance(tags, TagQuery): return tags
+    if isinstance(tags, str): return TagQuery(tags)
+    assert isinstance(tags, dict), f"Invalid type(tags) = {type(tags)}"
+    return TagQuery.from_tags(tags)
@@ -0,0 +1,281 @@
+from botocore.exceptions import ClientError
+import asyncio
+import contextlib
+import random
+import threading
+import time
+
+from s3_metrics import THROTTLE_CODES, thread_throttles
+from s3_parallel import bounded_map
+
+# S3 scales request rates per key prefix and answers 503 SlowDown while a hot prefix is being scaled.
+# AdaptiveLimiter keeps one concurrency budget per (bucket, prefix): every successful request adds
+# `increase / limit` to the prefix's limit (about +`increase` per round of requests), a throttled one
+# multiplies it by `decrease`, at most once per `cooldown` seconds so one burst of 503s halves it once.
+# Requests over the limit wait for a slot, so a hot prefix backs off while the others keep their rate.
+# Retrying is left to botocore (s3_client.configure_clients(max_attempts)), the limiter does not add
+# its own retries on top: throttles retried inside botocore are seen through s3_metrics, or through
+# the RetryAttempts of the response for the asyncio clients. Only the keys a successful delete_objects
+# reports as throttled, which botocore never retries, are sent again after a jittered exponential backoff.
+# The bulk operations (tagging, deletes, uploads, tag scans, local batch jobs, compaction, log ingestion,
+# and their s3_async versions) all run their requests through the shared limiter returned by get_limiter().
+
+def is_throttle_error(err: Exception) -> bool:
+    '''
+    Returns True if `err` is a ClientError telling the client to slow down (503 or a SlowDown-like code).
+
+    Parameters:
+    `err` Exception
+    '''
+    if not isinstance(err, ClientError):
+        return False
+    status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+    return status == 503 or err.response.get("Error", {}).get("Code") in THROTTLE_CODES
+
+class AdaptiveLimiter:
+    '''
+    Thread-safe AIMD concurrency limiter with one budget per bucket and key prefix.
+
+    Parameters:
+    `initial_limit` int
+        the number of concurrent requests a prefix starts with.
+    `min_limit` int
+        the lowest limit a throttled prefix is cut to.
+    `max_limit` int
+        the highest limit a prefix grows to.
+    `increase` float
+        the additive increase, the limit grows by about `increase` per `limit` successful requests.
+    `decrease` float
+        the multiplicative decrease applied to the limit when a request of the prefix is throttled.
+    `cooldown` float
+        the minimum number of seconds between two decreases of a prefix.
+    `prefix_depth` int
+        the number of "/"-separated key components forming the prefix, e.g. 1 gives "logs/" for "logs/2024/a.gz".
+    `max_attempts` int
+        the number of attempts of a delete_objects batch whose keys are reported as throttled.
+    `base_delay` float
+        the backoff ceiling in seconds of the first retry, doubled for every following retry.
+    `max_delay` float
+        the largest backoff ceiling in seconds.
+    `enabled` bool
+        if False, calls run without waiting for a budget.
+    '''
+    def __init__(self, initial_limit: int = 32, min_limit: int = 1, max_limit: int = 1024,
+                 increase: float = 1.0, decrease: float = 0.5, cooldown: float = 1.0, prefix_depth: int = 1,
+                 max_attempts: int = 8, base_delay: float = 0.05, max_delay: float = 20.0, enabled: bool = True):
+        assert 1 <= min_limit <= initial_limit <= max_limit, "Invalid limits, need min_limit <= initial_limit <= max_limit"
+        assert 0 < decrease < 1, f"Invalid decrease = {decrease}"
+        assert isinstance(max_attempts, int) and max_attempts > 0, f"Invalid max_attempts = {max_attempts}"
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.prefix_depth = prefix_depth
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.enabled = enabled
+        self._condition = threading.Condition()
+        self._async_waiters = set() #(event loop, future) of the coroutines waiting in async_slot()
+        self.budgets = {}
+
+    def prefix_of(self, key: str) -> str:
+        '''Returns the budget prefix of `key`: its first `prefix_depth` folders, "" for top-level keys'''
+        folders = key.split("/")[:-1][:self.prefix_depth]
+        return "".join(folder + "/" for folder in folders)
+
+    def helper_budget(self, bucket_name: str, key: str) -> dict:
+        '''helper for the limiter methods, the budget of `key`'s prefix, created on first use (lock held)'''
+        name = (bucket_name, self.prefix_of(key))
+        budget = self.budgets.get(name)
+        if budget is None:
+            budget = self.budgets[name] = {"limit": float(self.initial_limit), "in_flight": 0, "requests": 0,
+                                           "throttles": 0, "last_decrease": 0.0}
+        return budget
+
+    def helper_notify(self):
+        '''helper for the limiter methods, wakes the threads and coroutines waiting for a slot (lock held)'''
+        self._condition.notify_all()
+        for loop, waiter in self._async_waiters:
+            loop.call_soon_threadsafe(lambda waiter = waiter: waiter.done() or waiter.set_result(None))
+        self._async_waiters.clear()
+
+    @contextlib.contextmanager
+    def slot(self, bucket_name: str, key: str):
+        '''
+        Context manager waiting until `key`'s prefix is under its limit and holding one of its slots.
+
+        Parameters:
+        `bucket_name` str
+        `key` str
+            the object key, or any key under the prefix the request applies to.
+        '''
+        with self._condition:
+            budget = self.helper_budget(bucket_name, key)
+            while budget["in_flight"] >= int(budget["limit"]):
+                self._condition.wait()
+            budget["in_flight"] += 1
+        try:
+            yield budget
+        finally:
+            with self._condition:
+                budget["in_flight"] -= 1
+                self.helper_notify()
+
+    @contextlib.asynccontextmanager
+    async def async_slot(self, bucket_name: str, key: str):
+        '''
+        Async context manager waiting, without blocking the event loop, until `key`'s prefix is under its limit.
+
+        Same budgets as slot(), threads and coroutines share them.
+
+        Parameters:
+        `bucket_name` str
+        `key` str
+            the object key, or any key under the prefix the request applies to.
+        '''
+        while True:
+            with self._condition:
+                budget = self.helper_budget(bucket_name, key)
+                if budget["in_flight"] < int(budget["limit"]):
+                    budget["in_flight"] += 1
+                    break
+                loop = asyncio.get_running_loop()
+                waiter = loop.create_future()
+                self._async_waiters.add((loop, waiter))
+            await waiter
+        try:
+            yield budget
+        finally:
+            with self._condition:
+                budget["in_flight"] -= 1
+                self.helper_notify()
+
+    def record(self, bucket_name: str, key: str, throttled: bool):
+        '''
+        Adjusts the limit of `key`'s prefix after one request: additive increase, or multiplicative decrease if `throttled`.
+
+        Parameters:
+        `bucket_name` str
+        `key` str
+        `throttled` bool
+            if True, the request (or one of its attempts) was throttled.
+        '''
+        with self._condition:
+            budget = self.helper_budget(bucket_name, key)
+            budget["requests"] += 1
+            if not throttled:
+                budget["limit"] = min(self.max_limit, budget["limit"] + self.increase / budget["limit"])
+                if budget["in_flight"] < int(budget["limit"]): self.helper_notify()
+                return
+            budget["throttles"] += 1
+            now = time.monotonic()
+            if now - budget["last_decrease"] >= self.cooldown:
+                budget["limit"] = max(self.min_limit, budget["limit"] * self.decrease)
+                budget["last_decrease"] = now
+
+    def backoff(self, attempt: int) -> float:
+        '''Returns a "full jitter" delay in seconds before retry number `attempt` (0 for the first retry)'''
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, bucket_name: str, key: str, func, *args, **kwargs):
+        '''
+        Returns `func(*args, **kwargs)` run within the budget of `key`'s prefix.
+
+        Errors are raised as is, retries are botocore's. The calling thread's throttled attempts
+        retried by botocore, and a throttle error reaching the caller, count against the prefix.
+
+        Parameters:
+        `bucket_name` str
+        `key` str
+            the object key, or any key under the prefix the request applies to.
+        `func` callable
+            makes the request.
+        '''
+        if not self.enabled:
+            return func(*args, **kwargs)
+        with self.slot(bucket_name, key):
+            throttles = thread_throttles()
+            try:
+                result = func(*args, **kwargs)
+            except ClientError as err:
+                if is_throttle_error(err): self.record(bucket_name, key, True)
+                raise
+            self.record(bucket_name, key, thread_throttles() > throttles)
+            return result
+
+    async def async_call(self, bucket_name: str, key: str, func, *args, **kwargs):
+        '''
+        Returns `await func(*args, **kwargs)` run within the budget of `key`'s prefix, see call().
+
+        The coroutines of an event loop share one thread, so the request counts as throttled
+        when its response reports botocore retries (RetryAttempts), or when a throttle error is raised.
+
+        Parameters:
+        `bucket_name` str
+        `key` str
+        `func` coroutine function
+            makes the request, e.g. an aiobotocore client method.
+        '''
+        if not self.enabled:
+            return await func(*args, **kwargs)
+        async with self.async_slot(bucket_name, key):
+            try:
+                result = await func(*args, **kwargs)
+            except ClientError as err:
+                if is_throttle_error(err): self.record(bucket_name, key, True)
+                raise
+            retries = result.get("ResponseMetadata", {}).get("RetryAttempts", 0) if isinstance(result, dict) else 0
+            self.record(bucket_name, key, retries > 0)
+            return result
+
+    def map(self, func, items, bucket_name: str, key_of = None, max_workers: int = 16, max_in_flight: int = None):
+        '''
+        Lazily yields `func(item)` for every item, in order, like s3_parallel.bounded_map(),
+        with every call run through call() under the budget of `key_of(item)`.
+
+        Parameters:
+        `func` callable
+            makes the item's request(s), must be safe to repeat.
+        `items` iterable
+        `bucket_name` str
+        `key_of` callable
+            returns the key of an item, defaults to None: the item itself if it is a str, else item["Key"].
+        `max_workers` int
+        `max_in_flight` int
+            see s3_parallel.bounded_map()
+        '''
+        if key_of is None:
+            key_of = lambda item: item if isinstance(item, str) else item["Key"]
+        return bounded_map(lambda item: self.call(bucket_name, key_of(item), func, item),
+                           items, max_workers, max_in_flight)
+
+    def snapshot(self) -> dict:
+        '''Returns {(bucket, prefix): {"limit", "in_flight", "requests", "throttles"}} for every budget used'''
+        with self._condition:
+            return dict((name, {"limit": budget["limit"], "in_flight": budget["in_flight"],
+                                "requests": budget["requests"], "throttles": budget["throttles"]})
+                        for name, budget in self.budgets.items())
+
+_limiter = AdaptiveLimiter()
+
+def get_limiter() -> AdaptiveLimiter:
+    '''Returns the limiter shared by the bulk operations'''
+    return _limiter
+
+def configure_limiter(**settings) -> AdaptiveLimiter:
+    '''
+    Replaces the shared limiter by one with the given settings and returns it, the budgets start over.
+
+    Parameters:
+    the AdaptiveLimiter parameters, the ones not given keep their current value,
+    e.g. configure_limiter(initial_limit = 8, prefix_depth = 2) or configure_limiter(enabled = False).
+    '''
+    global _limiter
+    current = dict((name, getattr(_limiter, name)) for name in (
+        "initial_limit", "min_limit", "max_limit", "increase", "decrease", "cooldown", "prefix_depth",
+        "max_attempts", "base_delay", "max_delay", "enabled"))
+    _limiter = AdaptiveLimiter(**(current | settings))
+    return _limiter
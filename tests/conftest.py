@@ -0,0 +1,63 @@
+import os
+import sys
+import threading
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# the modules are flat at the root of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from s3_client import get_client
+
+@pytest.fixture
+def session(monkeypatch):
+    '''boto3 session whose S3 requests go to moto's in-memory S3'''
+    #moto's list_object_versions copies every key while the deletes of other threads remove keys,
+    #which fails the listing (real S3 does not), so moto serves them one at a time
+    from moto.s3.models import S3Backend
+    lock = threading.Lock()
+    list_object_versions, delete_objects = S3Backend.list_object_versions, S3Backend.delete_objects
+
+    def serialized_listing(*args, **kwargs):
+        with lock:
+            return list_object_versions(*args, **kwargs)
+
+    def conditional_delete(self, bucket_name, objects, *args, **kwargs):
+        #moto ignores the ETag of the deleted objects, S3 keeps an object whose ETag does not match
+        with lock:
+            keys = self.get_bucket(bucket_name).keys
+            matching = [obj for obj in objects if "ETag" not in obj or obj["Key"] not in keys
+                        or keys[obj["Key"]].etag.strip('"') == obj["ETag"].strip('"')]
+            deleted, errors = delete_objects(self, bucket_name, matching, *args, **kwargs)
+            return deleted, errors + [obj["Key"] for obj in objects if obj not in matching]
+
+    monkeypatch.setattr(S3Backend, "list_object_versions", serialized_listing)
+    monkeypatch.setattr(S3Backend, "delete_objects", conditional_delete)
+    with mock_aws():
+        yield boto3.session.Session(region_name = "us-east-1")
+
+@pytest.fixture
+def s3_client(session):
+    return get_client(session)
+
+def put_objects(s3_client, bucket_name: str, keys, body: bytes = b"data"):
+    '''Writes `body` at every key of `keys`'''
+    for key in keys:
+        s3_client.put_object(Bucket = bucket_name, Key = key, Body = body)
+
+def list_keys(s3_client, bucket_name: str, prefix: str = "") -> list[str]:
+    '''Returns the current keys under `prefix`'''
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return [obj["Key"] for page in paginator.paginate(Bucket = bucket_name, Prefix = prefix)
+            for obj in page.get("Contents", [])]
+
+def list_versions(s3_client, bucket_name: str, prefix: str = "") -> tuple[list[dict], list[dict]]:
+    '''Returns the versions and delete markers under `prefix`'''
+    versions, markers = [], []
+    paginator = s3_client.get_paginator("list_object_versions")
+    for page in paginator.paginate(Bucket = bucket_name, Prefix = prefix):
+        versions.extend(page.get("Versions", []))
+        markers.extend(page.get("DeleteMarkers", []))
+    return versions, markers
@@ -0,0 +1,30 @@
+import os
+
+from conftest import put_objects
+from s3_cache import ObjectCache
+
+BUCKET = "cached-bucket"
+
+def test_pinned_entries_are_not_evicted(session, s3_client, tmp_path):
+    s3_client.create_bucket(Bucket = BUCKET)
+    put_objects(s3_client, BUCKET, ["a", "b", "c"], b"x" * 100)
+    cache = ObjectCache(session, cache_dir = str(tmp_path), max_bytes = 150)
+    with cache.pinned(BUCKET, "a") as path:
+        cache.fetch(BUCKET, "b")
+        cache.fetch(BUCKET, "c")
+        assert os.path.exists(path)
+        with open(path, "rb") as file:
+            assert file.read() == b"x" * 100
+    #the entries fetched while "a" was pinned are evicted in its place
+    assert os.path.exists(path)
+    assert cache.size <= 150
+    assert cache.stats["Evicted"] == 2
+
+def test_get_maps_the_cached_copy(session, s3_client, tmp_path):
+    s3_client.create_bucket(Bucket = BUCKET)
+    put_objects(s3_client, BUCKET, ["a", "b"], b"y" * 100)
+    cache = ObjectCache(session, cache_dir = str(tmp_path), max_bytes = 150)
+    first = cache.get(BUCKET, "a")
+    assert cache.get(BUCKET, "b")[:] == b"y" * 100
+    assert first[:] == b"y" * 100 #still readable once evicted
+    assert cache.stats["Misses"] == 2 and cache.stats["Evicted"] == 1
@@ -0,0 +1,85 @@
+import io
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from conftest import list_keys, put_objects
+from s3_compact import compact_prefix
+
+BUCKET = "logging-bucket"
+
+@pytest.fixture
+def bucket(s3_client):
+    s3_client.create_bucket(Bucket = BUCKET)
+    return BUCKET
+
+def test_text_objects_are_merged_and_deleted(session, s3_client, bucket):
+    lines = [f"line {i}\n".encode() for i in range(30)]
+    for i, line in enumerate(lines):
+        put_objects(s3_client, bucket, [f"melon/{i:02d}"], line)
+    put_objects(s3_client, bucket, ["melon-other/0"])
+
+    result = compact_prefix(session, bucket, "melon/", min_age_hours = 0, verbose = False)
+
+    assert result["Merged"] == 30 and result["Deleted"] == 30 and not result["Errors"]
+    assert len(result["Written"]) == 1 and result["Written"][0].startswith("compacted/melon/")
+    assert list_keys(s3_client, bucket, "melon/") == []
+    assert list_keys(s3_client, bucket, "melon-other/") == ["melon-other/0"]
+    merged = s3_client.get_object(Bucket = bucket, Key = result["Written"][0])["Body"].read()
+    assert sorted(merged.splitlines(keepends = True)) == sorted(lines)
+
+def test_second_run_leaves_merged_files_alone(session, s3_client, bucket):
+    put_objects(s3_client, bucket, (f"melon/{i}" for i in range(5)), b"x\n")
+    first = compact_prefix(session, bucket, "melon/", min_age_hours = 0, verbose = False)
+
+    second = compact_prefix(session, bucket, "melon/", min_age_hours = 0, verbose = False)
+
+    assert second["Merged"] == 0 and not second["Written"]
+    assert list_keys(s3_client, bucket) == first["Written"]
+
+def test_parquet_objects_are_merged(session, s3_client, bucket):
+    for i in range(4):
+        buffer = io.BytesIO()
+        pq.write_table(pa.table({"cycle": [i, i], "voltage": [3.7, 3.8]}), buffer)
+        put_objects(s3_client, bucket, [f"cells/{i}.parquet"], buffer.getvalue())
+
+    result = compact_prefix(session, bucket, "cells/", min_age_hours = 0, verbose = False)
+
+    assert result["Merged"] == 4 and result["Deleted"] == 4 and not result["Errors"]
+    body = s3_client.get_object(Bucket = bucket, Key = result["Written"][0])["Body"].read()
+    table = pq.read_table(pa.BufferReader(body))
+    assert sorted(table["cycle"].to_pylist()) == [0, 0, 1, 1, 2, 2, 3, 3]
+
+def test_keep_originals_and_dry_run(session, s3_client, bucket):
+    put_objects(s3_client, bucket, (f"melon/{i}" for i in range(3)), b"x\n")
+
+    dry = compact_prefix(session, bucket, "melon/", min_age_hours = 0, dry_run = True, verbose = False)
+    assert dry["DryRun"] and len(dry["Written"]) == 1 and list_keys(s3_client, bucket) == ["melon/0", "melon/1", "melon/2"]
+
+    kept = compact_prefix(session, bucket, "melon/", min_age_hours = 0, delete_originals = False, verbose = False)
+    assert kept["Deleted"] == 0 and len(list_keys(s3_client, bucket, "melon/")) == 3
+
+def test_source_rewritten_after_its_read_is_kept(session, s3_client, bucket):
+    put_objects(s3_client, bucket, (f"melon/{i}" for i in range(3)), b"x\n")
+    def rewrite(params, **kwargs): #once the merged file is uploaded
+        if params["Key"].startswith("compacted/"):
+            s3_client.put_object(Bucket = bucket, Key = "melon/1", Body = b"late record\n")
+    s3_client.meta.events.register("provide-client-params.s3.HeadObject", rewrite)
+
+    result = compact_prefix(session, bucket, "melon/", min_age_hours = 0, verbose = False)
+
+    assert result["Deleted"] == 2 and [error["Keys"] for error in result["Errors"]] == [["melon/1"]]
+    assert list_keys(s3_client, bucket, "melon/") == ["melon/1"]
+    assert s3_client.get_object(Bucket = bucket, Key = "melon/1")["Body"].read() == b"late record\n"
+
+def test_kms_bucket_is_verified_by_size(session, s3_client, bucket):
+    put_objects(s3_client, bucket, (f"melon/{i}" for i in range(3)), b"x\n")
+    def kms_etag(parsed, **kwargs): #S3 gives SSE-KMS objects an ETag that is not their MD5
+        parsed["ServerSideEncryption"] = "aws:kms"
+        parsed["ETag"] = '"%032x"' % id(parsed)
+    s3_client.meta.events.register("after-call.s3.HeadObject", kms_etag)
+
+    result = compact_prefix(session, bucket, "melon/", min_age_hours = 0, verbose = False)
+
+    assert result["Merged"] == 3 and result["Deleted"] == 3 and not result["Errors"]
@@ -0,0 +1,97 @@
+import pytest
+
+from conftest import list_keys, put_objects
+from s3_copy import copy_objects
+from s3_generate import gen_python_dict_from_tagging_list
+
+BUCKET = "source-bucket"
+DESTINATION = "destination-bucket"
+
+@pytest.fixture
+def buckets(s3_client):
+    for bucket in (BUCKET, DESTINATION):
+        s3_client.create_bucket(Bucket = bucket)
+    put_objects(s3_client, BUCKET, (f"raw/{i:02d}.csv" for i in range(12)), b"a,b\n1,2\n")
+    s3_client.put_object_tagging(Bucket = BUCKET, Key = "raw/00.csv",
+                                 Tagging = {"TagSet": [{"Key": "project", "Value": "melon"}]})
+    put_objects(s3_client, BUCKET, ["other/00.csv"])
+
+def test_move_deletes_verified_sources(session, s3_client, buckets):
+    result = copy_objects(session, BUCKET, "raw/", DESTINATION, "processed/", move = True,
+                          max_workers = 4, verbose = False)
+
+    assert result["Deleted"] == 12 and result["Bytes"] == 12 * 8 and not result["Errors"]
+    assert sorted(result["Copied"]) == [f"processed/{i:02d}.csv" for i in range(12)]
+    assert list_keys(s3_client, BUCKET) == ["other/00.csv"]
+    assert list_keys(s3_client, DESTINATION) == sorted(result["Copied"])
+    assert s3_client.get_object(Bucket = DESTINATION, Key = "processed/05.csv")["Body"].read() == b"a,b\n1,2\n"
+    tags = s3_client.get_object_tagging(Bucket = DESTINATION, Key = "processed/00.csv")["TagSet"]
+    assert gen_python_dict_from_tagging_list(tags) == {"project": "melon"}
+
+def test_move_within_prefix_skips_copies(session, s3_client, buckets):
+    result = copy_objects(session, BUCKET, "raw/", BUCKET, "raw/archive/", move = True, verbose = False)
+
+    assert result["Deleted"] == 12 and not result["Errors"]
+    assert list_keys(s3_client, BUCKET, "raw/") == [f"raw/archive/{i:02d}.csv" for i in range(12)]
+
+def test_failed_copy_keeps_its_source(session, s3_client, buckets):
+    objects = [{"Key": "raw/00.csv", "Size": 8}, {"Key": "raw/missing.csv", "Size": 8}]
+
+    result = copy_objects(session, BUCKET, "raw/", DESTINATION, "processed/", objects = objects, move = True,
+                          verbose = False)
+
+    assert result["Copied"] == ["processed/00.csv"] and result["Deleted"] == 1
+    assert [error["Key"] for error in result["Errors"]] == ["raw/missing.csv"]
+    assert "raw/00.csv" not in list_keys(s3_client, BUCKET, "raw/")
+
+def test_dry_run_moves_nothing(session, s3_client, buckets):
+    result = copy_objects(session, BUCKET, "raw/", DESTINATION, "processed/", move = True, dry_run = True,
+                          verbose = False)
+
+    assert len(result["Copied"]) == 12 and result["Deleted"] == 0
+    assert len(list_keys(s3_client, BUCKET, "raw/")) == 12 and not list_keys(s3_client, DESTINATION)
+
+def test_move_onto_itself_is_refused(session, buckets):
+    with pytest.raises(AssertionError):
+        copy_objects(session, BUCKET, "raw/", BUCKET, "raw/", move = True, verbose = False)
+
+def overwrite_after_copy(s3_client, source_key: str, destination_key: str):
+    '''Overwrites `source_key` right after the copy at `destination_key` is verified, before the move deletes it'''
+    def overwrite(params, **kwargs):
+        if params["Key"] == destination_key:
+            s3_client.put_object(Bucket = BUCKET, Key = source_key, Body = b"written after the copy")
+    s3_client.meta.events.register("provide-client-params.s3.HeadObject", overwrite)
+
+def test_move_keeps_source_overwritten_after_its_copy(session, s3_client, buckets):
+    overwrite_after_copy(s3_client, "raw/03.csv", "processed/03.csv")
+
+    result = copy_objects(session, BUCKET, "raw/", DESTINATION, "processed/", move = True, verbose = False)
+
+    assert result["Deleted"] == 11 and [error["Key"] for error in result["Errors"]] == ["raw/03.csv"]
+    assert list_keys(s3_client, BUCKET, "raw/") == ["raw/03.csv"]
+    assert s3_client.get_object(Bucket = BUCKET, Key = "raw/03.csv")["Body"].read() == b"written after the copy"
+    assert s3_client.get_object(Bucket = DESTINATION, Key = "processed/03.csv")["Body"].read() == b"a,b\n1,2\n"
+
+def test_versioned_move_deletes_the_copied_version(session, s3_client):
+    s3_client.create_bucket(Bucket = BUCKET)
+    s3_client.put_bucket_versioning(Bucket = BUCKET, VersioningConfiguration = {"Status": "Enabled"})
+    put_objects(s3_client, BUCKET, ["raw/0.csv", "raw/1.csv"], b"copied")
+    overwrite_after_copy(s3_client, "raw/1.csv", "archive/1.csv")
+
+    result = copy_objects(session, BUCKET, "raw/", BUCKET, "archive/", move = True, verbose = False)
+
+    assert result["Deleted"] == 2 and not result["Errors"]
+    assert list_keys(s3_client, BUCKET, "raw/") == ["raw/1.csv"]
+    assert s3_client.get_object(Bucket = BUCKET, Key = "raw/1.csv")["Body"].read() == b"written after the copy"
+    assert not s3_client.list_object_versions(Bucket = BUCKET, Prefix = "raw/0.csv").get("DeleteMarkers")
+
+def test_move_of_kms_encrypted_objects_checks_size_only(session, s3_client, buckets):
+    def kms_etag(parsed, http_response, **kwargs): #S3 gives SSE-KMS copies an ETag that is not their MD5
+        parsed["ServerSideEncryption"] = "aws:kms"
+        if "/processed/" in http_response.url: parsed["ETag"] = '"%032x"' % id(parsed)
+    s3_client.meta.events.register("after-call.s3.HeadObject", kms_etag)
+
+    result = copy_objects(session, BUCKET, "raw/", DESTINATION, "processed/", move = True, verbose = False)
+
+    assert result["Deleted"] == 12 and not result["Errors"]
+    assert not list_keys(s3_client, BUCKET, "raw/")
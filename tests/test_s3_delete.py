@@ -0,0 +1,111 @@
+import pytest
+
+from conftest import list_keys, list_versions, put_objects
+from s3_delete import cleanup_versions, delete_keys, delete_objects__with_prefix
+
+BUCKET = "delete-bucket"
+
+@pytest.fixture
+def bucket(s3_client):
+    s3_client.create_bucket(Bucket = BUCKET)
+    return BUCKET
+
+@pytest.fixture
+def versioned_bucket(s3_client, bucket):
+    s3_client.put_bucket_versioning(Bucket = bucket, VersioningConfiguration = {"Status": "Enabled"})
+    return bucket
+
+def test_delete_keys_deletes_across_batches(session, s3_client, bucket):
+    put_objects(s3_client, bucket, (f"data/{i:04d}" for i in range(1205)), b"12345")
+    put_objects(s3_client, bucket, ["keep/0"])
+    listed = (obj for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket = bucket, Prefix = "data/")
+              for obj in page["Contents"])
+
+    result = delete_keys(session, bucket, listed, max_workers = 4, verbose = False)
+
+    assert result == {"Deleted": 1205, "Bytes": 1205 * 5, "Errors": [], "DryRun": False}
+    assert list_keys(s3_client, bucket) == ["keep/0"]
+
+def test_delete_keys_dry_run_deletes_nothing(session, s3_client, bucket):
+    put_objects(s3_client, bucket, ["a", "b"])
+
+    result = delete_keys(session, bucket, [{"Key": "a"}, {"Key": "b"}], verbose = False, dry_run = True)
+
+    assert result["Deleted"] == 2 and result["DryRun"]
+    assert list_keys(s3_client, bucket) == ["a", "b"]
+
+def test_delete_keys_deletes_given_versions_only(session, s3_client, versioned_bucket):
+    put_objects(s3_client, versioned_bucket, ["a"], b"old")
+    put_objects(s3_client, versioned_bucket, ["a"], b"new")
+    versions, _ = list_versions(s3_client, versioned_bucket)
+    old = [version for version in versions if not version["IsLatest"]]
+
+    result = delete_keys(session, versioned_bucket, old, verbose = False)
+
+    assert result["Deleted"] == 1 and not result["Errors"]
+    versions, markers = list_versions(s3_client, versioned_bucket)
+    assert [version["IsLatest"] for version in versions] == [True] and not markers
+    assert s3_client.get_object(Bucket = versioned_bucket, Key = "a")["Body"].read() == b"new"
+
+def test_delete_objects_with_prefix_removes_every_version(session, s3_client, versioned_bucket):
+    for _ in range(2):
+        put_objects(s3_client, versioned_bucket, (f"data/{i}" for i in range(600)))
+    s3_client.delete_object(Bucket = versioned_bucket, Key = "data/0")
+    put_objects(s3_client, versioned_bucket, ["other/0"])
+
+    result = delete_objects__with_prefix(session, versioned_bucket, "data/", verbose = False)
+
+    assert result["Deleted"] == 1201 and not result["Errors"]
+    versions, markers = list_versions(s3_client, versioned_bucket)
+    assert [version["Key"] for version in versions] == ["other/0"] and not markers
+
+def test_delete_objects_with_prefix_streams_several_pages(session, s3_client, versioned_bucket):
+    #3 versions of 1,100 keys: 4 list_object_versions pages, deleted while the next pages are listed
+    for body in (b"1", b"22", b"333"):
+        put_objects(s3_client, versioned_bucket, (f"data/{i:04d}" for i in range(1100)), body)
+    pages = []
+    s3_client.meta.events.register("after-call.s3.ListObjectVersions", lambda **kwargs: pages.append(1))
+
+    result = delete_objects__with_prefix(session, versioned_bucket, "data/", max_workers = 4, verbose = False)
+
+    assert len(pages) == 4
+    assert result["Deleted"] == 3300 and result["Bytes"] == 1100 * 6 and not result["Errors"]
+    assert list_versions(s3_client, versioned_bucket) == ([], [])
+
+def put_history(s3_client, bucket_name: str):
+    '''Writes logs/a with 3 versions, logs/b deleted after one version and logs/c with one version'''
+    for body in (b"1", b"22", b"333"):
+        put_objects(s3_client, bucket_name, ["logs/a"], body)
+    put_objects(s3_client, bucket_name, ["logs/b"], b"4444")
+    s3_client.delete_object(Bucket = bucket_name, Key = "logs/b")
+    put_objects(s3_client, bucket_name, ["logs/c"], b"55555")
+
+def test_cleanup_versions_keeps_newest_versions(session, s3_client, versioned_bucket):
+    put_history(s3_client, versioned_bucket)
+
+    result = cleanup_versions(session, versioned_bucket, "logs/", keep_versions = 1, verbose = False)
+
+    assert result["Deleted"] == 2 and result["BytesReclaimed"] == 1 + 2 and not result["Errors"]
+    versions, markers = list_versions(s3_client, versioned_bucket)
+    assert sorted(version["Key"] for version in versions) == ["logs/a", "logs/b", "logs/c"]
+    assert [marker["Key"] for marker in markers] == ["logs/b"]
+    assert s3_client.get_object(Bucket = versioned_bucket, Key = "logs/a")["Body"].read() == b"333"
+
+def test_cleanup_versions_purges_deleted_keys(session, s3_client, versioned_bucket):
+    put_history(s3_client, versioned_bucket)
+
+    result = cleanup_versions(session, versioned_bucket, "logs/", keep_versions = 0, verbose = False)
+
+    #the current objects stay, b's version goes and then its marker, left without versions
+    assert result["Deleted"] == 4 and result["BytesReclaimed"] == 1 + 2 + 4 and not result["Errors"]
+    versions, markers = list_versions(s3_client, versioned_bucket)
+    assert sorted(version["Key"] for version in versions) == ["logs/a", "logs/c"] and not markers
+
+def test_cleanup_versions_dry_run_deletes_nothing(session, s3_client, versioned_bucket):
+    for body in (b"1", b"22"):
+        put_objects(s3_client, versioned_bucket, ["logs/a"], body)
+
+    result = cleanup_versions(session, versioned_bucket, "logs/", dry_run = True, verbose = False)
+
+    assert result["Deleted"] == 1 and result["DryRun"]
+    assert len(list_versions(s3_client, versioned_bucket)[0]) == 2
@@ -0,0 +1,28 @@
+import pytest
+
+from conftest import put_objects
+from s3_get import get_objects_with_tags_from_bucket
+
+BUCKET = "tagged-bucket"
+
+@pytest.fixture
+def bucket(s3_client):
+    s3_client.create_bucket(Bucket = BUCKET)
+    put_objects(s3_client, BUCKET, (f"data/{i:04d}" for i in range(1100))) #more than one listing page
+    for i in range(0, 1100, 3):
+        tags = [{"Key": "project", "Value": "melon"}, {"Key": "cell", "Value": "A" if i % 2 else "B"}]
+        s3_client.put_object_tagging(Bucket = BUCKET, Key = f"data/{i:04d}", Tagging = {"TagSet": tags})
+    return BUCKET
+
+@pytest.mark.parametrize("max_workers, max_in_flight", [(4, None), (16, 64)])
+def test_concurrent_tag_fetch_matches_sequential(session, bucket, max_workers, max_in_flight):
+    tags = {"project": "melon"}
+    sequential = get_objects_with_tags_from_bucket(session, bucket, tags, "data/", s3_format = False)
+
+    concurrent = get_objects_with_tags_from_bucket(session, bucket, tags, "data/", s3_format = False,
+                                                   max_workers = max_workers, max_in_flight = max_in_flight)
+
+    assert len(sequential) == 367
+    assert [obj["Key"] for obj, _ in sequential] == sorted(obj["Key"] for obj, _ in sequential)
+    assert concurrent == sequential
+    assert all(tag_dict["project"] == "melon" and tag_dict["cell"] in ("A", "B") for _, tag_dict in concurrent)
@@ -0,0 +1,62 @@
+import csv
+import datetime
+import gzip
+import io
+import json
+import time
+
+import pytest
+
+from conftest import put_objects
+from s3_inventory import Inventory
+
+BUCKET = "inventoried-bucket"
+DESTINATION = "inventory-bucket"
+SCHEMA = "Bucket, Key, VersionId, IsLatest, IsDeleteMarker, Size, LastModifiedDate, ETag, StorageClass"
+
+@pytest.fixture
+def inventory(session, s3_client, tmp_path):
+    '''A versioned CSV report of data/00 to data/09 made now, data/03 has an old version and data/05 was deleted'''
+    for bucket in (BUCKET, DESTINATION):
+        s3_client.create_bucket(Bucket = bucket)
+    put_objects(s3_client, BUCKET, (f"data/{i:02d}" for i in range(10) if i != 5), b"old")
+    made = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds = 1)
+    modified = (made - datetime.timedelta(days = 1)).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+    text = io.StringIO()
+    writer = csv.writer(text)
+    for i in range(10):
+        writer.writerow([BUCKET, f"data/{i:02d}", f"v{i}", "true", "true" if i == 5 else "false", 3, modified, "etag", "STANDARD"])
+    writer.writerow([BUCKET, "data/03", "v-old", "false", "false", 9, modified, "etag", "STANDARD"])
+    s3_client.put_object(Bucket = DESTINATION, Key = "report/data/0.csv.gz", Body = gzip.compress(text.getvalue().encode()))
+    manifest = {"sourceBucket": BUCKET, "destinationBucket": f"arn:aws:s3:::{DESTINATION}", "fileFormat": "CSV",
+                "creationTimestamp": str(int(made.timestamp() * 1000)), "fileSchema": SCHEMA,
+                "files": [{"key": "report/data/0.csv.gz", "size": 1, "MD5checksum": "x"}]}
+    s3_client.put_object(Bucket = DESTINATION, Key = "report/2024-01-01T00-00Z/manifest.json",
+                         Body = json.dumps(manifest).encode())
+    return Inventory(session, DESTINATION, "report/", cache_dir = str(tmp_path))
+
+def test_versioned_report_keeps_current_versions(inventory):
+    keys = inventory.filter("data/")["Key"].to_pylist()
+
+    assert keys == [f"data/{i:02d}" for i in range(10) if i != 5]
+    assert inventory.filter(min_size = 4).num_rows == 0
+
+def test_snapshot_by_default(session, s3_client, inventory):
+    put_objects(s3_client, BUCKET, ["data/00a"], b"new") #sorts before the report's last key
+
+    keys = [obj["Key"] for obj in inventory.iter_objects_with_name_date(session, "data/")]
+
+    assert "data/00a" not in keys and len(keys) == 9
+
+def test_live_adds_objects_written_since_the_report(session, s3_client, inventory):
+    time.sleep(2) #S3 dates have a one second resolution
+    put_objects(s3_client, BUCKET, ["data/00a", "data/99"], b"new")
+    put_objects(s3_client, BUCKET, ["data/04"], b"rewritten")
+
+    objects = list(inventory.iter_objects_with_name_date(session, "data/", live = True))
+
+    keys = [obj["Key"] for obj in objects]
+    assert sorted(keys) == sorted([f"data/{i:02d}" for i in range(10) if i != 5] + ["data/00a", "data/99"])
+    assert len(keys) == len(set(keys))
+    assert [obj["Size"] for obj in objects if obj["Key"] == "data/04"] == [len(b"rewritten")]
+    assert [obj["Key"] for obj in inventory.iter_objects_with_name_date(session, "data/", min_size = 5, live = True)] == ["data/04"]
@@ -0,0 +1,49 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from conftest import list_keys
+from s3_logs import ingest_access_logs, read_checkpoint
+
+LOGS = "logging-bucket"
+OUTPUT = "parquet-bucket"
+RECORD = ('owner melon-bucket [17/Oct/2026:08:00:00 +0000] 10.0.0.1 requester {request_id} REST.GET.OBJECT '
+          'data/{request_id} "GET /data/{request_id} HTTP/1.1" 200 - 5 5 3 2 "-" "agent" -')
+
+@pytest.fixture
+def buckets(s3_client):
+    for bucket in (LOGS, OUTPUT):
+        s3_client.create_bucket(Bucket = bucket)
+    return s3_client
+
+def deliver(s3_client, key: str):
+    request_id = key.rsplit("-", 1)[-1]
+    s3_client.put_object(Bucket = LOGS, Key = f"melon/{key}", Body = RECORD.format(request_id = request_id).encode())
+
+def ingest(session, tmp_path) -> dict:
+    return ingest_access_logs(session, LOGS, "melon/", OUTPUT, "logs/", batch_size = 2, max_workers = 2,
+                              cache_dir = str(tmp_path), verbose = False)
+
+def test_logs_listed_before_the_checkpoint_are_ingested_once(session, buckets, tmp_path):
+    for key in ("2026-10-17-08-00-00-BBBB", "2026-10-17-08-00-00-CCCC", "2026-10-17-08-04-00-DDDD"):
+        deliver(buckets, key)
+    assert ingest(session, tmp_path)["Processed"] == 3
+    #same second with a lower suffix, and a late delivery a minute earlier
+    deliver(buckets, "2026-10-17-08-00-00-AAAA")
+    deliver(buckets, "2026-10-17-08-03-00-EEEE")
+    result = ingest(session, tmp_path)
+    assert result["Processed"] == 2
+    assert result["Checkpoint"] == "melon/2026-10-17-08-04-00-DDDD"
+    assert ingest(session, tmp_path)["Processed"] == 0
+    request_ids = []
+    for key in list_keys(buckets, OUTPUT, "logs/"):
+        body = buckets.get_object(Bucket = OUTPUT, Key = key)["Body"].read()
+        request_ids += pq.read_table(pa.BufferReader(body))["request_id"].to_pylist()
+    assert sorted(request_ids) == ["AAAA", "BBBB", "CCCC", "DDDD", "EEEE"]
+
+def test_recent_keys_outside_the_overlap_are_dropped(session, buckets, tmp_path):
+    for key in ("2026-10-17-07-00-00-AAAA", "2026-10-17-08-00-00-BBBB"):
+        deliver(buckets, key)
+    ingest(session, tmp_path)
+    checkpoint = read_checkpoint(LOGS, "melon/", str(tmp_path))
+    assert checkpoint == {"LastKey": "melon/2026-10-17-08-00-00-BBBB", "Recent": ["melon/2026-10-17-08-00-00-BBBB"]}